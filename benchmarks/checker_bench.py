@@ -0,0 +1,554 @@
+"""
+Offline benchmark for ProxyChecker and the upload pipeline, run against local
+stand-ins instead of httpbin / ipify / ip-api: an aiohttp judge plus HTTP
+(absolute-form and CONNECT), SOCKS4 and SOCKS5 proxy simulators with
+configurable latency, failure rate and blackholing.
+
+    python benchmarks/checker_bench.py [--sizes 1000,10000,100000]
+        [--scenarios http,connect,socks4,socks5,auto,all,pipeline]
+        [--latency MS] [--judge-latency MS] [--fail-rate F] [--blackhole-rate F]
+        [--timeout S] [--concurrency N] [--processes N] [--no-pool]
+        [--save-baseline FILE] [--baseline FILE] [--tolerance F]
+
+Every simulated proxy is its own 127.x.y.z address (Linux routes all of
+127.0.0.0/8 to loopback), so dedupe and per-host pooling behave as with a
+real list; the simulators therefore listen on 0.0.0.0 while the run lasts.
+They drop any client that is not on loopback, and CONNECT only tunnels to
+the local TLS judge, so they are never an open relay.
+Whether an address is healthy, refuses or blackholes is a hash of the
+address, so every scenario sees the same proxies.
+
+The connect scenario tunnels each check to a real TLS judge socket; at 100k
+it can run into the ephemeral port range, the other scenarios answer the
+judge request inside the simulator once the proxy handshake is done.
+
+With --processes N the checks go through the sharded engine (N worker
+processes) instead of the benchmark's own loop; the simulators stay here.
+--no-pool gives every check its own ProxyChecker and session, closed after
+it, the way checks ran before the shared connection pool.
+
+Reports checks/s, p50/p99 per-check latency, peak RSS and peak open FDs.
+RSS and FDs are those of this process, engine workers not included.
+
+--save-baseline writes checks/s and p99 per scenario and size to a JSON file;
+--baseline compares a later run with it and exits 1 if any checks/s fell, or
+p99 rose, by more than --tolerance (default 0.2, i.e. 20%).
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import zlib
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# bot.py keeps data/ relative to the working directory. Engine
+# processes re-import this module as __mp_main__, already inside WORKDIR
+if __name__ == "__main__":
+    START_DIR = os.getcwd()
+    WORKDIR = tempfile.mkdtemp(prefix="checker_bench_")
+    os.chdir(WORKDIR)
+
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+import checker  # noqa: E402
+
+
+# ================== SIMULATED NETWORK ==================
+
+def endpoint_ip(i):
+    """i-th simulated proxy address, skipping 127.0.0.0/16 where the judge lives"""
+    return f"127.{1 + (i >> 16)}.{(i >> 8) & 255}.{i & 255}"
+
+
+class Network:
+    """Judge + proxy simulators sharing one behaviour model"""
+
+    def __init__(self, latency, judge_latency, fail_rate, blackhole_rate):
+        self.latency = latency / 1000
+        self.judge_latency = judge_latency / 1000
+        self.fail_rate = fail_rate
+        self.blackhole_rate = blackhole_rate
+        self.ports = {}
+        self.judge_port = None
+        self.tls_port = None
+        self._servers = []
+        self._runner = None
+        self.file_text = ""
+
+    def behaviour(self, ip):
+        h = zlib.crc32(ip.encode()) / 2 ** 32
+        if h < self.fail_rate:
+            return "fail"
+        if h < self.fail_rate + self.blackhole_rate:
+            return "blackhole"
+        return "ok"
+
+    # --- judge ---
+
+    async def _judge(self, request):
+        await asyncio.sleep(self.judge_latency)
+        return web.json_response({"origin": request.remote})
+
+    async def _file(self, request):
+        return web.Response(text=self.file_text)
+
+    def _tls_context(self):
+        if not shutil.which("openssl"):
+            return None
+        key, cert = "judge.key", "judge.crt"  # in the working directory
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+             "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+            check=True, capture_output=True,
+        )
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(cert, key)
+        return ctx
+
+    # --- proxies ---
+
+    async def _inline_judge(self, reader, writer, head=None):
+        """Answer HTTP requests arriving on an established tunnel as the judge would"""
+        while True:
+            if head is None:
+                head = await reader.readuntil(b"\r\n\r\n")
+            await asyncio.sleep(self.judge_latency)
+            peer = writer.get_extra_info("peername")[0]
+            body = json.dumps({"origin": peer}).encode()
+            # HTTP/1.1 keeps the connection unless told to close, HTTP/1.0 only if asked to
+            lower = head.lower()
+            if b"HTTP/1.0" in head.split(b"\r\n", 1)[0]:
+                keep = b"connection: keep-alive" in lower
+            else:
+                keep = b"connection: close" not in lower
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\nConnection: %s\r\n\r\n" % (len(body), b"keep-alive" if keep else b"close")
+                + body
+            )
+            await writer.drain()
+            if not keep:
+                return
+            head = None
+
+    async def _tunnel(self, reader, writer, host, port):
+        if port != self.tls_port:
+            return await self._inline_judge(reader, writer)
+        if host != "127.0.0.1":
+            return  # only ever relay to our own TLS judge
+        up_reader, up_writer = await asyncio.open_connection(host, port)
+
+        async def pipe(src, dst):
+            try:
+                while data := await src.read(65536):
+                    dst.write(data)
+                    await dst.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                dst.close()
+
+        await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+
+    async def _http(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        method, target = head.split(b" ", 2)[:2]
+        if method == b"CONNECT":
+            host, _, port = target.decode().rpartition(":")
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            await writer.drain()
+            await self._tunnel(reader, writer, host, int(port))
+        else:
+            await self._inline_judge(reader, writer, head)
+
+    async def _socks5(self, reader, writer):
+        version, n = await reader.readexactly(2)
+        if version != 5:
+            return
+        methods = await reader.readexactly(n)
+        if 0 not in methods and 2 in methods:
+            writer.write(b"\x05\x02")
+            await reader.readexactly(1)
+            await reader.readexactly((await reader.readexactly(1))[0])
+            await reader.readexactly((await reader.readexactly(1))[0])
+            writer.write(b"\x01\x00")
+        else:
+            writer.write(b"\x05\x00")
+        _, _, _, atyp = await reader.readexactly(4)
+        if atyp == 1:
+            host = ".".join(map(str, await reader.readexactly(4)))
+        elif atyp == 3:
+            host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+        else:
+            host = "::1"
+            await reader.readexactly(16)
+        port = int.from_bytes(await reader.readexactly(2), "big")
+        writer.write(b"\x05\x00\x00\x01" + b"\x00" * 6)
+        await writer.drain()
+        await self._tunnel(reader, writer, host, port)
+
+    async def _socks4(self, reader, writer):
+        version, _ = await reader.readexactly(2)
+        if version != 4:
+            return
+        port = int.from_bytes(await reader.readexactly(2), "big")
+        ip = await reader.readexactly(4)
+        await reader.readuntil(b"\x00")  # user id
+        if ip[:3] == b"\x00\x00\x00":
+            host = (await reader.readuntil(b"\x00"))[:-1].decode()  # SOCKS4a
+        else:
+            host = ".".join(map(str, ip))
+        writer.write(b"\x00\x5a" + b"\x00" * 6)
+        await writer.drain()
+        await self._tunnel(reader, writer, host, port)
+
+    def _serve(self, handler):
+        async def serve(reader, writer):
+            if not writer.get_extra_info("peername")[0].startswith("127."):
+                writer.close()  # listening on 0.0.0.0, but only for this machine
+                return
+            mode = self.behaviour(writer.get_extra_info("sockname")[0])
+            try:
+                if mode == "blackhole":
+                    while await reader.read(65536):
+                        pass
+                elif mode == "ok":
+                    await asyncio.sleep(self.latency)
+                    await handler(reader, writer)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+                pass
+            finally:
+                writer.close()
+        return serve
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/ip", self._judge)
+        app.router.add_get("/file.txt", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.judge_port = site._server.sockets[0].getsockname()[1]
+
+        tls = self._tls_context()
+        if tls:
+            site = web.TCPSite(self._runner, "127.0.0.1", 0, ssl_context=tls)
+            await site.start()
+            self.tls_port = site._server.sockets[0].getsockname()[1]
+
+        for kind, handler in (("http", self._http), ("socks4", self._socks4), ("socks5", self._socks5)):
+            server = await asyncio.start_server(self._serve(handler), "0.0.0.0", 0, backlog=4096)
+            self._servers.append(server)
+            self.ports[kind] = server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        await self._runner.cleanup()
+
+    def judge_urls(self, tls=False):
+        if tls:
+            return [f"https://127.0.0.1:{self.tls_port}/ip?judge={i}" for i in range(3)]
+        return [f"http://127.0.0.1:{self.judge_port}/ip?judge={i}" for i in range(3)]
+
+    def lines(self, n, kinds):
+        """n proxy lines spread over the simulator kinds, and how many should be live"""
+        lines, healthy = [], 0
+        for i in range(1, n + 1):
+            ip = endpoint_ip(i)
+            lines.append(f"{ip}:{self.ports[kinds[i % len(kinds)]]}")
+            healthy += self.behaviour(ip) == "ok"
+        return lines, healthy
+
+
+# ================== MEASUREMENT ==================
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+class FdSampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = open_fds()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, open_fds())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(name, size, live, expected, elapsed, latencies, fds, deadlines="-"):
+    """Print one result row and return its comparable numbers"""
+    p50 = f"{percentile(latencies, 0.50) * 1000:8.1f}" if latencies else f"{'-':>8}"
+    p99 = f"{percentile(latencies, 0.99) * 1000:8.1f}" if latencies else f"{'-':>8}"
+    print(
+        f"{name:<10} {size:>8,} {f'{live}/{expected}':>15} {size / elapsed:10,.0f} "
+        f"{p50} {p99} {peak_rss_mb():10.1f} {fds:8}  {deadlines}"
+    )
+    return {
+        "checks_per_s": round(size / elapsed, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """Rows of this run that are worse than the baseline by more than tolerance"""
+    worse = []
+    for key, now in results.items():
+        then = baseline.get(key)
+        if not then:
+            continue
+        if now["checks_per_s"] < then["checks_per_s"] * (1 - tolerance):
+            worse.append(f"{key}: {now['checks_per_s']:,.0f} checks/s, baseline {then['checks_per_s']:,.0f}")
+        if now["p99_ms"] and then.get("p99_ms") and now["p99_ms"] > then["p99_ms"] * (1 + tolerance):
+            worse.append(f"{key}: p99 {now['p99_ms']:.1f} ms, baseline {then['p99_ms']:.1f} ms")
+    return worse
+
+
+# ================== SCENARIOS ==================
+
+async def drive(lines, check, concurrency):
+    """Run check(line) over every line on a WorkerPool; returns (live, elapsed, latencies, peak fds)"""
+    latencies = []
+    live = 0
+
+    async def one(line):
+        nonlocal live
+        start = time.perf_counter()
+        result = await check(line)
+        latencies.append(time.perf_counter() - start)
+        live += bool(result and result["live"])
+
+    with FdSampler() as fds:
+        start = time.perf_counter()
+        pool = bot.WorkerPool(one, concurrency, concurrency * 4).start()
+        try:
+            for line in lines:
+                await pool.put(line)
+            await pool.join()
+        finally:
+            await pool.close()
+        elapsed = time.perf_counter() - start
+    return live, elapsed, latencies, fds.peak
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        pass
+
+
+class FakeBot:
+    """Just enough of telegram.Bot for run_check_job"""
+
+    def __init__(self, url):
+        self.url = url
+        self.documents = 0
+
+    async def get_file(self, file_id):
+        return types.SimpleNamespace(file_path=self.url)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return FakeMessage()
+
+    async def send_document(self, chat_id, document=None, **kwargs):
+        self.documents += 1
+
+
+async def run_pipeline(net, lines, concurrency):
+    """Upload -> stream -> parse -> dedupe -> check -> spool -> reports, as handle_file runs it"""
+    net.file_text = "\n".join(lines)
+    fake_bot = FakeBot(f"http://127.0.0.1:{net.judge_port}/file.txt")
+    message = types.SimpleNamespace(
+        document=types.SimpleNamespace(file_id="bench", file_name="bench.txt"),
+        reply_text=None,
+    )
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=1, username="bench"),
+        effective_chat=types.SimpleNamespace(id=1),
+        message=message,
+    )
+    context = types.SimpleNamespace(user_data={"ptype": "auto"}, bot=fake_bot)
+
+    bot.MAX_CONCURRENCY = concurrency
+    bot.USER_CHECK_CAP = concurrency
+    with FdSampler() as fds:
+        start = time.perf_counter()
+        await bot.handle_file(update, context)
+        await asyncio.gather(*bot.active_jobs.values())
+        elapsed = time.perf_counter() - start
+
+    job = bot.store.list_jobs(1, 1)[0]
+    return job["live"], elapsed, fds.peak
+
+
+SCENARIOS = {
+    # name: (simulator kinds, judge over TLS, check mode; None = the whole upload pipeline)
+    "http": (("http",), False, "http"),
+    "connect": (("http",), True, "http"),
+    "socks4": (("socks4",), False, "socks4"),
+    "socks5": (("socks5",), False, "socks5"),
+    "auto": (("http", "socks4", "socks5"), False, "auto"),
+    "all": (("http", "socks4", "socks5"), False, "all"),
+    "pipeline": (("http", "socks4", "socks5"), False, None),
+}
+
+
+def unpooled_checker(ptype):
+    """A ProxyChecker and session per check, torn down after it"""
+    async def check(line):
+        own = checker.ProxyChecker(bot.proxy_checker.test_urls)
+        own.real_ips = bot.proxy_checker.real_ips
+        try:
+            return await own.check(line, ptype)
+        finally:
+            await own.close()
+    return check
+
+
+def checker_for(run_id, ptype, pooled=True):
+    if not pooled:
+        return unpooled_checker(ptype)
+    if bot.engine.running:
+        return lambda line: bot.engine.check(run_id, line, line, ptype)
+    return lambda line: bot.proxy_checker.check(line, ptype)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=5, help="proxy handshake delay, ms")
+    parser.add_argument("--judge-latency", type=float, default=5, help="judge answer delay, ms")
+    parser.add_argument("--fail-rate", type=float, default=0.2, help="share of proxies that refuse")
+    parser.add_argument("--blackhole-rate", type=float, default=0.01, help="share that never answer")
+    parser.add_argument("--timeout", type=float, default=3, help="checker timeouts, s (bot default 15)")
+    parser.add_argument("--concurrency", type=int, default=bot.MAX_CONCURRENCY)
+    parser.add_argument("--processes", type=int, default=0, help="engine worker processes, 0 = in-process")
+    parser.add_argument("--no-pool", action="store_true", help="a new session per check, as before pooling")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write this run's numbers as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="exit 1 if this run is worse than FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+    # Resolve before moving to WORKDIR
+    for name in ("save_baseline", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(START_DIR, getattr(args, name)))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # Blackholes cost a full timeout each; shrink them so a run stays short
+    checker.TIMEOUT = checker.aiohttp.ClientTimeout(total=args.timeout)
+    checker.CONNECT_TIMEOUT = min(checker.CONNECT_TIMEOUT, args.timeout)
+    checker.HANDSHAKE_TIMEOUT = min(checker.HANDSHAKE_TIMEOUT, args.timeout)
+    checker.READ_TIMEOUT = min(checker.READ_TIMEOUT, args.timeout)
+    bot.ensure_storage()
+
+    net = Network(args.latency, args.judge_latency, args.fail_rate, args.blackhole_rate)
+    await net.start()
+    if args.processes > 1:
+        bot.engine.processes = args.processes  # the one object bot and checker share
+        await bot.engine.start()
+
+    print(
+        f"latency {args.latency}ms, judge {args.judge_latency}ms, fail {args.fail_rate:.0%}, "
+        f"blackhole {args.blackhole_rate:.0%}, timeout {args.timeout}s, concurrency {args.concurrency}, "
+        f"judge mode {bot.JUDGE_MODE}, engine {f'{args.processes} processes' if bot.engine.running else 'in-process'}"
+        f"{', one session per check' if args.no_pool else ''}\n"
+    )
+    print(
+        f"{'scenario':<10} {'size':>8} {'live/expected':>15} {'checks/s':>10} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'peakRSS MB':>10} {'peak FDs':>8}  deadlines at the end"
+    )
+
+    results = {}
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            for name in args.scenarios.split(","):
+                kinds, tls, ptype = SCENARIOS[name]
+                if tls and not net.tls_port:
+                    print(f"{name:<10} {size:>8,}  skipped: openssl not found for the TLS judge")
+                    continue
+                bot.proxy_checker.test_urls = net.judge_urls(tls)
+                if bot.engine.running:
+                    bot.engine.configure()
+                lines, expected = net.lines(size, kinds)
+
+                if ptype is None:
+                    # the job learns its own deadlines, they end up in its report header
+                    live, elapsed, fds = await run_pipeline(net, lines, args.concurrency)
+                    results[f"{name}:{size}"] = report(name, size, live, expected, elapsed, [], fds)
+                else:
+                    timeouts = bot.TimeoutPolicy()  # a fresh run, as for every uploaded file
+                    bot.current_timeouts.set(timeouts)
+                    run_id = f"{name}-{size}"
+                    live, elapsed, latencies, fds = await drive(lines, checker_for(run_id, ptype, not args.no_pool), args.concurrency)
+                    if bot.engine.running:
+                        bot.engine.end_job(run_id)
+                        deadlines = "learnt per shard"
+                    else:
+                        deadlines = timeouts.describe()
+                    results[f"{name}:{size}"] = report(
+                        name, size, live, expected, elapsed, latencies, fds, deadlines
+                    )
+    finally:
+        await bot.engine.stop()
+        await bot.proxy_checker.close()
+        await net.close()
+        bot.store.close()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nbaseline saved to {args.save_baseline}")
+    if baseline is not None:
+        worse = regressions(results, baseline, args.tolerance)
+        if worse:
+            print(f"\nregressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for line in worse:
+                print(f"  {line}")
+            return 1
+        print(f"\nno regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
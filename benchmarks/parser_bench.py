@@ -0,0 +1,151 @@
+"""
+Microbenchmark: ProxyParser vs the original unvalidated parser (speed and
+retained memory per record, overall and per line format). Both parsers run
+in turn within each round after a gc.collect(), and their records are
+consumed as they come, the way the bot streams them into its queue, so
+neither pays for collecting the other's garbage or for a list it never keeps.
+
+    python benchmarks/parser_bench.py [lines]
+"""
+import gc
+import os
+import re
+import sys
+import time
+import random
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from checker import ProxyParser  # noqa: E402
+
+
+def legacy_parse_proxy(proxy_str):
+    """The parser as it was before validation and ProxyInfo, kept for comparison"""
+    proxy_str = proxy_str.strip()
+    proxy_str = proxy_str.replace('"', '').replace("'", '')
+    
+    if proxy_str.count(':') == 3:
+        parts = proxy_str.split(':')
+        if len(parts) == 4:
+            ip, port, user, password = parts
+            return {'ip': ip, 'port': port, 'user': user, 'password': password,
+                    'original': f"{user}:{password}@{ip}:{port}", 'format': 'auth'}
+    elif '@' in proxy_str:
+        auth_part, host_part = proxy_str.split('@')
+        if ':' in auth_part and ':' in host_part:
+            user, password = auth_part.split(':')
+            ip, port = host_part.split(':')
+            return {'ip': ip, 'port': port, 'user': user, 'password': password,
+                    'original': proxy_str, 'format': 'auth'}
+    elif proxy_str.count(':') == 1:
+        ip, port = proxy_str.split(':')
+        return {'ip': ip, 'port': port, 'user': None, 'password': None,
+                'original': proxy_str, 'format': 'no_auth'}
+    else:
+        ip_match = re.search(r'\b(?:\d{1,3}\.){3}\d{1,3}\b', proxy_str)
+        port_match = re.search(r':(\d{2,5})', proxy_str)
+        if ip_match and port_match:
+            ip = ip_match.group()
+            port = port_match.group(1)
+            return {'ip': ip, 'port': port, 'user': None, 'password': None,
+                    'original': f"{ip}:{port}", 'format': 'extracted'}
+    return None
+
+
+def legacy_parse_many(buffer):
+    """parse_many's line loop around the legacy parser, so batch numbers compare like for like"""
+    for line in buffer.splitlines():
+        line = line.strip()
+        if not line or line[0] == "#" or line.startswith("//"):
+            continue
+        yield line, legacy_parse_proxy(line)
+
+
+# Real lists put most lines on a few well-known or gateway ports
+COMMON_PORTS = (80, 443, 999, 1080, 3128, 4145, 5678, 8000, 8080, 8118, 8888, 9050, 9090, 10808)
+
+
+def make_lines(n, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        ip = ".".join(str(rnd.randint(1, 254)) for _ in range(4))
+        port = rnd.choice(COMMON_PORTS) if rnd.random() < 0.8 else rnd.randint(1000, 65000)
+        kind = i % 5
+        if kind == 0:
+            lines.append(f"{ip}:{port}")
+        elif kind == 1:
+            lines.append(f"user{i}:pass{i}@{ip}:{port}")
+        elif kind == 2:
+            lines.append(f"{ip}:{port}:user{i}:pass{i}")
+        elif kind == 3:
+            lines.append(f"socks5://{ip}:{port}")
+        else:
+            lines.append(f"{ip} {port} | scraped {i}")
+    return lines
+
+
+def bench(names, funcs, lines, rounds=7):
+    """Best time of each func(lines) over interleaved rounds; funcs must return an iterator"""
+    best = [float("inf")] * len(funcs)
+    for _ in range(rounds):
+        for i, func in enumerate(funcs):
+            gc.collect()
+            start = time.perf_counter()
+            deque(func(lines), maxlen=0)
+            best[i] = min(best[i], time.perf_counter() - start)
+    for name, elapsed in zip(names, best):
+        print(f"{name:<28} {elapsed * 1000:9.1f} ms  {len(lines) / elapsed:12,.0f} lines/s")
+    return best
+
+
+def retained(name, func, lines):
+    """Memory held by the parse results of every line"""
+    tracemalloc.start()
+    records = func(lines)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    print(f"{name:<28} {size / len(lines):9.0f} bytes/record")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    lines = make_lines(n)
+    buffer = "\n".join(lines)
+    print(f"Parsing {n:,} mixed-format lines (best of 7)\n")
+    
+    legacy, single = bench(
+        ["legacy parse_proxy", "new parse_proxy"],
+        [lambda ls: map(legacy_parse_proxy, ls), lambda ls: map(ProxyParser.parse_proxy, ls)],
+        lines,
+    )
+    legacy_batch, batch = bench(
+        ["legacy parse_many(buffer)", "new parse_many(buffer)"],
+        [lambda _: legacy_parse_many(buffer), lambda _: ProxyParser.parse_many(buffer)],
+        lines,
+    )
+    
+    print(f"\nrelative speed: {legacy / single:.2f}x per line, {legacy_batch / batch:.2f}x batch\n")
+    
+    retained("legacy parse_proxy", lambda ls: [legacy_parse_proxy(l) for l in ls], lines)
+    retained("new parse_proxy", lambda ls: [ProxyParser.parse_proxy(l) for l in ls], lines)
+    
+    # Per-format breakdown: the fast path covers the first three, the old
+    # re.search fallback costs on scheme:// and messy lines
+    print()
+    kinds = ["ip:port", "user:pass@ip:port", "ip:port:user:pass", "scheme://ip:port", "messy"]
+    for i, kind in enumerate(kinds):
+        sample = lines[i::len(kinds)]
+        old, new = bench(
+            [f"legacy   {kind}", f"new      {kind}"],
+            [lambda ls: map(legacy_parse_proxy, ls), lambda ls: map(ProxyParser.parse_proxy, ls)],
+            sample,
+        )
+        print(f"{'':<28} {old / new:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,24 @@
 import os
 import json
+import atexit
 import time
 import asyncio
 import logging
 import aiohttp
-import requests
-import tarfile
-import re
+import shutil
+import codecs
+import sqlite3
+import threading
+import heapq
+import itertools
+import statistics
 from datetime import datetime
-from collections import defaultdict
+from urllib.parse import urlsplit
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import RetryAfter, BadRequest, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -20,7 +28,35 @@ from telegram.ext import (
     filters,
 )
 
-import geoip2.database
+# Everything that checks proxies lives in checker, which also runs without Telegram
+import checker
+from checker import (
+    DATA_DIR,
+    GEO_READER_MODE,
+    JUDGE_MODE,
+    JUDGES_PER_CHECK,
+    JUDGE_SERVER_PORT,
+    ENGINE_PROCESSES,
+    IO_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    VERIFIED_SSL,
+    io_executor,
+    run_io,
+    ProxyParser,
+    geo_refresh_loop,
+    load_geo_readers,
+    close_geo_readers,
+    geo_cache,
+    smart_score,
+    TimeoutPolicy,
+    current_timeouts,
+    proxy_checker,
+    judge_server,
+    WorkerPool,
+    active_pools,
+    engine,
+    _remove_files,
+)
 
 # ================== HARD CONFIG ==================
 
@@ -28,30 +64,103 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 OWNER_ID = 8537424608  # 🔥 RAW OWNER ID
 
-MAXMIND_ACCOUNT_ID = os.getenv("MAXMIND_ACCOUNT_ID")
-MAXMIND_LICENSE_KEY = os.getenv("MAXMIND_LICENSE_KEY")
-
 REQUIRED_CHANNELS = ["@legendyt830", "@youXyash"]
 
-DATA_DIR = "data"
 RESULTS_DIR = f"{DATA_DIR}/results"
-GEO_DB = f"{DATA_DIR}/GeoLite2-City.mmdb"
+DB_PATH = f"{DATA_DIR}/proxies.db"  # uptime, proxies_db, user_stats and jobs live here
+JOBS_DIR = f"{DATA_DIR}/jobs"  # input snapshots of unfinished checks
+
+MAX_CONCURRENCY = 50  # accurate, not fake-fast (workers per check, tune live with /workers)
+MAX_WORKERS_LIMIT = 500
+
+# Process-wide check scheduling, shared fairly by everyone checking at once
+GLOBAL_CHECK_BUDGET = int(os.getenv("GLOBAL_CHECK_BUDGET", 200))  # checks in flight across all users
+USER_CHECK_CAP = int(os.getenv("USER_CHECK_CAP", 0))  # per user, all their files together (0 = follow /workers)
+OWNER_CHECK_CAP = int(os.getenv("OWNER_CHECK_CAP", GLOBAL_CHECK_BUDGET))
+USER_WEIGHT = 1
+OWNER_WEIGHT = int(os.getenv("OWNER_WEIGHT", 4))  # owner gets 4 slots for every 1 of a busy user
+
+# Streaming ingestion of uploaded files
+INGEST_QUEUE_SIZE = MAX_CONCURRENCY * 4  # lines buffered ahead of the workers
 
-TIMEOUT = aiohttp.ClientTimeout(total=15)
-MAX_CONCURRENCY = 50  # accurate, not fake-fast
+# Live results are spooled to disk as they arrive, then merge-sorted by score
+SPOOL_FLUSH_LINES = 200  # buffered lines per write
+SORT_RUN_SIZE = int(os.getenv("SORT_RUN_SIZE", 20000))  # records sorted in memory per merge run
+MAX_UPLOAD_BYTES = 45 * 1024 * 1024  # bots can send documents up to 50MB, bigger reports go in parts
+
+# Fast mode (opt-in per user with /fastmode): answer recent checks from the store
+FAST_MODE_TTL = int(os.getenv("FAST_MODE_TTL", 3600))  # a proxy seen alive this recently is not re-judged
+DEAD_CACHE_TTL = int(os.getenv("DEAD_CACHE_TTL", 1800))  # a proxy found dead this recently is skipped
+
+# Progress message updates (one editor task per check, never inside a worker)
+PROGRESS_INTERVAL = 3  # seconds between edits, keeps us far from Telegram flood limits
+PROGRESS_WINDOW = 30  # seconds of history behind the CPM / ETA estimate
+
+# Event loop lag sampling
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag samples
+LOOP_LAG_SAMPLES = 240  # ~2 minutes of history
 
 # ================== ENHANCED LOGGING ==================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+# Configured by main(): engine shards re-import this file as __mp_main__ and
+# must not open bot.log or register our exit hooks
 logger = logging.getLogger(__name__)
 
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+        handlers=[
+            logging.FileHandler("bot.log"),
+            logging.StreamHandler()
+        ]
+    )
+
+# ================== EVENT LOOP LAG ==================
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed sleep"""
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL, samples=LOOP_LAG_SAMPLES):
+        self.interval = interval
+        self.samples = deque(maxlen=samples)
+        self._task = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval) * 1000)
+    
+    def stats(self):
+        """Lag in ms: last sample, average, p99 and max over the window"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return {
+            "current": round(self.samples[-1], 1),
+            "avg": round(statistics.fmean(ordered), 1),
+            "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 1),
+            "max": round(ordered[-1], 1),
+        }
+
+loop_lag = LoopLagMonitor()
+
 # ================== FIXED STORAGE WITH AUTO CREATION ==================
 
 def ensure_storage():
@@ -68,9 +177,6 @@ def ensure_storage():
             "last_reset": datetime.now().strftime("%Y-%m-%d")
         },
         "ban.json": [],
-        "uptime.json": {},
-        "user_stats.json": {},
-        "proxies_db.json": {}
     }
     
     for filename, default_data in json_files.items():
@@ -116,6 +222,9 @@ def ensure_storage():
 
 def load(name):
     """Load JSON file with error handling and auto-fix"""
+    if name in STORE_TABLES:
+        return store.load_table(name)
+    
     try:
         filepath = f"{DATA_DIR}/{name}"
         if not os.path.exists(filepath):
@@ -151,6 +260,9 @@ def load(name):
 
 def save(name, data):
     """Save JSON file with error handling"""
+    if name in STORE_TABLES:
+        return store.save_table(name, data)
+    
     try:
         with open(f"{DATA_DIR}/{name}", "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2, ensure_ascii=False, default=str)
@@ -164,172 +276,393 @@ def save(name, data):
         except:
             pass
 
-# ================== PROXY PARSER ==================
-
-class ProxyParser:
-    @staticmethod
-    def parse_proxy(proxy_str):
-        """
-        Parse various proxy formats:
-        1. ip:port
-        2. user:pass@ip:port
-        3. ip:port:user:pass
-        4. ip:port:user:pass:type (some providers)
-        """
-        proxy_str = proxy_str.strip()
-        
-        # Clean up any extra spaces or quotes
-        proxy_str = proxy_str.replace('"', '').replace("'", '')
-        
-        # Pattern 1: ip:port:user:pass
-        if proxy_str.count(':') == 3:
-            parts = proxy_str.split(':')
-            if len(parts) == 4:
-                ip, port, user, password = parts
-                return {
-                    'ip': ip,
-                    'port': port,
-                    'user': user,
-                    'password': password,
-                    'original': f"{user}:{password}@{ip}:{port}",
-                    'format': 'auth'
-                }
-        
-        # Pattern 2: user:pass@ip:port
-        elif '@' in proxy_str:
-            auth_part, host_part = proxy_str.split('@')
-            if ':' in auth_part and ':' in host_part:
-                user, password = auth_part.split(':')
-                ip, port = host_part.split(':')
-                return {
-                    'ip': ip,
-                    'port': port,
-                    'user': user,
-                    'password': password,
-                    'original': proxy_str,
-                    'format': 'auth'
-                }
-        
-        # Pattern 3: ip:port (no auth)
-        elif proxy_str.count(':') == 1:
-            ip, port = proxy_str.split(':')
-            return {
-                'ip': ip,
-                'port': port,
-                'user': None,
-                'password': None,
-                'original': proxy_str,
-                'format': 'no_auth'
-            }
-        
-        # Pattern 4: Try to extract IP:PORT from messy string
-        else:
-            # Try to find IP:PORT pattern
-            ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-            port_pattern = r':(\d{2,5})'
-            
-            ip_match = re.search(ip_pattern, proxy_str)
-            port_match = re.search(port_pattern, proxy_str)
-            
-            if ip_match and port_match:
-                ip = ip_match.group()
-                port = port_match.group(1)
-                return {
-                    'ip': ip,
-                    'port': port,
-                    'user': None,
-                    'password': None,
-                    'original': f"{ip}:{port}",
-                    'format': 'extracted'
-                }
-        
-        return None
-
-    @staticmethod
-    def normalize_proxy(proxy_info):
-        """Convert proxy info to standard format"""
-        if proxy_info['user'] and proxy_info['password']:
-            return f"{proxy_info['user']}:{proxy_info['password']}@{proxy_info['ip']}:{proxy_info['port']}"
-        else:
-            return f"{proxy_info['ip']}:{proxy_info['port']}"
+_checks_lock = threading.Lock()
 
-# ================== GEO DB AUTO DOWNLOAD & UPDATE ==================
+def add_checks_count(count):
+    """Add checked proxies to the global counters, resetting 'today' on a new day"""
+    with _checks_lock:
+        _add_checks_count(count)
 
-def ensure_geolite_db():
-    if os.path.exists(GEO_DB):
-        # Check if DB is older than 7 days
-        db_age = time.time() - os.path.getmtime(GEO_DB)
-        if db_age < 604800:  # 7 days in seconds
-            return
-        
-        logger.info("🔄 GeoLite2 City database is old, updating...")
+def _add_checks_count(count):
+    checks = load("checks_count.json")
+    today = datetime.now().strftime("%Y-%m-%d")
+    
+    # Ensure checks dictionary has all required keys
+    if "last_reset" not in checks:
+        checks["last_reset"] = today
+    if "today" not in checks:
+        checks["today"] = 0
+    if "total" not in checks:
+        checks["total"] = 0
+    
+    # Reset today's count if it's a new day
+    if checks["last_reset"] != today:
+        checks["today"] = 0
+        checks["last_reset"] = today
     
-    logging.info("⬇️ Downloading GeoLite2 City database")
+    # Update counts
+    checks["total"] = checks.get("total", 0) + count
+    checks["today"] = checks.get("today", 0) + count
+    save("checks_count.json", checks)
 
-    url = "https://download.maxmind.com/app/geoip_download"
-    params = {
-        "edition_id": "GeoLite2-City",
-        "license_key": MAXMIND_LICENSE_KEY,
-        "suffix": "tar.gz",
-    }
+_users_lock = threading.Lock()
 
-    try:
-        r = requests.get(
-            url,
-            params=params,
-            auth=(MAXMIND_ACCOUNT_ID, MAXMIND_LICENSE_KEY),
-            timeout=60,
-        )
-        r.raise_for_status()
+def touch_user(uid, username):
+    """Record a /start in users.json"""
+    with _users_lock:
+        users = load("users.json")
+        users[str(uid)] = {
+            "first_seen": int(time.time()),
+            "username": username,
+            "last_active": int(time.time()),
+            "checks_made": users.get(str(uid), {}).get("checks_made", 0)
+        }
+        save("users.json", users)
 
-        tar_path = f"{DATA_DIR}/geo.tar.gz"
-        with open(tar_path, "wb") as f:
-            f.write(r.content)
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
 
-        with tarfile.open(tar_path, "r:gz") as tar:
-            for m in tar.getmembers():
-                if m.name.endswith("GeoLite2-City.mmdb"):
-                    m.name = os.path.basename(m.name)
-                    tar.extract(m, DATA_DIR)
-                    os.rename(f"{DATA_DIR}/{m.name}", GEO_DB)
+# ================== INDEXED STORE (SQLITE) ==================
 
-        os.remove(tar_path)
-        logging.info("✅ GeoLite2 City database updated successfully")
-        
-    except Exception as e:
-        logging.error(f"❌ Failed to update GeoLite2 database: {e}")
-        if not os.path.exists(GEO_DB):
-            raise
+# Former whole-file JSON stores -> table, key column, value columns
+STORE_TABLES = {
+    "uptime.json": ("uptime", "key", ("success", "total", "first_seen")),
+    "proxies_db.json": ("proxies", "key", (
+        "last_seen", "country", "isp", "latency", "score",
+        "type", "has_auth", "total_checks", "success_rate",
+    )),
+    "user_stats.json": ("user_stats", "uid", ("total_checks", "live_proxies", "files_checked")),
+}
 
-# ================== ENHANCED GEO LOOKUP ==================
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uptime (
+    key TEXT PRIMARY KEY,
+    success INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    first_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS proxies (
+    key TEXT PRIMARY KEY,
+    last_seen TEXT,
+    country TEXT,
+    isp TEXT,
+    latency INTEGER,
+    score REAL,
+    type TEXT,
+    has_auth INTEGER,
+    total_checks INTEGER,
+    success_rate REAL
+);
+CREATE INDEX IF NOT EXISTS idx_proxies_country ON proxies(country);
+CREATE INDEX IF NOT EXISTS idx_proxies_type ON proxies(type);
+CREATE INDEX IF NOT EXISTS idx_proxies_last_seen ON proxies(last_seen);
+CREATE TABLE IF NOT EXISTS user_stats (
+    uid TEXT PRIMARY KEY,
+    total_checks INTEGER NOT NULL DEFAULT 0,
+    live_proxies INTEGER NOT NULL DEFAULT 0,
+    files_checked INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    ptype TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    file_name TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    input_complete INTEGER NOT NULL DEFAULT 0,
+    lines_read INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    invalid INTEGER NOT NULL DEFAULT 0,
+    live INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL NOT NULL DEFAULT 0,
+    fast INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_uid ON jobs(uid);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+CREATE TABLE IF NOT EXISTS dead (
+    key TEXT NOT NULL,
+    ptype TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (key, ptype)
+);
+CREATE INDEX IF NOT EXISTS idx_dead_checked_at ON dead(checked_at);
+CREATE TABLE IF NOT EXISTS job_done (
+    job_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    result TEXT,
+    failed_types TEXT,
+    PRIMARY KEY (job_id, key)
+);
+"""
 
-geo_reader = None
+JOB_UNFINISHED = ("queued", "running")
 
-def geo_lookup(ip):
-    try:
-        r = geo_reader.city(ip)
-        country = r.country.name or "Unknown"
-        city = r.city.name or "Unknown"
-        isp = r.traits.isp or "Unknown"
-        asn = r.traits.autonomous_system_number or "Unknown"
-        aso = r.traits.autonomous_system_organization or "Unknown"
+class Store:
+    """
+    SQLite (WAL mode) backend for the per-proxy and per-user data that used
+    to be rewritten as whole JSON files on every check. Updates are keyed
+    upserts, so a run only touches the rows it checked.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()  # one connection, shared across threads
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(STORE_SCHEMA)
+            self._conn = conn
+            self._migrate_json()
+        return self._conn
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def _migrate_json(self):
+        """One-time import of the old JSON files; they are kept as *.migrated"""
+        for name, (table, key_col, cols) in STORE_TABLES.items():
+            filepath = f"{DATA_DIR}/{name}"
+            if not os.path.exists(filepath):
+                continue
+            try:
+                with open(filepath, "r", encoding="utf-8") as f:
+                    data = json.load(f) if os.path.getsize(filepath) else {}
+            except json.JSONDecodeError as e:
+                logger.error(f"❌ Cannot migrate {name}: {e}")
+                continue
+            if isinstance(data, dict) and data:
+                self.save_table(name, data)
+            os.replace(filepath, f"{filepath}.migrated")
+            logger.info(f"📦 Migrated {len(data)} entries from {name} to {self.path}")
+    
+    def load_table(self, name):
+        """Whole table as the dict the old JSON file held (small tables / admin use)"""
+        table, key_col, cols = STORE_TABLES[name]
+        with self._lock:
+            rows = self.conn.execute(f"SELECT {key_col}, {', '.join(cols)} FROM {table}").fetchall()
+        return {row[0]: dict(zip(cols, row[1:])) for row in rows}
+    
+    def save_table(self, name, data):
+        """Upsert every entry of a dict shaped like the old JSON file"""
+        table, key_col, cols = STORE_TABLES[name]
+        rows = [
+            (str(key), *(value.get(col) for col in cols))
+            for key, value in data.items() if isinstance(value, dict)
+        ]
+        self._upsert(table, key_col, cols, rows)
+    
+    def _upsert(self, table, key_col, cols, rows):
+        placeholders = ", ".join("?" * (len(cols) + 1))
+        updates = ", ".join(f"{col}=excluded.{col}" for col in cols)
+        sql = (
+            f"INSERT INTO {table} ({key_col}, {', '.join(cols)}) VALUES ({placeholders}) "
+            f"ON CONFLICT({key_col}) DO UPDATE SET {updates}"
+        )
+        with self._lock, self.conn:
+            self.conn.executemany(sql, rows)
+    
+    def bump_uptime(self, keys):
+        """Count one more successful check for each key; returns {key: (success, total)}"""
+        keys = list(keys)
+        now = datetime.now().isoformat()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO uptime (key, success, total, first_seen) VALUES (?, 1, 1, ?) "
+                "ON CONFLICT(key) DO UPDATE SET success=success+1, total=total+1",
+                [(key, now) for key in keys],
+            )
+            return self._uptime_of(keys)
+    
+    def _uptime_of(self, keys):
+        counts = {}
+        for i in range(0, len(keys), 500):  # stay under SQLite's variable limit
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, success, total FROM uptime WHERE key IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            counts.update({key: (success, total) for key, success, total in rows})
+        return counts
+    
+    def upsert_proxies(self, entries):
+        """entries: {proxy key: proxies_db-style dict}"""
+        self.save_table("proxies_db.json", entries)
+    
+    def get_user_stats(self, uid):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT total_checks, live_proxies, files_checked FROM user_stats WHERE uid=?",
+                (str(uid),),
+            ).fetchone()
+        if row is None:
+            return {"total_checks": 0, "live_proxies": 0, "files_checked": 0}
+        return dict(zip(("total_checks", "live_proxies", "files_checked"), row))
+    
+    def add_user_stats(self, uid, total_checks=0, live_proxies=0, files_checked=0):
+        """Atomically increment a user's counters"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO user_stats (uid, total_checks, live_proxies, files_checked) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET "
+                "total_checks=total_checks+excluded.total_checks, "
+                "live_proxies=live_proxies+excluded.live_proxies, "
+                "files_checked=files_checked+excluded.files_checked",
+                (str(uid), total_checks, live_proxies, files_checked),
+            )
+    
+    # --- fast mode caches ---
+    
+    def cached_check(self, key, ptype, ttl=FAST_MODE_TTL, dead_ttl=DEAD_CACHE_TTL):
+        """
+        ("live", proxies row) if the proxy was verified alive within ttl in a
+        matching mode, ("dead", None) if found dead within dead_ttl, else None.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM dead WHERE key=? AND checked_at>=? AND (ptype=? OR ptype IN ('auto', 'all'))",
+                (key, time.time() - dead_ttl, ptype),
+            ).fetchone()
+            if row:
+                return "dead", None
+            cur = self.conn.execute("SELECT * FROM proxies WHERE key=?", (key,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            row = dict(zip([d[0] for d in cur.description], row))
         
-        return {
-            "country": country,
-            "city": city,
-            "isp": isp,
-            "asn": asn,
-            "aso": aso
-        }
-    except Exception as e:
-        logger.error(f"Geo lookup failed for {ip}: {e}")
-        return {
-            "country": "Unknown",
-            "city": "Unknown",
-            "isp": "Unknown",
-            "asn": "Unknown",
-            "aso": "Unknown"
-        }
+        try:
+            age = (datetime.now() - datetime.fromisoformat(row["last_seen"])).total_seconds()
+        except (TypeError, ValueError):
+            return None
+        if age > ttl or (ptype not in ("auto", "all") and row["type"] != ptype):
+            return None
+        return "live", row
+    
+    def mark_dead(self, key, ptype):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead (key, ptype, checked_at) VALUES (?, ?, ?)",
+                (key, ptype, time.time()),
+            )
+    
+    def clear_dead(self, key):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM dead WHERE key=?", (key,))
+    
+    def prune_dead(self, ttl=DEAD_CACHE_TTL):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM dead WHERE checked_at<?", (time.time() - ttl,))
+    
+    # --- persistent check jobs ---
+    
+    def _job_rows(self, sql, params=()):
+        with self._lock:
+            cur = self.conn.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+    
+    def create_job(self, uid, chat_id, ptype, file_id, file_name=None, fast=False):
+        now = datetime.now().isoformat()
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO jobs (uid, chat_id, ptype, file_id, file_name, fast, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (uid, chat_id, ptype, file_id, file_name, int(fast), now, now),
+            )
+            return cur.lastrowid
+    
+    def update_job(self, job_id, **fields):
+        fields["updated"] = datetime.now().isoformat()
+        sets = ", ".join(f"{col}=?" for col in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {sets} WHERE id=?", (*fields.values(), job_id))
+    
+    def get_job(self, job_id):
+        rows = self._job_rows("SELECT * FROM jobs WHERE id=?", (job_id,))
+        return rows[0] if rows else None
+    
+    def list_jobs(self, uid=None, limit=10):
+        """Newest first, with how many endpoints are already checked"""
+        sql = (
+            "SELECT jobs.*, (SELECT COUNT(*) FROM job_done WHERE job_id=jobs.id) AS checked FROM jobs "
+            + ("WHERE uid=? " if uid is not None else "")
+            + "ORDER BY id DESC LIMIT ?"
+        )
+        return self._job_rows(sql, ((uid, limit) if uid is not None else (limit,)))
+    
+    def unfinished_jobs(self):
+        return self._job_rows(
+            f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(JOB_UNFINISHED))}) ORDER BY id",
+            JOB_UNFINISHED,
+        )
+    
+    def record_job_result(self, job_id, key, result):
+        """
+        Done log: the endpoint is never checked again for this job. A dead
+        endpoint has a NULL result; failed_types keeps the protocols its dead
+        record tried (empty if none answered, NULL if it was never checked).
+        """
+        live = bool(result and result["live"])
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO job_done (job_id, key, result, failed_types) VALUES (?, ?, ?, ?)",
+                (
+                    job_id, key,
+                    json.dumps(result, ensure_ascii=False) if live else None,
+                    " ".join(result["failed_types"]) if result and not live else None,
+                ),
+            )
+    
+    def job_done_keys(self, job_id):
+        """{key: was live} of everything checked so far"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT key, result IS NOT NULL FROM job_done WHERE job_id=?", (job_id,)
+            ).fetchall()
+        return {key: bool(live) for key, live in rows}
+    
+    def job_results_page(self, job_id, after=0, limit=1000):
+        """Live results of a job in rowid order: ([result, ...], last rowid)"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT rowid, result FROM job_done WHERE job_id=? AND rowid>? AND result IS NOT NULL "
+                "ORDER BY rowid LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [json.loads(result) for _, result in rows], (rows[-1][0] if rows else after)
+    
+    def job_dead_types(self, job_id):
+        """{protocol: dead endpoints that failed it} of a job, "" counting the ones that answered none"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT failed_types FROM job_done WHERE job_id=? AND result IS NULL AND failed_types IS NOT NULL",
+                (job_id,),
+            ).fetchall()
+        counts = defaultdict(int)
+        for (failed,) in rows:
+            for ptype in failed.split() or [""]:
+                counts[ptype] += 1
+        return dict(counts)
+    
+    def clear_job_done(self, job_id):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM job_done WHERE job_id=?", (job_id,))
+
+store = Store(DB_PATH)
 
 # ================== FORCE JOIN WITH CACHE ==================
 
@@ -365,171 +698,510 @@ class ChannelChecker:
 
 channel_checker = ChannelChecker()
 
-# ================== ENHANCED SMART SCORE ==================
+# ================== STREAMING INGESTION ==================
 
-def smart_score(latency, uptime, success_rate=100, proxy_type="http"):
+async def iter_document_batches(file):
     """
-    Enhanced scoring algorithm:
-    - Base score: 100 - latency penalty
-    - Uptime bonus: increases with consistency
-    - Success rate bonus
-    - Proxy type multiplier
+    Yield the lines of an uploaded Telegram file, one list per downloaded chunk,
+    while it is still downloading, so checking can start on the first lines
+    of a huge list.
     """
-    # Latency penalty (more aggressive for high latency)
-    latency_penalty = min(latency / 5, 60)
+    if not (file.file_path or "").startswith(("http://", "https://")):
+        # Local Bot API server: the file is already on disk, nothing to stream
+        content = await file.download_as_bytearray()
+        yield content.decode("utf-8", errors="replace").splitlines()
+        return
     
-    # Uptime bonus (logarithmic growth)
-    uptime_bonus = min(uptime * 8, 30)
+    session = await proxy_checker.get_session()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
     
-    # Success rate bonus
-    success_bonus = success_rate * 0.2
-    
-    # Proxy type multiplier
-    type_multiplier = {
-        "socks5": 1.2,
-        "socks4": 1.1,
-        "https": 1.15,
-        "http": 1.0
-    }.get(proxy_type, 1.0)
+    # The URL holds BOT_TOKEN: verify api.telegram.org even on the check session
+    async with session.get(
+        file.file_path,
+        ssl=VERIFIED_SSL,
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+    ) as r:
+        r.raise_for_status()
+        async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            lines = (tail + decoder.decode(chunk)).split("\n")
+            tail = lines.pop()  # may be cut mid-line, finish it with the next chunk
+            yield lines
     
-    base_score = (100 - latency_penalty + uptime_bonus + success_bonus)
-    return round(base_score * type_multiplier, 2)
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield [tail]
 
-# ================== ENHANCED PROXY CHECKER ==================
+# ================== FAIR CHECK SCHEDULER ==================
 
-class ProxyChecker:
-    def __init__(self):
-        self.test_urls = [
-            "http://httpbin.org/ip",
-            "http://api.ipify.org?format=json",
-            "http://ip-api.com/json/"
-        ]
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        }
+class _UserLane:
+    __slots__ = ("waiters", "running", "pass_", "weight", "cap")
+    
+    def __init__(self, pass_, weight, cap):
+        self.waiters = deque()  # futures of workers waiting for a slot
+        self.running = 0
+        self.pass_ = pass_  # stride scheduling virtual time
+        self.weight = weight
+        self.cap = cap
+
+class CheckScheduler:
+    """
+    Global budget of in-flight checks shared by every running file.
+    Free slots go to the user with the lowest virtual time (stride scheduling),
+    each grant advances it by 1/weight, so busy users share the budget by weight
+    and a user with 100k lines can't starve one with 100.
+    """
+    
+    def __init__(self, budget=GLOBAL_CHECK_BUDGET):
+        self.budget = budget
+        self.in_flight = 0
+        self.vtime = 0.0
+        self._lanes = {}
+    
+    @staticmethod
+    def user_cap(uid):
+        """Checks one user may have in flight; read live so /workers moves it"""
+        if uid == OWNER_ID:
+            return max(1, OWNER_CHECK_CAP)
+        return max(1, USER_CHECK_CAP or MAX_CONCURRENCY)
+    
+    def _lane(self, uid):
+        lane = self._lanes.get(uid)
+        if lane is None:
+            weight = OWNER_WEIGHT if uid == OWNER_ID else USER_WEIGHT
+            # New users start at the current virtual time, no credit for idling
+            lane = self._lanes[uid] = _UserLane(self.vtime, weight, self.user_cap(uid))
+        return lane
+    
+    def refresh_caps(self):
+        """Apply a changed cap to the users already checking"""
+        for uid, lane in self._lanes.items():
+            lane.cap = self.user_cap(uid)
+        self._dispatch()
     
-    async def test_proxy(self, proxy_url, proxy_type):
-        """Test a proxy with given type and URL"""
+    async def acquire(self, uid):
+        lane = self._lane(uid)
+        fut = asyncio.get_running_loop().create_future()
+        lane.waiters.append(fut)
+        self._dispatch()
         try:
-            async with aiohttp.ClientSession(timeout=TIMEOUT, headers=self.headers) as session:
-                async with session.get(
-                    "http://httpbin.org/ip",
-                    proxy=proxy_url,
-                    ssl=False,
-                ) as r:
-                    if r.status == 200:
-                        data = await r.json()
-                        if "origin" in data:
-                            return True
-        except Exception as e:
-            logger.debug(f"Proxy test failed: {e}")
-        return False
-    
-    async def check_proxy_with_type(self, proxy_str, proxy_type):
-        """Check proxy with specific protocol type"""
-        start = time.time()
-        
-        # Parse proxy
-        proxy_info = ProxyParser.parse_proxy(proxy_str)
-        if not proxy_info:
-            return None
-        
-        ip = proxy_info['ip']
-        
-        # Format proxy URL based on type
-        if proxy_info['user'] and proxy_info['password']:
-            if proxy_type in ["socks4", "socks5"]:
-                proxy_url = f"{proxy_type}://{proxy_info['user']}:{proxy_info['password']}@{proxy_info['ip']}:{proxy_info['port']}"
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(uid)  # granted just as we were cancelled
             else:
-                proxy_url = f"{proxy_type}://{proxy_info['user']}:{proxy_info['password']}@{proxy_info['ip']}:{proxy_info['port']}"
-        else:
-            proxy_url = f"{proxy_type}://{proxy_info['ip']}:{proxy_info['port']}"
-        
-        successful_tests = 0
-        total_tests = len(self.test_urls)
-        
+                try:
+                    lane.waiters.remove(fut)
+                except ValueError:
+                    pass
+                self._forget(uid)
+            raise
+    
+    def release(self, uid):
+        lane = self._lanes[uid]
+        lane.running -= 1
+        self.in_flight -= 1
+        self._forget(uid)
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, uid):
+        await self.acquire(uid)
         try:
-            async with aiohttp.ClientSession(timeout=TIMEOUT, headers=self.headers) as session:
-                for test_url in self.test_urls:
-                    try:
-                        async with session.get(
-                            test_url,
-                            proxy=proxy_url,
-                            ssl=False,
-                        ) as r:
-                            if r.status == 200:
-                                successful_tests += 1
-                    except:
-                        continue
-                
-                if successful_tests > 0:
-                    latency = int((time.time() - start) * 1000)
-                    geo_info = geo_lookup(ip)
-                    
-                    # Calculate success rate
-                    success_rate = (successful_tests / total_tests) * 100
-                    
-                    result = {
-                        "proxy": ProxyParser.normalize_proxy(proxy_info),
-                        "original": proxy_str,
-                        "latency": latency,
-                        "country": geo_info["country"],
-                        "city": geo_info["city"],
-                        "isp": geo_info["isp"],
-                        "asn": geo_info["asn"],
-                        "aso": geo_info["aso"],
-                        "success_rate": success_rate,
-                        "checks_passed": successful_tests,
-                        "total_checks": total_tests,
-                        "type": proxy_type,
-                        "has_auth": proxy_info['user'] is not None,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    return result
-        except Exception as e:
-            logger.debug(f"Proxy {proxy_str} failed with {proxy_type}: {e}")
-        
-        return None
+            yield
+        finally:
+            self.release(uid)
     
-    async def auto_check_proxy(self, proxy_str):
-        """
-        Automatically detect and check proxy with all protocols
-        Returns the best working result
-        """
-        proxy_types = ["socks5", "socks4", "http", "https"]
-        results = []
-        
-        # Try all protocols in parallel
-        tasks = []
-        for ptype in proxy_types:
-            task = asyncio.create_task(self.check_proxy_with_type(proxy_str, ptype))
-            tasks.append(task)
-        
-        # Wait for first successful result
-        for task in asyncio.as_completed(tasks):
-            result = await task
-            if result:
-                return result
-        
-        return None
+    def _forget(self, uid):
+        lane = self._lanes.get(uid)
+        if lane and not lane.running and not lane.waiters:
+            del self._lanes[uid]
     
-    async def check_all_types(self, proxy_str):
-        """Check proxy with all types and return all working results"""
-        proxy_types = ["socks5", "socks4", "http", "https"]
-        results = []
-        
-        tasks = [self.check_proxy_with_type(proxy_str, ptype) for ptype in proxy_types]
-        proxy_results = await asyncio.gather(*tasks)
-        
-        for result in proxy_results:
-            if result:
-                results.append(result)
+    def _dispatch(self):
+        while self.in_flight < self.budget:
+            eligible = [
+                lane for lane in self._lanes.values()
+                if lane.waiters and lane.running < lane.cap
+            ]
+            if not eligible:
+                return
+            lane = min(eligible, key=lambda l: l.pass_)
+            fut = lane.waiters.popleft()
+            if fut.done():
+                continue  # waiter was cancelled
+            self.vtime = lane.pass_
+            lane.pass_ += 1 / lane.weight
+            lane.running += 1
+            self.in_flight += 1
+            fut.set_result(None)
+    
+    def depths(self):
+        """{uid: (running, waiting)} for every user with work in the scheduler"""
+        return {uid: (lane.running, len(lane.waiters)) for uid, lane in self._lanes.items()}
+
+check_scheduler = CheckScheduler()
+
+# ================== PROGRESS REPORTER ==================
+
+class ProgressReporter:
+    """
+    Edits the progress message on a timer from its own task.
+    Workers only bump counters; snapshot() is read every PROGRESS_INTERVAL,
+    unchanged text is not sent and RetryAfter pauses the edits.
+    """
+    
+    def __init__(self, message, snapshot, interval=PROGRESS_INTERVAL, window=PROGRESS_WINDOW):
+        self.message = message
+        self.snapshot = snapshot  # () -> (checked, total, live, reading)
+        self.interval = interval
+        self.window = window
+        self.samples = deque()  # (time, checked)
+        self._last_text = None
+        self._paused_until = 0
+        self._task = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def rate(self, now, checked):
+        """Checks per second over the last PROGRESS_WINDOW seconds"""
+        self.samples.append((now, checked))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        t0, c0 = self.samples[0]
+        return (checked - c0) / (now - t0) if now > t0 else 0.0
+    
+    def render(self, checked, total, live, rate, reading):
+        cpm = int(rate * 60)
+        remaining = max(total - checked, 0)
+        eta = f"{int(remaining / rate)}s" if rate > 0 else "..."
+        if reading:
+            eta += "+"  # more lines may still arrive
+        
+        progress_percent = int((checked / total) * 100) if total else 0
+        progress_bar = "🟢" * min(progress_percent // 5, 20)
+        progress_bar += "⚪" * (20 - min(progress_percent // 5, 20))
+        total_text = f"{total}+ (reading)" if reading else f"{total}"
+        
+        return (
+            f"🔍 *Checking Proxies*\n\n"
+            f"📊 Progress: {checked}/{total_text} ({progress_percent}%)\n"
+            f"{progress_bar}\n\n"
+            f"⚡ Speed: {cpm} CPM\n"
+            f"⏱️ ETA: {eta}\n"
+            f"✅ Live: {live}\n"
+            f"❌ Dead: {checked - live}"
+        )
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            checked, total, live, reading = self.snapshot()
+            text = self.render(checked, total, live, self.rate(now, checked), reading)
+            if text == self._last_text or now < self._paused_until:
+                continue
+            
+            try:
+                await self.message.edit_text(text, parse_mode="Markdown")
+                self._last_text = text
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+                self._paused_until = loop.time() + delay
+                logger.warning(f"⏳ Progress edits flood-limited, pausing {delay}s")
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self._last_text = text
+                else:
+                    logger.debug(f"Progress edit failed: {e}")
+            except TelegramError as e:
+                logger.debug(f"Progress edit failed: {e}")
+
+# ================== PERSISTENT JOBS ==================
+
+active_jobs = {}  # job id -> running task
+cancelled_jobs = set()  # ids stopped by /cancel (a bot restart cancels tasks too, but resumes them)
+
+def job_snapshot_path(job_id):
+    return f"{JOBS_DIR}/{job_id}.txt"
+
+def finish_job(job_id, status, **fields):
+    """Final state: the done log, input snapshot and result spool are no longer needed"""
+    store.update_job(job_id, status=status, **fields)
+    store.clear_job_done(job_id)
+    spool = ResultSpool(job_id)
+    for path in (job_snapshot_path(job_id), spool.spool_path, spool.live_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def iter_snapshot_batches(path):
+    """Lines of a local input snapshot, one list per chunk, read on the I/O pool"""
+    f = await run_io(open, path, "r", encoding="utf-8", errors="replace", newline="")
+    tail = ""
+    try:
+        while True:
+            chunk = await run_io(f.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (tail + chunk).split("\n")
+            tail = lines.pop()
+            yield lines
+    finally:
+        await run_io(f.close)
+    if tail:
+        yield [tail]
+
+async def iter_job_batches(bot, job):
+    """
+    Input lines of a job. The first run streams the Telegram file and keeps
+    a snapshot on disk; once that is complete a resume reads the snapshot,
+    otherwise the file is fetched again by its file_id.
+    """
+    path = job_snapshot_path(job["id"])
+    if job["input_complete"] and await run_io(os.path.exists, path):
+        async for batch in iter_snapshot_batches(path):
+            yield batch
+        return
+    
+    file = await bot.get_file(job["file_id"])
+    await run_io(os.makedirs, JOBS_DIR, exist_ok=True)
+    snapshot = await run_io(open, path, "w", encoding="utf-8")
+    try:
+        async for batch in iter_document_batches(file):
+            await run_io(snapshot.write, "".join(f"{line}\n" for line in batch))
+            yield batch
+    finally:
+        await run_io(snapshot.close)
+    await run_io(store.update_job, job["id"], input_complete=1)
+    job["input_complete"] = 1
+
+def start_job(bot, job_id):
+    task = asyncio.create_task(run_check_job(bot, job_id))
+    active_jobs[job_id] = task
+    task.add_done_callback(lambda t: active_jobs.pop(job_id, None))
+    return task
+
+async def resume_jobs(bot):
+    """Requeue every job a restart interrupted"""
+    jobs = await run_io(store.unfinished_jobs)
+    for job in jobs:
+        start_job(bot, job["id"])
+    if jobs:
+        logger.info(f"♻️ Resumed {len(jobs)} unfinished job(s)")
+
+async def stop_jobs():
+    """Cancel running jobs on shutdown; they stay unfinished and resume next start"""
+    tasks = list(active_jobs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ================== RESULT SPOOL ==================
+
+def score_live_result(result):
+    """Bump uptime for a freshly checked live result, score it and upsert its proxies row"""
+    proxy_key = result["proxy"]
+    success_count, total_count = store.bump_uptime([proxy_key]).get(proxy_key, (1, 1))
+    success_rate_proxy = (success_count / total_count * 100) if total_count > 0 else 0
+    
+    result["score"] = smart_score(
+        result["latency"],
+        success_count,
+        success_rate_proxy,
+        result["type"],
+        result.get("timings")
+    )
+    
+    # Store in database with defaults
+    store.upsert_proxies({proxy_key: {
+        "last_seen": datetime.now().isoformat(),
+        "country": result.get("country", "Unknown"),
+        "isp": result.get("isp", "Unknown"),
+        "latency": result.get("latency", 0),
+        "score": result.get("score", 0),
+        "type": result.get("type", "unknown"),
+        "has_auth": result.get("has_auth", False),
+        "total_checks": total_count,
+        "success_rate": success_rate_proxy
+    }})
+
+def record_check(job_id, key, result, ptype):
+    """
+    Blocking part of finishing one check, run on the I/O pool. A fresh live
+    result bumps its uptime, gets its score and proxies row; a dead one feeds
+    the negative cache. Cached fast-mode answers only go to the done log, so
+    they never extend their own freshness. Returns the result if it is live.
+    """
+    live = bool(result and result["live"])
+    if live and not result.get("cached"):
+        score_live_result(result)
+        store.clear_dead(key)
+    elif not live:
+        store.mark_dead(key, ptype)
+    
+    store.record_job_result(job_id, key, result)
+    return result if live else None
+
+def _append_text(path, data):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(data)
+
+def _truncate(path):
+    open(path, "w").close()
+
+class BufferedAppender:
+    """Append-only text file; lines are buffered and written in batches on the I/O pool"""
+    
+    def __init__(self, path, flush_lines=SPOOL_FLUSH_LINES):
+        self.path = path
+        self.flush_lines = flush_lines
+        self._buf = []
+        self._lock = asyncio.Lock()  # batches land in order
+    
+    async def write(self, line):
+        self._buf.append(line)
+        if len(self._buf) >= self.flush_lines:
+            await self.flush()
+    
+    async def flush(self):
+        async with self._lock:
+            if self._buf:
+                data, self._buf = "".join(self._buf), []
+                await run_io(_append_text, self.path, data)
+
+class ResultSpool:
+    """
+    Live results of one job, appended to disk as they arrive instead of held
+    in a list: a JSON-lines spool for the final sorted report and a plain
+    live list for partial downloads. Only the summary counters stay in memory.
+    """
+    
+    def __init__(self, job_id):
+        self.spool_path = f"{JOBS_DIR}/{job_id}.spool.jsonl"
+        self.live_path = f"{JOBS_DIR}/{job_id}.live.txt"
+        self._spool = BufferedAppender(self.spool_path)
+        self._live = BufferedAppender(self.live_path)
+        self.live = 0
+        self.type_stats = defaultdict(int)
+        self.country_stats = defaultdict(int)
+        self.auth_stats = {"with_auth": 0, "without_auth": 0}
+    
+    async def reset(self):
+        """Start empty; a resume refills the spool from the done log"""
+        await run_io(os.makedirs, JOBS_DIR, exist_ok=True)
+        for path in (self.spool_path, self.live_path):
+            await run_io(_truncate, path)
+    
+    async def add(self, r):
+        self.live += 1
+        self.type_stats[r.get("type", "unknown")] += 1
+        self.country_stats[r.get("country", "Unknown")] += 1
+        if r.get("has_auth", False):
+            self.auth_stats["with_auth"] += 1
+        else:
+            self.auth_stats["without_auth"] += 1
         
-        # Sort by latency (fastest first)
-        results.sort(key=lambda x: x["latency"])
-        return results
+        await self._spool.write(json.dumps(r, ensure_ascii=False) + "\n")
+        await self._live.write(f"{r.get('type', 'http')}://{r['proxy']}\n")
+    
+    async def flush(self):
+        await self._spool.flush()
+        await self._live.flush()
+    
+    async def copy_live(self, path):
+        """Copy of the live list so far, taken between two appended batches"""
+        await self._live.flush()
+        async with self._live._lock:
+            await run_io(shutil.copyfile, self.live_path, path)
+
+def iter_sorted_spool(path, run_size=SORT_RUN_SIZE):
+    """
+    External merge sort of a JSON-lines spool by score, best first: sorted
+    runs of run_size records go to temp files, then a k-way heapq.merge
+    streams them back. Memory is bounded by run_size, not by the result count.
+    """
+    by_score = lambda r: -r.get("score", 0)
+    runs = []
+    try:
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                while True:
+                    chunk = list(itertools.islice(f, run_size))
+                    if not chunk:
+                        break
+                    records = sorted((json.loads(line) for line in chunk), key=by_score)
+                    run_path = f"{path}.run{len(runs)}"
+                    with open(run_path, "w", encoding="utf-8") as out:
+                        out.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+                    runs.append(run_path)
+        
+        files = [open(p, encoding="utf-8") for p in runs]
+        try:
+            yield from heapq.merge(*(map(json.loads, f) for f in files), key=by_score)
+        finally:
+            for f in files:
+                f.close()
+    finally:
+        for p in runs:
+            os.remove(p)
+
+def split_for_upload(path, limit=MAX_UPLOAD_BYTES):
+    """Byte ranges of at most limit bytes, cut on line boundaries"""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while size - start > limit:
+            window = min(limit, 64 * 1024)
+            f.seek(start + limit - window)
+            cut = f.read(window).rfind(b"\n")
+            end = start + limit - window + cut + 1 if cut >= 0 else start + limit
+            ranges.append((start, end))
+            start = end
+    ranges.append((start, size))
+    return ranges
+
+def read_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
 
-proxy_checker = ProxyChecker()
+async def send_report(bot, chat_id, path, filename, caption):
+    """Send a file as one document, or in numbered parts when over MAX_UPLOAD_BYTES"""
+    ranges = await run_io(split_for_upload, path)
+    if len(ranges) == 1:
+        return await bot.send_document(
+            chat_id,
+            document=await run_io(read_file_bytes, path),
+            filename=filename,
+            caption=caption
+        )
+    
+    stem, ext = os.path.splitext(filename)
+    for n, (start, end) in enumerate(ranges, 1):
+        await bot.send_document(
+            chat_id,
+            document=await run_io(read_file_range, path, start, end),
+            filename=f"{stem}_part{n}of{len(ranges)}{ext}",
+            caption=f"{caption} - part {n}/{len(ranges)}"
+        )
+
+# Spools of running jobs, for /partial
+active_spools = {}
 
 # ================== ENHANCED HANDLERS ==================
 
@@ -554,14 +1226,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     # Update user stats
-    users = load("users.json")
-    users[str(uid)] = {
-        "first_seen": int(time.time()),
-        "username": username,
-        "last_active": int(time.time()),
-        "checks_made": users.get(str(uid), {}).get("checks_made", 0)
-    }
-    save("users.json", users)
+    await run_io(touch_user, uid, username)
 
     await update.message.reply_text(
         "🚀 *ULTIMATE PROXY CHECKER*\n\n"
@@ -578,6 +1243,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📊 *Commands:*\n"
         "• /check - Start checking proxies\n"
         "• /stats - Your statistics\n"
+        "• /jobs - Your running checks (they survive restarts)\n"
         "• /help - Show help message",
         parse_mode="Markdown"
     )
@@ -688,238 +1354,270 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     try:
-        # Download file
-        file = await update.message.document.get_file()
-        content = (await file.download_as_bytearray()).decode().splitlines()
-        
-        # Parse and clean proxies
-        raw_proxies = []
-        parsed_proxies = []
+        document = update.message.document
+        job_id = await run_io(
+            store.create_job, uid, update.effective_chat.id, ptype, document.file_id, document.file_name,
+            fast=context.user_data.get("fastmode", False)
+        )
         
-        for line in content:
-            line = line.strip()
-            if line and not line.startswith("#") and not line.startswith("//"):
-                # Try to parse the proxy
-                proxy_info = ProxyParser.parse_proxy(line)
-                if proxy_info:
-                    raw_proxies.append(line)
-                    parsed_proxies.append(proxy_info)
-                elif ':' in line:  # Basic validation
-                    raw_proxies.append(line)
+        logger.info(f"User {username} ({uid}) queued job #{job_id} in {ptype} mode")
         
-        if not raw_proxies:
-            return await update.message.reply_text(
-                "❌ No valid proxies found in file.\n"
-                "Supported formats:\n"
-                "• ip:port\n• user:pass@ip:port\n• ip:port:user:pass"
-            )
+        # Update user stats
+        await run_io(store.add_user_stats, uid, files_checked=1)
         
-        logger.info(f"User {username} ({uid}) checking {len(raw_proxies)} proxies in {ptype} mode")
+        # The check runs in the background, the handler returns right away
+        start_job(context.bot, job_id)
         
-        # Create progress message
-        progress_msg = await update.message.reply_text(
-            f"⏳ *Initializing Check*\n\n"
-            f"📊 Total: {len(raw_proxies)} proxies\n"
-            f"🔧 Mode: {ptype.upper()}\n"
+    except Exception as e:
+        logger.error(f"Error in handle_file: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(
+                f"❌ *Error Processing File*\n\n"
+                f"```\n{str(e)[:500]}\n```",
+                parse_mode="Markdown"
+            )
+        except:
+            pass
+
+async def run_check_job(bot, job_id):
+    """Run (or resume) a persisted check job and send the results to its chat"""
+    job = await run_io(store.get_job, job_id)
+    uid, chat_id, ptype = job["uid"], job["chat_id"], job["ptype"]
+    progress_msg = None
+    start_time = time.time() - job["elapsed"]  # time spent before a restart counts too
+    # Deadlines adapt to this file's proxies; the worker tasks inherit the context
+    timeouts = TimeoutPolicy()
+    current_timeouts.set(timeouts)
+    
+    try:
+        # Everything in the done log is skipped, nothing is checked twice
+        done = await run_io(store.job_done_keys, job_id)
+        resumed = job["status"] == "running"
+        await run_io(store.update_job, job_id, status="running")
+        
+        # Create progress message (the total is only known once the file is read)
+        progress_msg = await bot.send_message(
+            chat_id,
+            (f"♻️ *Resuming Check #{job_id}*\n\n" if resumed else f"⏳ *Initializing Check #{job_id}*\n\n")
+            + f"🔧 Mode: {ptype.upper()}{' ⚡ fast' if job['fast'] else ''}\n"
             f"📝 Format: Mixed/Auto\n"
-            f"⏱️ Preparing...",
+            + (f"✅ Already checked: {len(done)}\n" if resumed else "")
+            + f"⏱️ Reading file, checks start right away...\n"
+            f"📥 /partial {job_id} for live proxies so far\n"
+            f"🛑 /cancel {job_id} to stop",
             parse_mode="Markdown"
         )
         
-        # Update user stats - FIXED: Use get with defaults
-        user_stats = load("user_stats.json")
-        if str(uid) not in user_stats:
-            user_stats[str(uid)] = {"total_checks": 0, "live_proxies": 0, "files_checked": 0}
-        user_stats[str(uid)]["files_checked"] = user_stats[str(uid)].get("files_checked", 0) + 1
-        save("user_stats.json", user_stats)
+        # Live results go straight to disk; a resume refills the spool from the done log
+        spool = ResultSpool(job_id)
+        await spool.reset()
+        after = 0
+        while True:
+            page, after = await run_io(store.job_results_page, job_id, after)
+            if not page:
+                break
+            for r in page:
+                await spool.add(r)
+        active_spools[job_id] = spool
         
         # Check proxies based on mode
-        results = []
         checked = 0
-        start_time = time.time()
-        
-        sem = asyncio.Semaphore(MAX_CONCURRENCY)
-        
-        async def runner(proxy_str):
-            nonlocal checked, results
-            async with sem:
-                try:
-                    if ptype == "auto":
-                        # Auto mode: try all protocols, return first working one
-                        result = await proxy_checker.auto_check_proxy(proxy_str)
-                        if result:
-                            results.append(result)
-                    
-                    elif ptype == "all":
-                        # All types mode: test all, return fastest
-                        type_results = await proxy_checker.check_all_types(proxy_str)
-                        if type_results:
-                            # Take the fastest (first in sorted list)
-                            results.append(type_results[0])
-                    
-                    else:
-                        # Specific type mode
-                        result = await proxy_checker.check_proxy_with_type(proxy_str, ptype)
-                        if result:
-                            results.append(result)
-                    
-                except Exception as e:
-                    logger.error(f"Error checking proxy {proxy_str}: {e}")
+        total = 0  # unique endpoints queued so far, final once reading is done
+        lines_read = 0  # proxy-looking lines, duplicates and unparseable included
+        invalid = 0
+        duplicates = defaultdict(list)  # canonical key -> extra lines for the same endpoint
+        reading = True
+        fast = bool(job["fast"])
+        cache_hits = 0  # fast mode: answered from the store after a port probe
+        dead_skipped = 0  # fast mode: skipped through the negative cache
+        if fast:
+            await run_io(store.prune_dead)
+        
+        async def producer():
+            """Parse, dedupe and queue lines while the document is still downloading"""
+            nonlocal total, lines_read, invalid, reading, checked
+            seen = set()
+            try:
+                async for batch in iter_job_batches(bot, job):
+                    for line, proxy_info in ProxyParser.parse_many(batch):
+                        if not proxy_info:
+                            # Looks like host:port but can never be checked: dead, no work
+                            if ':' in line:
+                                lines_read += 1
+                                invalid += 1
+                            continue
+                        lines_read += 1
+                        
+                        # Every format of the same endpoint is checked only once
+                        key = ProxyParser.canonical_key(proxy_info)
+                        if key in seen:
+                            duplicates[key].append(line)
+                            continue
+                        seen.add(key)
+                        total += 1
+                        if key in done:
+                            # Checked before the restart, live ones are already spooled
+                            checked += 1
+                            continue
+                        await pool.put((key, line))
+                await run_io(store.update_job, job_id, lines_read=lines_read, total=total, invalid=invalid)
+            finally:
+                reading = False
+        
+        async def runner(item):
+            nonlocal checked, cache_hits, dead_skipped
+            key, proxy_str = item
+            result = hit = None
+            try:
+                if fast:
+                    hit = await run_io(store.cached_check, key, ptype)
+                    if hit and hit[0] == "dead":
+                        # Found dead recently: no check, and the dead mark is not refreshed
+                        dead_skipped += 1
+                        await run_io(store.record_job_result, job_id, key, None)
+                        checked += 1
+                        return
                 
-                checked += 1
+                # The revalidation probe opens a connection too, so it shares the fair budget
+                async with check_scheduler.slot(uid):
+                    if hit:
+                        result = await proxy_checker.cached_result(proxy_str, hit[1])
+                        cache_hits += result is not None
+                    if result is None:
+                        try:
+                            if engine.running:
+                                result = await engine.check(job_id, key, proxy_str, ptype)
+                            else:
+                                result = await proxy_checker.check(proxy_str, ptype)
+                        except ConnectionError:
+                            # Its engine shard died mid-check: check it here rather than call it dead
+                            result = await proxy_checker.check(proxy_str, ptype)
                 
-                # Update progress every 10% or 50 proxies
-                if checked % max(len(raw_proxies) // 10, 1) == 0 or checked == len(raw_proxies):
-                    elapsed = max(time.time() - start_time, 0.1)
-                    cpm = int((checked / elapsed) * 60)
-                    eta = int(((len(raw_proxies) - checked) / checked) * elapsed) if checked > 0 else 0
-                    
-                    progress_percent = int((checked / len(raw_proxies)) * 100)
-                    progress_bar = "🟢" * min(progress_percent // 5, 20)
-                    progress_bar += "⚪" * (20 - min(progress_percent // 5, 20))
-                    
-                    try:
-                        await progress_msg.edit_text(
-                            f"🔍 *Checking Proxies*\n\n"
-                            f"📊 Progress: {checked}/{len(raw_proxies)} ({progress_percent}%)\n"
-                            f"{progress_bar}\n\n"
-                            f"⚡ Speed: {cpm} CPM\n"
-                            f"⏱️ ETA: {eta}s\n"
-                            f"✅ Live: {len(results)}\n"
-                            f"❌ Dead: {checked - len(results)}",
-                            parse_mode="Markdown"
-                        )
-                    except:
-                        pass
+                if result:
+                    result["key"] = key
+                
+            except Exception as e:
+                logger.error(f"Error checking proxy {proxy_str}: {e}")
+            
+            # Scored and in the done log before it counts as checked
+            result = await run_io(record_check, job_id, key, result, ptype)
+            if result:
+                await spool.add(result)
+            checked += 1
+        
+        # Run checks: a fixed pool drains the bounded queue as the file is read,
+        # the download is paused while the workers catch up
+        pool = WorkerPool(runner, MAX_CONCURRENCY, INGEST_QUEUE_SIZE).start()
+        reporter = ProgressReporter(
+            progress_msg, lambda: (checked, total, spool.live, reading)
+        ).start()
+        try:
+            await producer()
+            await pool.join()
+        finally:
+            await pool.close()
+            await reporter.stop()
+        await spool.flush()
+        
+        if not lines_read:
+            await run_io(finish_job, job_id, "done")
+            return await progress_msg.edit_text(
+                "❌ No valid proxies found in file.\n"
+                "Supported formats:\n"
+                "• ip:port\n• user:pass@ip:port\n• ip:port:user:pass"
+            )
+        
+        duplicate_lines = sum(len(lines) for lines in duplicates.values())
+        live = spool.live
         
-        # Run checks
-        await asyncio.gather(*[runner(p) for p in raw_proxies])
+        logger.info(
+            f"Job #{job_id}: user {uid} checked {total} unique proxies "
+            f"({duplicate_lines} duplicates, {invalid} invalid) in {ptype} mode"
+        )
         
         # Calculate stats
         total_time = time.time() - start_time
-        success_rate = (len(results) / len(raw_proxies) * 100) if raw_proxies else 0
-        
-        # Update uptime database - FIXED: Use get with defaults
-        uptime = load("uptime.json")
-        proxies_db = load("proxies_db.json")
-        
-        for r in results:
-            proxy_key = r["proxy"]
-            
-            # Update uptime with defaults
-            if proxy_key not in uptime:
-                uptime[proxy_key] = {"success": 1, "total": 1, "first_seen": datetime.now().isoformat()}
-            else:
-                uptime[proxy_key]["success"] = uptime[proxy_key].get("success", 0) + 1
-                uptime[proxy_key]["total"] = uptime[proxy_key].get("total", 0) + 1
-            
-            # Calculate score
-            success_count = uptime[proxy_key].get("success", 0)
-            total_count = uptime[proxy_key].get("total", 0)
-            success_rate_proxy = (success_count / total_count * 100) if total_count > 0 else 0
-            
-            r["score"] = smart_score(
-                r["latency"], 
-                success_count,
-                success_rate_proxy,
-                r["type"]
-            )
-            
-            # Store in database with defaults
-            proxies_db[proxy_key] = {
-                "last_seen": datetime.now().isoformat(),
-                "country": r.get("country", "Unknown"),
-                "isp": r.get("isp", "Unknown"),
-                "latency": r.get("latency", 0),
-                "score": r.get("score", 0),
-                "type": r.get("type", "unknown"),
-                "has_auth": r.get("has_auth", False),
-                "total_checks": total_count,
-                "success_rate": success_rate_proxy
-            }
-        
-        # Sort results by score (highest first)
-        results.sort(key=lambda x: x.get("score", 0), reverse=True)
+        success_rate = (live / total * 100) if total else 0
         
         # Save files
         user_dir = f"{RESULTS_DIR}/{uid}"
-        os.makedirs(user_dir, exist_ok=True)
-        
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Save detailed results
         detailed_out = f"{user_dir}/{ptype}_detailed_{timestamp}.txt"
-        with open(detailed_out, "w", encoding="utf-8") as f:
-            f.write(f"# Proxy Check Results - {ptype.upper()} Mode\n")
-            f.write(f"# Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"# Total: {len(raw_proxies)} | Live: {len(results)} | Dead: {len(raw_proxies)-len(results)}\n")
-            f.write(f"# Success Rate: {success_rate:.1f}%\n")
-            f.write(f"# Time: {total_time:.1f}s\n")
-            f.write(f"{'='*80}\n\n")
-            
-            for i, r in enumerate(results, 1):
-                auth_info = " (Auth)" if r.get("has_auth", False) else ""
-                f.write(f"{i}. {r.get('proxy', 'Unknown')}{auth_info}\n")
-                f.write(f"   ⏱ Latency: {r.get('latency', 0)}ms\n")
-                f.write(f"   🌍 Location: {r.get('country', 'Unknown')} / {r.get('city', 'Unknown')}\n")
-                f.write(f"   🏢 ISP: {r.get('isp', 'Unknown')}\n")
-                f.write(f"   📡 Type: {r.get('type', 'unknown').upper()}\n")
-                f.write(f"   ✅ Checks: {r.get('checks_passed', 0)}/{r.get('total_checks', 0)}\n")
-                f.write(f"   ⭐ Score: {r.get('score', 0)}\n")
-                f.write(f"{'-'*40}\n")
-        
-        # Save only live proxies (formatted nicely)
         live_out = f"{user_dir}/{ptype}_live_{timestamp}.txt"
-        with open(live_out, "w", encoding="utf-8") as f:
-            for r in results:
-                proxy = r.get("proxy", "")
-                proxy_type = r.get("type", "http")
-                if proxy:
-                    f.write(f"{proxy_type}://{proxy}\n")
         
-        # Save stats
-        save("uptime.json", uptime)
-        save("proxies_db.json", proxies_db)
-        
-        # Update check counts - FIXED: Use get with defaults
-        checks = load("checks_count.json")
-        today = datetime.now().strftime("%Y-%m-%d")
+        def write_reports():
+            """Merge-sort the spool by score (highest first) into both files, on the I/O pool"""
+            os.makedirs(user_dir, exist_ok=True)
+            with open(detailed_out, "w", encoding="utf-8") as f, open(live_out, "w", encoding="utf-8") as lf:
+                f.write(f"# Proxy Check Results - {ptype.upper()} Mode\n")
+                f.write(f"# Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                f.write(f"# Lines: {lines_read} | Unique: {total} | Duplicates: {duplicate_lines} | Invalid: {invalid}\n")
+                f.write(f"# Total: {total} | Live: {live} | Dead: {total-live}\n")
+                if dead_types:
+                    failed = " | ".join(
+                        f"{ptype or 'no protocol answered'} {count}" for ptype, count in sorted(dead_types.items())
+                    )
+                    f.write(f"# Dead by protocol tried: {failed}\n")
+                f.write(f"# Success Rate: {success_rate:.1f}%\n")
+                f.write(f"# Time: {total_time:.1f}s\n")
+                f.write(f"# Deadlines: {timeouts.describe()}\n")
+                f.write(f"{'='*80}\n\n")
+                
+                for i, r in enumerate(iter_sorted_spool(spool.spool_path), 1):
+                    # Fan results back out to every line that named the same endpoint
+                    r["duplicates"] = duplicates.get(r["key"], [])
+                    
+                    auth_info = " (Auth)" if r.get("has_auth", False) else ""
+                    f.write(f"{i}. {r.get('proxy', 'Unknown')}{auth_info}\n")
+                    f.write(f"   ⏱ Latency: {r.get('latency', 0)}ms\n")
+                    if r.get("timings"):
+                        phases = " | ".join(
+                            f"{phase} {value}ms" for phase, value in r["timings"].items() if value is not None
+                        )
+                        f.write(f"   ⏲ Phases: {phases}\n")
+                    f.write(f"   🌍 Location: {r.get('country', 'Unknown')} / {r.get('city', 'Unknown')}\n")
+                    f.write(f"   🏢 ISP: {r.get('isp', 'Unknown')}\n")
+                    f.write(f"   📡 Type: {r.get('type', 'unknown').upper()}\n")
+                    if r.get("anonymity"):
+                        f.write(f"   🕵️ Anonymity: {r['anonymity'].capitalize()}\n")
+                    f.write(f"   ✅ Checks: {r.get('checks_passed', 0)}/{r.get('total_checks', 0)}\n")
+                    f.write(f"   ⭐ Score: {r.get('score', 0)}\n")
+                    if r.get("cached"):
+                        f.write(f"   ♻️ Cached: verified {r.get('verified_at', '?')[:19]}, port answered in {r.get('probe_ms')}ms\n")
+                    if r["duplicates"]:
+                        shown = ", ".join(r["duplicates"][:5])
+                        more = f" (+{len(r['duplicates']) - 5} more)" if len(r["duplicates"]) > 5 else ""
+                        f.write(f"   🔁 Also listed as: {shown}{more}\n")
+                    tried = " | ".join(
+                        f"{outcome} {', '.join(r[field])}"
+                        for outcome, field in (("passed", "passed_types"), ("failed", "failed_types"), ("cancelled", "cancelled_types"))
+                        if r.get(field)
+                    )
+                    if tried:
+                        f.write(f"   🧪 Other protocols: {tried}\n")
+                    f.write(f"{'-'*40}\n")
+                    
+                    # Save only live proxies (formatted nicely)
+                    proxy = r.get("proxy", "")
+                    if proxy:
+                        lf.write(f"{r.get('type', 'http')}://{proxy}\n")
         
-        # Ensure checks dictionary has all required keys
-        if "last_reset" not in checks:
-            checks["last_reset"] = today
-        if "today" not in checks:
-            checks["today"] = 0
-        if "total" not in checks:
-            checks["total"] = 0
+        dead_types = await run_io(store.job_dead_types, job_id)
+        await run_io(write_reports)
         
-        # Reset today's count if it's a new day
-        if checks["last_reset"] != today:
-            checks["today"] = 0
-            checks["last_reset"] = today
+        # Update check counts
+        await run_io(add_checks_count, total)
         
-        # Update counts
-        checks["total"] = checks.get("total", 0) + len(raw_proxies)
-        checks["today"] = checks.get("today", 0) + len(raw_proxies)
-        save("checks_count.json", checks)
+        # Update user stats
+        await run_io(store.add_user_stats, uid, total_checks=total, live_proxies=live)
         
-        # Update user stats with defaults
-        user_stats[str(uid)]["total_checks"] = user_stats[str(uid)].get("total_checks", 0) + len(raw_proxies)
-        user_stats[str(uid)]["live_proxies"] = user_stats[str(uid)].get("live_proxies", 0) + len(results)
-        save("user_stats.json", user_stats)
+        # The reports are on disk now, the job's done log, snapshot and spool can go
+        await run_io(finish_job, job_id, "done", live=live, elapsed=total_time)
         
-        # Prepare final message
-        type_stats = defaultdict(int)
-        country_stats = defaultdict(int)
-        auth_stats = {"with_auth": 0, "without_auth": 0}
-        
-        for r in results:
-            type_stats[r.get("type", "unknown")] += 1
-            country_stats[r.get("country", "Unknown")] += 1
-            if r.get("has_auth", False):
-                auth_stats["with_auth"] += 1
-            else:
-                auth_stats["without_auth"] += 1
+        # Prepare final message (counted while spooling)
+        type_stats = spool.type_stats
+        country_stats = spool.country_stats
+        auth_stats = spool.auth_stats
         
         # Format type breakdown
         type_text = "\n".join([f"  • {t.upper()}: {c}" for t, c in sorted(type_stats.items())]) if type_stats else "  • None"
@@ -934,11 +1632,15 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await progress_msg.edit_text(
             f"✅ *Check Complete!*\n\n"
             f"📊 *Results Summary ({ptype.upper()} Mode):*\n"
-            f"• Total Proxies: {len(raw_proxies)}\n"
-            f"• ✅ Live: {len(results)}\n"
-            f"• ❌ Dead: {len(raw_proxies)-len(results)}\n"
+            f"• Total Proxies: {lines_read}\n"
+            f"• 🔁 Duplicates: {duplicate_lines} (checked once)\n"
+            f"• ⚠️ Invalid: {invalid}\n"
+            f"• ✅ Live: {live}\n"
+            f"• ❌ Dead: {total-live}\n"
             f"• 📈 Success Rate: {success_rate:.1f}%\n"
-            f"• ⏱️ Time Taken: {total_time:.1f}s\n\n"
+            f"• ⏱️ Time Taken: {total_time:.1f}s\n"
+            + (f"• ⚡ Fast Mode: {cache_hits} cached, {dead_skipped} skipped (recently dead)\n" if fast else "")
+            + f"\n"
             f"🔧 *Protocol Breakdown:*\n{type_text}\n\n"
             f"🔐 *Authentication:*\n{auth_text}\n\n"
             f"🌍 *Top Countries:*\n{countries_text}\n\n"
@@ -948,24 +1650,42 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
         
-        # Send files
-        await update.message.reply_document(
-            document=open(live_out, "rb"),
-            filename=f"live_proxies_{timestamp}.txt",
-            caption=f"📄 Live Proxies List ({len(results)} found)"
+        # Send files (split into parts above the upload limit)
+        await send_report(
+            bot, chat_id, live_out,
+            f"live_proxies_{timestamp}.txt",
+            f"📄 Live Proxies List ({live} found)"
         )
         
-        await update.message.reply_document(
-            document=open(detailed_out, "rb"),
-            filename=f"detailed_results_{timestamp}.txt",
-            caption="📊 Detailed Results Report"
+        await send_report(
+            bot, chat_id, detailed_out,
+            f"detailed_results_{timestamp}.txt",
+            "📊 Detailed Results Report"
         )
         
+    except asyncio.CancelledError:
+        if job_id in cancelled_jobs:
+            cancelled_jobs.discard(job_id)
+            await run_io(finish_job, job_id, "cancelled")
+            note = f"🛑 Check #{job_id} cancelled."
+        else:
+            # Bot is stopping: keep the job running-state so it resumes on the next start
+            await run_io(store.update_job, job_id, elapsed=time.time() - start_time)
+            note = f"⏸ Bot restarting, check #{job_id} will resume automatically."
+        try:
+            if progress_msg:
+                await progress_msg.edit_text(note)
+        except Exception:
+            pass
+        raise
+    
     except Exception as e:
-        logger.error(f"Error in handle_file: {e}", exc_info=True)
+        logger.error(f"Error in job #{job_id}: {e}", exc_info=True)
+        await run_io(finish_job, job_id, "failed", error=str(e)[:500])
         # Try to send error message
         try:
-            await update.message.reply_text(
+            await bot.send_message(
+                chat_id,
                 f"❌ *Error Processing File*\n\n"
                 f"```\n{str(e)[:500]}\n```\n\n"
                 f"⚠️ *Possible fixes:*\n"
@@ -976,6 +1696,11 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except:
             pass
+    
+    finally:
+        active_spools.pop(job_id, None)
+        if engine.running:
+            engine.end_job(job_id)
 
 # ================== ENHANCED ADMIN ==================
 
@@ -984,9 +1709,28 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if uid == OWNER_ID:
         # Owner stats
-        users = load("users.json")
-        checks = load("checks_count.json")
-        user_stats = load("user_stats.json")
+        users = await run_io(load, "users.json")
+        checks = await run_io(load, "checks_count.json")
+        lag = loop_lag.stats()
+        geo = geo_cache.stats()
+        depths = check_scheduler.depths()
+        waiting = sum(w for _, w in depths.values())
+        queue_lines = "".join(
+            f"  └ `{user_id}`{' 👑' if user_id == OWNER_ID else ''}: {running} running, {queued} waiting\n"
+            for user_id, (running, queued) in sorted(depths.items(), key=lambda kv: -sum(kv[1]))[:10]
+        )
+        engine_line = (
+            f"{engine.processes} processes, {'/'.join(map(str, engine.in_flight()))} checks in flight"
+            if engine.running else "in-process"
+        )
+        judge_lines = "".join(
+            f"  └ `{urlsplit(j['url']).netloc}`: {j['ok']}% ok, {j['latency']}ms, {j['failures']}/{j['requests']} failed\n"
+            for j in proxy_checker.judges.stats()
+        )
+        lag_line = (
+            f"{lag['current']}ms now / {lag['avg']}ms avg / {lag['p99']}ms p99 / {lag['max']}ms max"
+            if lag else "warming up"
+        )
         
         # Calculate active users (last 7 days)
         week_ago = time.time() - (7 * 24 * 3600)
@@ -1007,15 +1751,26 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• Total Checks: {checks.get('total', 0)}\n"
             f"• Today's Checks: {checks.get('today', 0)}\n\n"
             f"⚙️ *Bot Status:*\n"
-            f"• GeoDB: {'✅ Ready' if geo_reader else '❌ Not loaded'}\n"
+            f"• GeoDB: {'✅ Ready' if checker.geo_reader else '❌ Not loaded'} ({GEO_READER_MODE})\n"
+            f"• ASN DB: {'✅ Ready' if checker.geo_asn_reader else '❌ Not loaded'}\n"
             f"• Storage: {DATA_DIR}\n"
-            f"• Max Concurrency: {MAX_CONCURRENCY}",
+            f"• Max Concurrency: {MAX_CONCURRENCY}\n"
+            f"• Check Slots: {check_scheduler.in_flight}/{check_scheduler.budget} busy, {waiting} waiting\n"
+            f"{queue_lines}"
+            f"• Queued Lines: {sum(p.queue.qsize() for p in active_pools)} in {len(active_pools)} files\n"
+            f"• Engine: {engine_line}\n"
+            f"• Judges: {JUDGE_MODE}, {min(JUDGES_PER_CHECK, len(proxy_checker.test_urls))} per check, "
+            f"built-in {'on' if JUDGE_SERVER_PORT else 'off'}\n"
+            f"{judge_lines}"
+            f"• I/O Threads: {IO_WORKERS}\n"
+            f"• Loop Lag: {lag_line}\n"
+            f"• Geo Cache: {geo['size']} IPs, {geo['hit_rate']:.1f}% hits ({geo['hits']}/{geo['hits'] + geo['misses']})",
             parse_mode="Markdown"
         )
     else:
         # User stats
-        user_stats = load("user_stats.json").get(str(uid), {})
-        users = load("users.json")
+        user_stats = await run_io(store.get_user_stats, uid)
+        users = await run_io(load, "users.json")
         user_data = users.get(str(uid), {})
         
         checks_made = user_stats.get("total_checks", 0)
@@ -1043,11 +1798,165 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• Days Active: {days_active}\n\n"
             f"💡 *Tips for Best Results:*\n"
             f"• Use **Auto Detect** for mixed files\n"
-            f"• Remove duplicates before checking\n"
+            f"• Duplicates are detected and checked once\n"
             f"• Check during off-peak hours (UTC 00:00-06:00)",
             parse_mode="Markdown"
         )
 
+def effective_limits():
+    """What actually bounds a user's checks: their cap and the shared budget"""
+    return (
+        f"👤 Checks in flight per user: {CheckScheduler.user_cap(None)}\n"
+        f"🌐 Shared budget: {check_scheduler.budget}"
+    )
+
+async def workers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Owner only: show or change the worker pool size, running checks included"""
+    global MAX_CONCURRENCY
+    
+    if update.effective_user.id != OWNER_ID:
+        return
+    
+    if not context.args:
+        return await update.message.reply_text(
+            f"⚙️ Workers per check: {MAX_CONCURRENCY}\n"
+            f"🔄 Running checks: {len(active_pools)}\n"
+            f"{effective_limits()}\n\n"
+            f"Usage: /workers <1-{MAX_WORKERS_LIMIT}>"
+        )
+    
+    try:
+        size = int(context.args[0])
+    except ValueError:
+        return await update.message.reply_text("❌ Worker count must be a number")
+    if not 1 <= size <= MAX_WORKERS_LIMIT:
+        return await update.message.reply_text(f"❌ Worker count must be between 1 and {MAX_WORKERS_LIMIT}")
+    
+    MAX_CONCURRENCY = size
+    for pool in active_pools:
+        pool.resize(size)
+    check_scheduler.refresh_caps()
+    
+    logger.info(f"⚡ Max Concurrency set to {size}")
+    await update.message.reply_text(
+        f"✅ Workers per check set to {size}\n"
+        f"🔄 Applied to {len(active_pools)} running check(s)\n"
+        f"{effective_limits()}"
+    )
+
+JOB_ICONS = {"queued": "🕓", "running": "🔄", "done": "✅", "cancelled": "🛑", "failed": "❌"}
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Recent check jobs of the user (the owner sees everyone's)"""
+    uid = update.effective_user.id
+    jobs = await run_io(store.list_jobs, None if uid == OWNER_ID else uid, 10)
+    
+    if not jobs:
+        return await update.message.reply_text(
+            "📭 No checks yet. Use /check and upload a .txt file."
+        )
+    
+    lines = ["📋 Your recent checks:\n"]
+    for job in jobs:
+        icon = JOB_ICONS.get(job["status"], "•")
+        if job["status"] in JOB_UNFINISHED:
+            total_text = f"{job['total']}" if job["input_complete"] else "?"
+            progress = f"{job['checked']}/{total_text} checked"
+        elif job["status"] == "done":
+            progress = f"{job['live']} live of {job['total']}"
+        else:
+            progress = "stopped"
+        owner_note = f" (user {job['uid']})" if uid == OWNER_ID and job["uid"] != uid else ""
+        lines.append(
+            f"{icon} #{job['id']} {job['ptype'].upper()} - {job['status']} - {progress}\n"
+            f"    {job['file_name'] or 'file'}{owner_note}"
+        )
+    if any(job["status"] in JOB_UNFINISHED for job in jobs):
+        lines.append("\n🛑 /cancel <id> stops a running check")
+    
+    # Plain text: file names may contain Markdown characters
+    await update.message.reply_text("\n".join(lines))
+
+async def _pick_job(uid, args):
+    """Job named by /command <id>, or the user's newest unfinished one; None if not theirs"""
+    if args:
+        job = await run_io(store.get_job, int(args[0]))
+    else:
+        running = [j for j in await run_io(store.list_jobs, uid, 10) if j["status"] in JOB_UNFINISHED]
+        job = running[0] if running else None
+    if not job or (job["uid"] != uid and uid != OWNER_ID):
+        return None
+    return job
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel a running check: /cancel <id>, or the newest one without an id"""
+    uid = update.effective_user.id
+    
+    try:
+        job = await _pick_job(uid, context.args)
+    except ValueError:
+        return await update.message.reply_text("❌ Usage: /cancel <job id>")
+    
+    if not job:
+        return await update.message.reply_text("❌ No such check. See /jobs")
+    if job["status"] not in JOB_UNFINISHED:
+        return await update.message.reply_text(f"ℹ️ Check #{job['id']} is already {job['status']}.")
+    
+    task = active_jobs.get(job["id"])
+    if task:
+        cancelled_jobs.add(job["id"])
+        task.cancel()  # the job reports back on its progress message
+    else:
+        await run_io(finish_job, job["id"], "cancelled")
+    await update.message.reply_text(f"🛑 Cancelling check #{job['id']}...")
+
+async def partial_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the live proxies a running check has found so far"""
+    uid = update.effective_user.id
+    
+    try:
+        job = await _pick_job(uid, context.args)
+    except ValueError:
+        return await update.message.reply_text("❌ Usage: /partial <job id>")
+    
+    spool = active_spools.get(job["id"]) if job else None
+    if not spool:
+        return await update.message.reply_text("❌ No running check to take results from. See /jobs")
+    if not spool.live:
+        return await update.message.reply_text(f"⏳ Check #{job['id']} has no live proxies yet.")
+    
+    copy_path = f"{spool.live_path}.{update.message.message_id}.partial"
+    try:
+        await spool.copy_live(copy_path)
+        await send_report(
+            context.bot, update.effective_chat.id, copy_path,
+            f"live_partial_{job['id']}.txt",
+            f"📥 Check #{job['id']}: {spool.live} live so far (unsorted, the final list is ranked)"
+        )
+    finally:
+        await run_io(_remove_files, copy_path)
+
+async def fastmode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Toggle fast mode for the user's next uploads: /fastmode [on|off]"""
+    arg = context.args[0].lower() if context.args else None
+    if arg in ("on", "off"):
+        enabled = arg == "on"
+    else:
+        enabled = not context.user_data.get("fastmode", False)
+    context.user_data["fastmode"] = enabled
+    
+    if enabled:
+        await update.message.reply_text(
+            f"⚡ *Fast Mode ON*\n\n"
+            f"• Proxies verified alive in the last {FAST_MODE_TTL // 60} min are answered from cache "
+            f"after a quick port probe\n"
+            f"• Proxies found dead in the last {DEAD_CACHE_TTL // 60} min are skipped\n\n"
+            f"Use /fastmode off for a full re-check.",
+            parse_mode="Markdown"
+        )
+    else:
+        await update.message.reply_text("🐢 Fast Mode OFF: every proxy gets a full check.")
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🆘 *HELP & GUIDE*\n\n"
@@ -1055,6 +1964,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /start - Start the bot & see formats\n"
         "• /check - Check proxies (RECOMMENDED: Auto Detect)\n"
         "• /stats - View statistics\n"
+        "• /jobs - Your running and recent checks\n"
+        "• /cancel - Stop a running check\n"
+        "• /partial - Live proxies found so far\n"
+        "• /fastmode - Reuse recent results for re-uploaded lists\n"
         "• /help - This message\n\n"
         "📁 *Supported Proxy Formats:*\n"
         "```\n"
@@ -1067,39 +1980,85 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Tests all 4 protocols automatically\n"
         "• Returns fastest working protocol\n\n"
         "⚡ *Best Practices:*\n"
-        "1. Remove duplicate proxies\n"
-        "2. Use Auto Detect for unknown types\n"
-        "3. Files up to 10,000 proxies work best",
+        "1. Use Auto Detect for unknown types\n"
+        "2. Duplicates in any format are checked once\n"
+        "3. Checks survive bot restarts and resume where they stopped",
         parse_mode="Markdown"
     )
 
 # ================== FIXED MAIN FUNCTION ==================
 
+geo_refresh_task = None
+engine_task = None
+
+async def start_engine():
+    """Learn our own address first, the engine shards copy it when they start"""
+    await proxy_checker.detect_real_ip()
+    if ENGINE_PROCESSES > 1:
+        await engine.start()
+
+async def startup(app: Application):
+    """Start background monitors once the event loop is running"""
+    global geo_refresh_task, engine_task
+    loop_lag.start()
+    geo_refresh_task = asyncio.create_task(geo_refresh_loop())
+    if JUDGE_SERVER_PORT:
+        await judge_server.start()
+    engine_task = asyncio.create_task(start_engine())  # jobs check in-process until it is up
+    await resume_jobs(app.bot)
+
+async def stop(app: Application):
+    """Pause running jobs while the bot can still edit their messages"""
+    await stop_jobs()
+
+async def shutdown(app: Application):
+    """Release network resources while the event loop is still running"""
+    await loop_lag.stop()
+    for task in (geo_refresh_task, engine_task):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    await judge_server.stop()
+    await engine.stop()
+    await proxy_checker.close()
+
+
 def main():
+    setup_logging()
+    atexit.register(cleanup)
+    
     # First, ensure all storage exists
     logger.info("📁 Initializing storage...")
     ensure_storage()
     
     # Load GeoIP database
     logger.info("🌍 Loading GeoIP database...")
-    try:
-        ensure_geolite_db()
-        global geo_reader
-        geo_reader = geoip2.database.Reader(GEO_DB)
-        logger.info("✅ GeoLite2 database loaded successfully")
-    except Exception as e:
-        logger.error(f"❌ Failed to load GeoLite2 database: {e}")
-        geo_reader = None
+    load_geo_readers()
     
     # Create bot application
     logger.info("🤖 Creating bot application...")
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(startup)
+        .post_stop(stop)
+        .post_shutdown(shutdown)
+        .build()
+    )
     
     # Command handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("check", check))
     app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("workers", workers))
+    app.add_handler(CommandHandler("jobs", jobs_command))
+    app.add_handler(CommandHandler("cancel", cancel_command))
+    app.add_handler(CommandHandler("partial", partial_command))
+    app.add_handler(CommandHandler("fastmode", fastmode_command))
     
     # Callback handlers
     app.add_handler(CallbackQueryHandler(recheck, pattern="recheck"))
@@ -1116,7 +2075,7 @@ def main():
     logger.info(f"⚡ Max Concurrency: {MAX_CONCURRENCY}")
     
     # Verify JSON files exist
-    json_files = ["users.json", "checks_count.json", "ban.json", "uptime.json", "user_stats.json", "proxies_db.json"]
+    json_files = ["users.json", "checks_count.json", "ban.json"]
     for json_file in json_files:
         filepath = f"{DATA_DIR}/{json_file}"
         if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
@@ -1124,20 +2083,20 @@ def main():
         else:
             logger.warning(f"⚠️ {json_file}: Missing or empty, will be created")
     
+    # Open the indexed store (migrates the old JSON files on first run)
+    store.conn
+    logger.info(f"✅ {DB_PATH}: OK")
+    
     # Run the bot
     app.run_polling(drop_pending_updates=True)
 
 # ================== CLEANUP ON EXIT ==================
 
-import atexit
-
 def cleanup():
-    """Cleanup function to close GeoIP reader on exit"""
-    if geo_reader:
-        geo_reader.close()
-        logger.info("✅ GeoIP database closed")
-
-atexit.register(cleanup)
+    """Registered by main(): close the GeoIP readers on exit (the connection pool is closed by shutdown())"""
+    close_geo_readers()
+    io_executor.shutdown(wait=True)
+    store.close()
 
 if __name__ == "__main__":
     main()
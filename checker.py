@@ -0,0 +1,2342 @@
+"""
+Proxy checking engine: parser, protocol sniffing, judges, adaptive timeouts,
+geo enrichment, scoring and the sharded multi-process engine. It never
+imports telegram nor reads BOT_TOKEN; bot.py builds the Telegram bot on top
+of it, and it runs on its own from cron or other services:
+
+    python -m checker [-t auto|all|http|https|socks4|socks5] [-f jsonl|csv]
+        [-c CONCURRENCY] [--processes N] [--include-dead]
+        [--update-geo | --offline] [-v] [FILE ...]
+
+Lines are read from the files (or stdin) as they come and results are
+streamed to stdout, one per unique proxy, in completion order. The same
+thing is available to async code as check_proxies().
+"""
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import logging
+import argparse
+import aiohttp
+import requests
+import tarfile
+import shutil
+import re
+import ssl
+import threading
+import struct
+import ipaddress
+import functools
+import heapq
+import itertools
+import random
+import contextvars
+import multiprocessing
+import signal
+import zlib
+import base64
+from socket import inet_pton, AF_INET
+from datetime import datetime
+from collections import namedtuple, OrderedDict, deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import geoip2.database
+import geoip2.errors
+from aiohttp import web
+
+# ================== CONFIG ==================
+
+DATA_DIR = "data"
+MAXMIND_ACCOUNT_ID = os.getenv("MAXMIND_ACCOUNT_ID")
+MAXMIND_LICENSE_KEY = os.getenv("MAXMIND_LICENSE_KEY")
+
+GEO_DB = f"{DATA_DIR}/GeoLite2-City.mmdb"
+GEO_ASN_DB = f"{DATA_DIR}/GeoLite2-ASN.mmdb"  # ISP / ASN, the City edition leaves them empty
+GEO_DB_MAX_AGE = 604800  # refresh after 7 days
+GEO_READER_MODE = os.getenv("GEO_READER_MODE", "mmap")  # mmap (shared page cache) or memory (fastest, ~70MB RAM)
+GEO_DOWNLOAD_URL = os.getenv("GEO_DOWNLOAD_URL", "https://download.maxmind.com/app/geoip_download")
+GEO_REFRESH_CHECK = int(os.getenv("GEO_REFRESH_CHECK", 6 * 3600))  # how often the background refresher wakes up
+GEO_SWAP_GRACE = 30  # seconds a replaced reader stays open for lookups already running on it
+
+TIMEOUT = aiohttp.ClientTimeout(total=15)
+# The check session skips certificate checks (judges behind proxies); requests
+# that carry a secret (bot token in a file URL, MaxMind key) pass this instead
+VERIFIED_SSL = ssl.create_default_context()
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Shared aiohttp session (one per ProxyChecker): https judges through HTTP
+# proxies, https-scheme proxies and our direct requests (judges, downloads).
+# Plain HTTP proxies and SOCKS go through our own clients.
+POOL_LIMIT = int(os.getenv("POOL_LIMIT", 1024))  # keep above GLOBAL_CHECK_BUDGET * JUDGES_PER_CHECK: waiting for a slot counts against the connect deadline
+POOL_LIMIT_PER_HOST = int(os.getenv("POOL_LIMIT_PER_HOST", 8))  # per judge + proxy pair, or direct host (parallel file downloads)
+
+# Per-phase deadlines (seconds). Each run starts at these ceilings; once it has
+# TIMEOUT_MIN_SAMPLES live proxies a phase only waits for the live p99 of the
+# run * TIMEOUT_MARGIN + TIMEOUT_PAD (never under its floor), so dead proxies
+# fail fast while the slow live ones still make it. TIMEOUT.total caps it all.
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", 3))  # TCP connect to the proxy (dead ports fail here)
+HANDSHAKE_TIMEOUT = float(os.getenv("HANDSHAKE_TIMEOUT", 4))  # SOCKS negotiation, HTTP CONNECT, probe replies
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", 8))  # judge answer once the tunnel is up
+TIMEOUT_FLOORS = {"connect": 0.3, "handshake": 0.3, "read": 1.0}
+TIMEOUT_MARGIN = 1.5
+TIMEOUT_PAD = 0.2
+TIMEOUT_MIN_SAMPLES = 30
+TIMEOUT_WINDOW = 1000  # recent live samples kept per phase
+TIMEOUT_EXPLORE = 0.02  # share of waits still given the ceiling, so the slow tail stays measured
+
+SOCKS_TYPES = ("socks4", "socks5")
+SNIFF_GRACE_MIN = 0.05  # seconds the other probes still get after one was recognized
+MAX_JUDGE_BODY = 64 * 1024  # judges answer with a few hundred bytes
+
+# How the judge URLs are queried per protocol check:
+#   sequential - one after another (slowest, old behaviour)
+#   parallel   - all at once, wait for every answer
+#   quorum     - all at once, stop as soon as JUDGE_QUORUM have passed (plain
+#                HTTP proxies: in turn on one keep-alive connection instead)
+JUDGE_MODE = os.getenv("JUDGE_MODE", "quorum")
+JUDGE_QUORUM = int(os.getenv("JUDGE_QUORUM", 2))
+
+# Judge URLs (comma separated). JUDGE_PUBLIC_URL is how proxies reach a judge
+# we run ourselves (JUDGE_SERVER_PORT, 0 = off), e.g. http://203.0.113.7:8089/judge;
+# it goes first and, echoing headers, also gives the anonymity level.
+JUDGE_URLS = [
+    url.strip()
+    for url in os.getenv(
+        "JUDGE_URLS", "http://httpbin.org/ip,http://api.ipify.org?format=json,http://ip-api.com/json/"
+    ).split(",")
+    if url.strip()
+]
+JUDGE_SERVER_HOST = os.getenv("JUDGE_SERVER_HOST", "0.0.0.0")
+JUDGE_SERVER_PORT = int(os.getenv("JUDGE_SERVER_PORT", 0))
+JUDGE_PUBLIC_URL = os.getenv("JUDGE_PUBLIC_URL")
+if JUDGE_PUBLIC_URL:
+    JUDGE_URLS = [JUDGE_PUBLIC_URL] + [url for url in JUDGE_URLS if url != JUDGE_PUBLIC_URL]
+JUDGES_PER_CHECK = int(os.getenv("JUDGES_PER_CHECK", 3))  # drawn from JUDGE_URLS by health
+JUDGE_HEALTH_ALPHA = 0.05  # weight of the newest outcome in a judge's running health
+JUDGE_MIN_WEIGHT = 0.05  # a failing judge still gets the odd request, so it can recover
+
+# Request headers that give a proxy away, and the anonymity levels worst first
+PROXY_HEADERS = (
+    "via", "forwarded", "x-forwarded-for", "x-forwarded", "forwarded-for", "x-real-ip",
+    "client-ip", "x-client-ip", "x-originating-ip", "true-client-ip", "x-cluster-client-ip",
+    "x-proxy-id", "proxy-connection",
+)
+ANONYMITY_LEVELS = ("transparent", "anonymous", "elite")
+
+# Per-request timing phases (ms): TCP connect to the proxy, proxy handshake
+# (SOCKS negotiation), TLS to the judge, time to first byte, total
+TIMING_PHASES = ("connect", "handshake", "tls", "ttfb", "total")
+
+# Sharded engine: with ENGINE_PROCESSES > 1 the checks of every job run in that
+# many worker processes (own event loop, connection pool, geo readers), sharded
+# by proxy so an endpoint always lands on the same one. Parsing, dedupe and
+# results stay with the caller, whose concurrency still bounds the checks in
+# flight (the bot: raise GLOBAL_CHECK_BUDGET and MAX_CONCURRENCY along with it).
+# Only worth it with a spare core per shard: on one core the pipes and extra
+# loops make checking slower, not faster.
+ENGINE_PROCESSES = int(os.getenv("ENGINE_PROCESSES", 0))  # 0 or 1 = check in the calling process
+ENGINE_RESTART_DELAY = 1  # first restart of a dead shard, doubled on every failure in a row
+ENGINE_RESTART_MAX_DELAY = 60
+ENGINE_RESTART_LIMIT = 8  # failures in a row before a shard is given up (its checks run in-process)
+ENGINE_RESTART_RESET = 120  # a shard that ran this long (s) before dying starts the count again
+
+# Blocking work (GeoIP, file reads) runs on its own thread pool
+IO_WORKERS = int(os.getenv("IO_WORKERS", 4))
+GEO_BATCH_SIZE = 256  # max lookups coalesced into one executor call
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", 50000))  # IPs kept in the geo LRU
+
+# ================== LOGGING ==================
+
+# Configured by whoever runs us (bot.py, the CLI below)
+logger = logging.getLogger(__name__)
+
+# ================== BLOCKING I/O EXECUTOR ==================
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking call on the I/O pool so the event loop keeps serving checks"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+# ================== PROXY PARSER ==================
+
+class ProxyInfo(namedtuple("ProxyInfo", "ip port user password scheme format")):
+    """Compact parse result, one per line (a tuple is far smaller than a dict at 500k lines)"""
+    __slots__ = ()
+    
+    @property
+    def original(self):
+        return ProxyParser.normalize_proxy(self)
+
+# Last resort for messy lines: the first IPv4 followed by a port
+_OCTET = r"(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)"
+_EXTRACT_RE = re.compile(rf"(?<![\d.])({_OCTET}(?:\.{_OCTET}){{3}})(?::|\s+)(\d{{2,5}})\b", re.ASCII)
+_HOSTNAME_RE = re.compile(r"^[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*$")
+
+_IPV4_OCTETS = frozenset(str(i) for i in range(256))
+_new_info = tuple.__new__  # ProxyInfo(...) without namedtuple's Python-level __new__
+
+# Port string -> int for the fast path: a list repeats a few ports (8080,
+# 3128, 1080, a provider's gateway port) on most of its lines, and every
+# record of the same port then shares one int. Only canonical spellings of
+# valid ports go in, and only the first PORT_CACHE_SIZE of them.
+PORT_CACHE_SIZE = 4096
+_PORTS = {}
+
+def _valid_port(port):
+    """ASCII digits only: int() would also take "+80", " 80", "1_000" and non-ASCII digits"""
+    return port.isdigit() and port.isascii()
+
+_SCHEME_TYPES = {
+    "http": "http", "https": "https",
+    "socks4": "socks4", "socks4a": "socks4",
+    "socks5": "socks5", "socks5h": "socks5",
+}
+
+class ProxyParser:
+    @staticmethod
+    def parse_proxy(proxy_str):
+        """
+        Parse various proxy formats:
+        1. ip:port
+        2. user:pass@ip:port
+        3. ip:port:user:pass
+        4. ip:port:user:pass:type (some providers)
+        Each may carry a scheme:// prefix, and the host may be [IPv6].
+        Ports and IPv4 octets are validated; a line with half a credential
+        or an unknown scheme/type is rejected rather than trimmed.
+        Returns a ProxyInfo, or None if no valid ip/port is found.
+        """
+        # Fast path for the three shapes nearly every list uses, on a clean
+        # line with an IPv4 host: one split, inet_pton checks the dotted quad
+        # (no leading zeros, octets <= 255) without a list of octets, and the
+        # record is built once. Anything it is not sure about takes the
+        # general path, which gives the same answer for the lines taken here.
+        parts = proxy_str.split(":")
+        n = len(parts)
+        if n == 2:
+            host, port = parts
+            user = None
+        elif n == 4:
+            host, port, user, password = parts
+            if (not (user and password) or "@" in proxy_str or "/" in proxy_str
+                    or '"' in proxy_str or "'" in proxy_str or password[-1].isspace()):
+                return ProxyParser._parse_general(proxy_str)
+        elif n == 3:
+            # user:pass@ip:port
+            user, password, port = parts
+            password, _, host = password.rpartition("@")
+            if (not (user and password) or "/" in proxy_str
+                    or '"' in proxy_str or "'" in proxy_str or user[0].isspace()):
+                return ProxyParser._parse_general(proxy_str)
+        elif n == 1 and "@" not in proxy_str and "[" not in proxy_str:
+            # No colon at all: only the messy-line extraction can find a port
+            return ProxyParser._extract(proxy_str)
+        else:
+            return ProxyParser._parse_general(proxy_str)
+        
+        port_num = _PORTS.get(port)
+        if port_num is None:
+            if not (port.isdigit() and port.isascii()):
+                return ProxyParser._parse_general(proxy_str)
+            port_num = int(port)
+            if not 0 < port_num < 65536:
+                return ProxyParser._parse_general(proxy_str)
+            if len(_PORTS) < PORT_CACHE_SIZE and port[0] != "0":
+                _PORTS[port] = port_num
+        try:
+            inet_pton(AF_INET, host)
+        except OSError:
+            return ProxyParser._parse_general(proxy_str)
+        if user is None:
+            return _new_info(ProxyInfo, (host, port_num, None, None, None, 'no_auth'))
+        return _new_info(ProxyInfo, (host, port_num, user, password, None, 'auth'))
+    
+    @staticmethod
+    def _parse_general(proxy_str):
+        """Every format parse_proxy accepts: schemes, quotes, [IPv6], hostnames, messy lines"""
+        s = proxy_str.strip()
+        if '"' in s or "'" in s:
+            s = s.replace('"', '').replace("'", '')
+        
+        scheme = user = password = None
+        if "://" in s:
+            scheme, _, s = s.partition("://")
+            scheme = _SCHEME_TYPES.get(scheme.lower())
+            if scheme is None:
+                return None
+        if "@" in s:
+            auth, _, s = s.rpartition("@")
+            user, sep, password = auth.partition(":")
+            if not (user and sep and password):
+                return None
+        
+        if s[:1] == "[":
+            # [IPv6]:port
+            host, _, port = s[1:].partition("]:")
+            if not _valid_port(port):
+                return None
+            try:
+                host = ipaddress.IPv6Address(host).compressed
+            except ValueError:
+                return None
+        else:
+            parts = s.split(":")
+            n = len(parts)
+            if n == 2:
+                host, port = parts
+            elif n == 4 or n == 5:
+                if user or not (parts[2] and parts[3]):
+                    return None
+                host, port, user, password = parts[:4]
+                if n == 5:
+                    ptype = _SCHEME_TYPES.get(parts[4].lower())
+                    if ptype is None or scheme not in (None, ptype):
+                        return None
+                    scheme = ptype
+            elif n == 3 and _valid_port(parts[1]) and parts[2] and not any(c.isspace() for c in parts[2]):
+                # ip:port:user, the password is missing
+                return None
+            else:
+                return ProxyParser._extract(proxy_str)
+            
+            if not _valid_port(port):
+                return ProxyParser._extract(proxy_str)
+            
+            octets = host.split(".")
+            if len(octets) == 4 and octets[3] in _IPV4_OCTETS:
+                if not (octets[0] in _IPV4_OCTETS and octets[1] in _IPV4_OCTETS and octets[2] in _IPV4_OCTETS):
+                    return None
+            elif host[-1:].isdigit() or not _HOSTNAME_RE.match(host):
+                return ProxyParser._extract(proxy_str)
+            else:
+                host = host.lower()
+        
+        port = int(port)
+        if not 0 < port < 65536:
+            return None
+        if user:
+            return ProxyInfo(host, port, user, password, scheme, 'auth')
+        return ProxyInfo(host, port, None, None, scheme, 'no_auth')
+    
+    @staticmethod
+    def _extract(proxy_str):
+        """Pattern 5: Try to extract IP:PORT from messy string"""
+        m = _EXTRACT_RE.search(proxy_str)
+        if m is None:
+            return None
+        ip, port = m.groups()
+        port = int(port)
+        if not 0 < port < 65536:
+            return None
+        return ProxyInfo(ip, port, None, None, None, 'extracted')
+    
+    @staticmethod
+    def parse_many(lines):
+        """
+        Batch mode: parse a whole buffer (str/bytes) or an iterable of lines.
+        Yields (line, ProxyInfo or None) for every line that is not blank
+        or a comment.
+        """
+        if isinstance(lines, (bytes, bytearray)):
+            lines = lines.decode("utf-8", errors="replace")
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        
+        parse = ProxyParser.parse_proxy
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] == "#" or line.startswith("//"):
+                continue
+            yield line, parse(line)
+    
+    @staticmethod
+    def normalize_proxy(proxy_info):
+        """Convert proxy info to standard format"""
+        host = f"[{proxy_info.ip}]" if ":" in proxy_info.ip else proxy_info.ip
+        if proxy_info.user and proxy_info.password:
+            return f"{proxy_info.user}:{proxy_info.password}@{host}:{proxy_info.port}"
+        else:
+            return f"{host}:{proxy_info.port}"
+    
+    @staticmethod
+    def canonical_key(proxy_info):
+        """
+        Identity of an endpoint (ip, port, credentials), so the same proxy
+        written as ip:port:user:pass, user:pass@ip:port or with a scheme
+        is treated as one. parse_proxy already lower-cases hosts and turns
+        ports into ints, so this is the normalized form.
+        """
+        return ProxyParser.normalize_proxy(proxy_info)
+
+# ================== GEO DB AUTO DOWNLOAD & UPDATE ==================
+
+GEO_EDITIONS = (
+    ("GeoLite2-City", GEO_DB, True),  # (edition, path, required)
+    ("GeoLite2-ASN", GEO_ASN_DB, False),
+)
+
+def _geo_stale(path):
+    """Missing or older than GEO_DB_MAX_AGE"""
+    if not os.path.exists(path):
+        return True
+    return time.time() - os.path.getmtime(path) >= GEO_DB_MAX_AGE
+
+def _geo_params(edition):
+    params = {
+        "edition_id": edition,
+        "license_key": MAXMIND_LICENSE_KEY,
+        "suffix": "tar.gz",
+    }
+    return {k: v for k, v in params.items() if v}
+
+def _prepare_mmdb(tar_path, edition, tmp_path):
+    """Extract the edition's .mmdb from the tarball to tmp_path and make sure it opens"""
+    with tarfile.open(tar_path, "r:gz") as tar:
+        for m in tar.getmembers():
+            if m.isfile() and m.name.endswith(f"{edition}.mmdb"):
+                with tar.extractfile(m) as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                break
+        else:
+            raise ValueError(f"{edition}.mmdb not found in archive")
+    
+    # A truncated or wrong file must never replace a working database
+    with geoip2.database.Reader(tmp_path) as reader:
+        db_type = reader.metadata().database_type
+    if edition not in db_type:
+        raise ValueError(f"archive holds {db_type}, expected {edition}")
+
+def _remove_files(*paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+def _download_geolite(edition, path):
+    """Download one GeoLite2 edition (streamed to disk) and move its .mmdb to path"""
+    tar_path = f"{path}.tar.gz.part"
+    tmp_path = f"{path}.tmp"
+    try:
+        with requests.get(
+            GEO_DOWNLOAD_URL,
+            params=_geo_params(edition),
+            auth=(MAXMIND_ACCOUNT_ID, MAXMIND_LICENSE_KEY) if MAXMIND_ACCOUNT_ID else None,
+            timeout=60,
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            with open(tar_path, "wb") as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        
+        _prepare_mmdb(tar_path, edition, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        _remove_files(tar_path, tmp_path)
+
+async def _download_geolite_async(edition, path):
+    """Same as _download_geolite but on the shared session (TLS verified), disk work on the I/O pool"""
+    tar_path = f"{path}.tar.gz.part"
+    tmp_path = f"{path}.tmp"
+    session = await proxy_checker.get_session()
+    auth = aiohttp.BasicAuth(MAXMIND_ACCOUNT_ID, MAXMIND_LICENSE_KEY) if MAXMIND_ACCOUNT_ID else None
+    try:
+        async with session.get(
+            GEO_DOWNLOAD_URL,
+            params=_geo_params(edition),
+            auth=auth,
+            ssl=VERIFIED_SSL,
+            timeout=aiohttp.ClientTimeout(total=600, sock_read=60),
+        ) as r:
+            r.raise_for_status()
+            f = await run_io(open, tar_path, "wb")
+            try:
+                async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await run_io(f.write, chunk)
+            finally:
+                await run_io(f.close)
+        
+        await run_io(_prepare_mmdb, tar_path, edition, tmp_path)
+        await run_io(os.replace, tmp_path, path)
+    finally:
+        await run_io(_remove_files, tar_path, tmp_path)
+
+def ensure_geolite_db():
+    updated = False
+    for edition, path, required in GEO_EDITIONS:
+        if not _geo_stale(path):
+            continue
+        
+        if os.path.exists(path):
+            logger.info(f"🔄 {edition} database is old, updating...")
+        
+        logging.info(f"⬇️ Downloading {edition} database")
+        
+        try:
+            _download_geolite(edition, path)
+            updated = True
+            logging.info(f"✅ {edition} database updated successfully")
+            
+        except Exception as e:
+            logging.error(f"❌ Failed to update {edition} database: {e}")
+            if required and not os.path.exists(path):
+                raise
+    
+    if updated:
+        geo_cache.clear()  # answers from the old database are stale now
+
+async def refresh_geolite(force=False):
+    """Download stale editions and swap their readers in under running checks"""
+    global geo_reader, geo_asn_reader
+    loop = asyncio.get_running_loop()
+    updated = []
+    
+    for edition, path, required in GEO_EDITIONS:
+        if not force and not await run_io(_geo_stale, path):
+            continue
+        
+        logger.info(f"⬇️ Refreshing {edition} database in the background")
+        try:
+            await _download_geolite_async(edition, path)
+            reader = await run_io(open_geo_reader, path)
+        except Exception as e:
+            logger.error(f"❌ Background refresh of {edition} failed: {e}")
+            continue
+        
+        # Plain rebinding is atomic: a lookup uses either the old or the new reader
+        if path == GEO_DB:
+            old, geo_reader = geo_reader, reader
+        else:
+            old, geo_asn_reader = geo_asn_reader, reader
+        geo_cache.clear()
+        updated.append(edition)
+        logger.info(f"✅ {edition} database swapped in")
+        
+        if old is not None:
+            loop.call_later(GEO_SWAP_GRACE, old.close)
+    
+    if updated and engine.running:
+        engine.broadcast(("geo",))  # the shards reopen their own readers
+    return updated
+
+async def geo_refresh_loop():
+    """Background task: keeps the GeoLite2 databases fresh without a restart"""
+    while True:
+        await asyncio.sleep(GEO_REFRESH_CHECK)
+        try:
+            await refresh_geolite()
+        except Exception as e:
+            logger.error(f"❌ GeoIP refresh loop error: {e}")
+
+def open_geo_reader(path):
+    """Open a GeoLite2 database in the configured GEO_READER_MODE"""
+    modes = {
+        "mmap": geoip2.database.MODE_MMAP,
+        "memory": geoip2.database.MODE_MEMORY,
+        "auto": geoip2.database.MODE_AUTO,
+    }
+    mode = modes.get(GEO_READER_MODE.lower())
+    if mode is None:
+        logger.warning(f"⚠️ Unknown GEO_READER_MODE {GEO_READER_MODE!r}, using mmap")
+        mode = geoip2.database.MODE_MMAP
+    return geoip2.database.Reader(path, mode=mode)
+
+def load_geo_readers(download=True):
+    """Open the City database (downloaded first if stale and download is set) and the optional ASN one"""
+    global geo_reader, geo_asn_reader
+    try:
+        if download:
+            ensure_geolite_db()
+        geo_reader = open_geo_reader(GEO_DB)
+        logger.info(f"✅ GeoLite2 database loaded successfully ({GEO_READER_MODE})")
+    except Exception as e:
+        logger.error(f"❌ Failed to load GeoLite2 database: {e}")
+        geo_reader = None
+    
+    if os.path.exists(GEO_ASN_DB):
+        try:
+            geo_asn_reader = open_geo_reader(GEO_ASN_DB)
+            logger.info("✅ GeoLite2 ASN database loaded successfully")
+        except Exception as e:
+            logger.error(f"❌ Failed to load GeoLite2 ASN database: {e}")
+            geo_asn_reader = None
+    else:
+        logger.warning("⚠️ GeoLite2 ASN database missing, ISP/ASN will show Unknown")
+
+def close_geo_readers():
+    if geo_reader:
+        geo_reader.close()
+        logger.info("✅ GeoIP database closed")
+    if geo_asn_reader:
+        geo_asn_reader.close()
+
+# ================== ENHANCED GEO LOOKUP ==================
+
+geo_reader = None
+geo_asn_reader = None  # optional, ISP/ASN enrichment
+
+UNKNOWN_GEO = {
+    "country": "Unknown",
+    "city": "Unknown",
+    "isp": "Unknown",
+    "asn": "Unknown",
+    "aso": "Unknown"
+}
+
+class GeoCache:
+    """Bounded LRU of geo answers keyed by IP, shared by every check"""
+    
+    def __init__(self, maxsize=GEO_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()  # lookups run on the I/O threads
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on clear(), older answers are dropped
+    
+    def get(self, ip):
+        with self._lock:
+            info = self._data.get(ip)
+            if info is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(ip)
+            self.hits += 1
+            return info
+    
+    def put(self, ip, info, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return  # read from a reader that has been swapped out meanwhile
+            self._data[ip] = info
+            self._data.move_to_end(ip)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups * 100) if lookups else 0.0,
+            }
+
+geo_cache = GeoCache()
+
+def _geo_read(ip):
+    """Query the City and ASN readers in one go; returns (info, cacheable)"""
+    # Take local references, the refresher may swap the globals meanwhile
+    city_reader, asn_reader = geo_reader, geo_asn_reader
+    if city_reader is None:
+        return UNKNOWN_GEO, False  # don't pin Unknown before the DB is loaded
+    info = dict(UNKNOWN_GEO)
+    try:
+        r = city_reader.city(ip)
+        info["country"] = r.country.name or "Unknown"
+        info["city"] = r.city.name or "Unknown"
+    except geoip2.errors.AddressNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Geo lookup failed for {ip}: {e}")
+        return UNKNOWN_GEO, False
+    if asn_reader is not None:
+        try:
+            a = asn_reader.asn(ip)
+            # GeoLite has no ISP edition, the AS organization is the closest thing
+            info["asn"] = a.autonomous_system_number or "Unknown"
+            info["aso"] = a.autonomous_system_organization or "Unknown"
+            info["isp"] = info["aso"]
+        except geoip2.errors.AddressNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"ASN lookup failed for {ip}: {e}")
+            return info, False
+    return info, True
+
+def geo_lookup(ip):
+    """Geo info for one IP (cached). The returned dict is shared, don't mutate it"""
+    info = geo_cache.get(ip)
+    if info is None:
+        generation = geo_cache.generation
+        info, cacheable = _geo_read(ip)
+        if cacheable:
+            geo_cache.put(ip, info, generation)
+    return info
+
+def geo_lookup_many(ips):
+    """Geo info for many IPs at once: {ip: info}, each distinct IP read at most once"""
+    return {ip: geo_lookup(ip) for ip in dict.fromkeys(ips)}
+
+class GeoBatcher:
+    """Coalesces geo lookups issued in the same loop tick into one executor call"""
+    
+    def __init__(self, batch_size=GEO_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._pending = {}  # ip -> future
+        self._scheduled = False
+    
+    async def lookup(self, ip):
+        loop = asyncio.get_running_loop()
+        fut = self._pending.get(ip)
+        if fut is None:
+            fut = self._pending[ip] = loop.create_future()
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._flush)
+        # Shielded: a cancelled auto-mode probe must not cancel the shared lookup
+        return await asyncio.shield(fut)
+    
+    def _flush(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i in range(0, len(items), self.batch_size):
+            asyncio.ensure_future(self._resolve(items[i:i + self.batch_size]))
+    
+    async def _resolve(self, batch):
+        try:
+            infos = await run_io(geo_lookup_many, [ip for ip, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for ip, fut in batch:
+            if not fut.done():
+                fut.set_result(infos[ip])
+
+geo_batcher = GeoBatcher()
+
+# ================== ENHANCED SMART SCORE ==================
+
+def smart_score(latency, uptime, success_rate=100, proxy_type="http", timings=None):
+    """
+    Enhanced scoring algorithm:
+    - Base score: 100 - latency penalty
+    - Uptime bonus: increases with consistency
+    - Success rate bonus
+    - Proxy type multiplier
+    When per-phase timings are available the penalty uses the time to first
+    byte, which is what a client actually waits for, instead of the total.
+    """
+    if timings and timings.get("ttfb") is not None:
+        latency = timings["ttfb"]
+    
+    # Latency penalty (more aggressive for high latency)
+    latency_penalty = min(latency / 5, 60)
+    
+    # Uptime bonus (logarithmic growth)
+    uptime_bonus = min(uptime * 8, 30)
+    
+    # Success rate bonus
+    success_bonus = success_rate * 0.2
+    
+    # Proxy type multiplier
+    type_multiplier = {
+        "socks5": 1.2,
+        "socks4": 1.1,
+        "https": 1.15,
+        "http": 1.0
+    }.get(proxy_type, 1.0)
+    
+    base_score = (100 - latency_penalty + uptime_bonus + success_bonus)
+    return round(base_score * type_multiplier, 2)
+
+# ================== ADAPTIVE TIMEOUTS ==================
+
+TIMEOUT_PHASES = ("connect", "handshake", "read")
+
+class TimeoutPolicy:
+    """
+    Connect / handshake / read deadlines for one run, learnt from the phase
+    timings of the live proxies found so far. The ceilings apply until enough
+    are in, then p99 * TIMEOUT_MARGIN + TIMEOUT_PAD clamped to [floor, ceiling].
+    """
+    
+    def __init__(self, ceilings=None):
+        self.ceilings = ceilings or {
+            "connect": CONNECT_TIMEOUT,
+            "handshake": HANDSHAKE_TIMEOUT,
+            "read": READ_TIMEOUT,
+        }
+        self.deadlines = dict(self.ceilings)
+        self.samples = {phase: deque(maxlen=TIMEOUT_WINDOW) for phase in TIMEOUT_PHASES}
+        self._unsorted = 0
+    
+    def deadline(self, phase):
+        """Seconds to wait for a phase (now and then the ceiling, to keep sampling the tail)"""
+        if random.random() < TIMEOUT_EXPLORE:
+            return self.ceilings[phase]
+        return self.deadlines[phase]
+    
+    def client_timeout(self, tunnel=False):
+        """The same deadlines for an aiohttp request through an HTTP proxy"""
+        connect, handshake, read = (self.deadline(phase) for phase in TIMEOUT_PHASES)
+        return aiohttp.ClientTimeout(
+            total=TIMEOUT.total,
+            # https judges: TCP connect, then CONNECT + TLS in the same step
+            connect=connect + handshake if tunnel else connect,
+            sock_connect=connect,
+            sock_read=read,
+        )
+    
+    def observe(self, timings):
+        """Learn from the phase timings (ms) of a judge request that passed or a recognized sniff reply"""
+        connect, handshake, tls, ttfb = (timings.get(key) for key in ("connect", "handshake", "tls", "ttfb"))
+        if connect is not None:
+            self.samples["connect"].append(connect / 1000)
+        if handshake is not None:
+            self.samples["handshake"].append(handshake / 1000)
+        if ttfb is not None:
+            read = ttfb - sum(value for value in (connect, handshake, tls) if value)
+            self.samples["read"].append(max(read, 0) / 1000)
+        
+        # Re-sorting a window per request would cost more than it saves
+        self._unsorted += 1
+        if self._unsorted >= 16:
+            self._unsorted = 0
+            self._update()
+    
+    def _update(self):
+        for phase, samples in self.samples.items():
+            if len(samples) < TIMEOUT_MIN_SAMPLES:
+                continue
+            values = sorted(samples)
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+            self.deadlines[phase] = round(
+                min(self.ceilings[phase], max(TIMEOUT_FLOORS[phase], p99 * TIMEOUT_MARGIN + TIMEOUT_PAD)), 2
+            )
+    
+    def describe(self):
+        return " | ".join(f"{phase} {self.deadlines[phase]}s" for phase in TIMEOUT_PHASES)
+
+# Every job sets its own policy; checks outside a job share the default one
+default_timeouts = TimeoutPolicy()
+current_timeouts = contextvars.ContextVar("current_timeouts", default=default_timeouts)
+
+# ================== ENHANCED PROXY CHECKER ==================
+
+def _ips_in(text):
+    """Every IP address in a judge answer or header value (1.2.3.4:80 and for="[::1]" included)"""
+    ips = set()
+    for token in re.split(r'[\s,;="\[\]]+', text):
+        if token.count(":") == 1:
+            token = token.partition(":")[0]
+        try:
+            ips.add(str(ipaddress.ip_address(token)))
+        except ValueError:
+            pass
+    return ips
+
+class JudgePool:
+    """
+    Judge URLs with a running health each. Every check draws its judges by
+    weight (success rate over latency), so a slow or throttling judge gets
+    fewer requests without ever being dropped. A failed request only counts
+    against a judge when another judge passed through the same proxy in the
+    same check, otherwise it was the proxy that was dead.
+    """
+    
+    def __init__(self, urls, alpha=JUDGE_HEALTH_ALPHA):
+        self.urls = list(urls)
+        self.alpha = alpha
+        self.health = {
+            url: {"ok": 1.0, "latency": None, "requests": 0, "failures": 0}
+            for url in self.urls
+        }
+    
+    def weight(self, url):
+        health = self.health[url]
+        latency = health["latency"] or 500
+        return max(health["ok"], JUDGE_MIN_WEIGHT) * 1000 / max(latency, 50)
+    
+    def pick(self, count=JUDGES_PER_CHECK):
+        """Weighted sample without replacement, healthiest judges most likely first"""
+        return heapq.nlargest(
+            min(count, len(self.urls)),
+            self.urls,
+            key=lambda url: random.random() ** (1 / self.weight(url)),
+        )
+    
+    def record(self, outcomes):
+        """
+        outcomes: (url, passed, total ms) of the judges of one check. passed is
+        None for a judge cancelled once the quorum was in, its time so far is
+        then a lower bound that only ever raises its latency.
+        """
+        if not any(passed for _, passed, _ in outcomes):
+            return
+        for url, passed, total in outcomes:
+            health = self.health[url]
+            latency = health["latency"]
+            if passed is None:
+                if latency is None or total > latency:
+                    health["latency"] = total if latency is None else latency + self.alpha * (total - latency)
+                continue
+            health["requests"] += 1
+            health["ok"] += self.alpha * (passed - health["ok"])
+            if not passed:
+                health["failures"] += 1
+            elif total is not None:
+                health["latency"] = total if latency is None else latency + self.alpha * (total - latency)
+    
+    def stats(self):
+        return [
+            {
+                "url": url,
+                "ok": round(self.health[url]["ok"] * 100, 1),
+                "latency": round(self.health[url]["latency"] or 0),
+                "requests": self.health[url]["requests"],
+                "failures": self.health[url]["failures"],
+            }
+            for url in self.urls
+        ]
+
+class HttpProxyStream:
+    """
+    One keep-alive connection to a plain HTTP proxy that a check's http://
+    judges take in turn as absolute-form GETs, so the check costs one TCP
+    connect instead of one per judge (aiohttp pools by judge host and proxy,
+    so its connections are never shared between judges). It reconnects if
+    the proxy closed it after an answer; once a connect failed, the other
+    judges fail at once instead of waiting out the connect again.
+    """
+    
+    def __init__(self, checker, proxy_info):
+        self.checker = checker
+        self.proxy_info = proxy_info
+        self.auth = None
+        if proxy_info.user and proxy_info.password:
+            token = base64.b64encode(f"{proxy_info.user}:{proxy_info.password}".encode()).decode()
+            self.auth = {"Proxy-Authorization": f"Basic {token}"}
+        self._stream = None
+        self._unreachable = False
+    
+    async def get(self, url, timings):
+        """GET url through the proxy; returns (status, body), raises like socks_request"""
+        return await asyncio.wait_for(self._get(url, timings), TIMEOUT.total)
+    
+    async def _get(self, url, timings):
+        if self._unreachable:
+            raise ConnectionError("proxy did not accept the connection")
+        start = time.monotonic()
+        if self._stream is None:
+            try:
+                self._stream = await self.checker._open_connection(self.proxy_info.ip, self.proxy_info.port)
+            except BaseException:
+                self._unreachable = True
+                raise
+            timings["connect"] = round((time.monotonic() - start) * 1000, 1)
+        
+        reader, writer = self._stream
+        try:
+            status, body, reusable = await self.checker._http_get(
+                reader, writer, url, urlsplit(url).netloc, start, timings, self.auth, keep_alive=True
+            )
+        except BaseException:
+            self.close()
+            raise
+        if not reusable:
+            self.close()
+        return status, body
+    
+    def close(self):
+        if self._stream is not None:
+            self._stream[1].close()
+            self._stream = None
+
+class ProxyChecker:
+    def __init__(self, judge_urls=None):
+        self.judges = JudgePool(judge_urls or JUDGE_URLS)
+        self.real_ips = set()  # our own addresses, a judge seeing one means the proxy leaked it
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+        }
+        self._session = None
+        self._ssl = None
+    
+    @property
+    def test_urls(self):
+        return self.judges.urls
+    
+    @test_urls.setter
+    def test_urls(self, urls):
+        self.judges = JudgePool(urls)
+    
+    async def get_session(self):
+        """
+        Return the long-lived session, creating it on first use.
+        Every check shares one connector and its connection cap, instead of
+        building and tearing down a session per check. Proxies are dialled
+        by IP, so its DNS cache only serves the direct requests.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=POOL_LIMIT,
+                limit_per_host=POOL_LIMIT_PER_HOST,
+                # Nothing worth parking: judge connections are pooled per judge and proxy,
+                # and no check asks the same pair twice
+                force_close=True,
+                ssl=False,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=TIMEOUT,
+                headers=self.headers,
+                trace_configs=[self._timing_trace()],
+            )
+            logger.info("🔌 Proxy checker connection pool created")
+        return self._session
+    
+    @staticmethod
+    def _timing_trace():
+        """
+        aiohttp trace hooks filling the timings dict passed as trace_request_ctx.
+        For an HTTP proxy "connect" covers the TCP connect to the proxy (plus
+        CONNECT and TLS for https judges, which aiohttp does in one step);
+        a request on a pooled keep-alive connection has no connect phase.
+        """
+        def now():
+            return time.monotonic()
+        
+        async def on_request_start(session, ctx, params):
+            if ctx.trace_request_ctx is not None:
+                ctx.trace_request_ctx["_start"] = now()
+        
+        async def on_connection_create_start(session, ctx, params):
+            if ctx.trace_request_ctx is not None:
+                ctx.trace_request_ctx["_connect_start"] = now()
+        
+        async def on_connection_create_end(session, ctx, params):
+            timings = ctx.trace_request_ctx
+            if timings is not None and "_connect_start" in timings:
+                timings["connect"] = round((now() - timings["_connect_start"]) * 1000, 1)
+        
+        async def on_request_end(session, ctx, params):
+            # Fired once the status line and headers are in
+            timings = ctx.trace_request_ctx
+            if timings is not None and "_start" in timings:
+                timings["ttfb"] = round((now() - timings["_start"]) * 1000, 1)
+        
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_start.append(on_connection_create_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_request_end.append(on_request_end)
+        return trace
+    
+    async def close(self):
+        """Close the shared session and its connector"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("✅ Proxy checker connection pool closed")
+        self._session = None
+    
+    async def test_proxy(self, proxy_url, proxy_type):
+        """Test a proxy with given type and URL"""
+        try:
+            if proxy_type in SOCKS_TYPES:
+                proxy_info = ProxyParser.parse_proxy(proxy_url)
+                status, body = await self.socks_request(proxy_info, proxy_type, "http://httpbin.org/ip")
+                return status == 200 and "origin" in json.loads(body)
+            
+            session = await self.get_session()
+            async with session.get(
+                "http://httpbin.org/ip",
+                proxy=proxy_url,
+                ssl=False,
+            ) as r:
+                if r.status == 200:
+                    data = await r.json(content_type=None)
+                    if "origin" in data:
+                        return True
+        except Exception as e:
+            logger.debug(f"Proxy test failed: {e}")
+        return False
+    
+    async def _judge(self, session, proxy_info, proxy_type, proxy_url, test_url, stream=None):
+        """
+        One judge request through the proxy, on stream (an HttpProxyStream)
+        when the check shares one connection between its judges.
+        Returns (passed, per-phase timings, anonymity level or None)
+        """
+        timings = {}
+        tunnel = False
+        start = time.monotonic()
+        try:
+            if proxy_type in SOCKS_TYPES:
+                # aiohttp only speaks HTTP proxies, SOCKS goes through our own client
+                status, body = await self.socks_request(proxy_info, proxy_type, test_url, timings)
+            elif stream is not None:
+                status, body = await stream.get(test_url, timings)
+            else:
+                tunnel = test_url.startswith("https:")
+                async with session.get(
+                    test_url,
+                    proxy=proxy_url,
+                    ssl=False,
+                    timeout=current_timeouts.get().client_timeout(tunnel),
+                    trace_request_ctx=timings,
+                ) as r:
+                    # Never buffer more than a judge answer: a proxy can stream forever
+                    body = await self._read_judge_body(r.content)
+                    status = r.status
+        except Exception:  # never swallow CancelledError
+            return False, None, None
+        timings["total"] = round((time.monotonic() - start) * 1000, 1)
+        timings = {phase: timings.get(phase) for phase in TIMING_PHASES}
+        passed = status == 200
+        if passed:
+            learn = timings
+            if proxy_type not in SOCKS_TYPES and tunnel and timings["connect"] is not None:
+                # aiohttp times TCP + CONNECT + TLS as one step: that is the
+                # tunnel handshake, not a bare TCP connect
+                learn = dict(timings, connect=None, handshake=timings["connect"])
+            current_timeouts.get().observe(learn)
+        return passed, timings, self.classify_anonymity(body) if passed else None
+    
+    @staticmethod
+    async def _read_judge_body(content):
+        """Body of up to MAX_JUDGE_BODY bytes; raises ValueError on anything larger"""
+        body = b""
+        while True:
+            chunk = await content.read(MAX_JUDGE_BODY + 1 - len(body))
+            if not chunk:
+                return body
+            body += chunk
+            if len(body) > MAX_JUDGE_BODY:
+                raise ValueError(f"judge body over {MAX_JUDGE_BODY} bytes")
+    
+    def classify_anonymity(self, body):
+        """
+        Anonymity level from a judge that echoes the request headers (our own
+        judge, httpbin /get style): transparent if our address reached it,
+        anonymous if the proxy still announced itself, elite otherwise.
+        None for judges that only answer with an IP.
+        """
+        try:
+            data = json.loads(body)
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get("headers"), dict):
+            return None
+        
+        headers = {name.lower(): str(value) for name, value in data["headers"].items()}
+        forwarded = [headers[name] for name in PROXY_HEADERS if name in headers]
+        seen = _ips_in(" ".join([str(data.get("origin", ""))] + forwarded))
+        if self.real_ips & seen:
+            return "transparent"
+        if forwarded:
+            return "anonymous"
+        return "elite"
+    
+    async def detect_real_ip(self):
+        """Ask the judges directly (no proxy) which address we come from"""
+        session = await self.get_session()
+        
+        async def ask(url):
+            try:
+                async with session.get(url, ssl=False) as r:
+                    data = await r.json(content_type=None)
+            except Exception:
+                return set()
+            if not isinstance(data, dict):
+                return set()
+            # httpbin / our judge, ipify, ip-api
+            return _ips_in(" ".join(str(data.get(key, "")) for key in ("origin", "ip", "query")))
+        
+        for ips in await asyncio.gather(*(ask(url) for url in self.test_urls)):
+            self.real_ips |= ips
+        if self.real_ips:
+            logger.info(f"🪪 Checker address: {', '.join(sorted(self.real_ips))}")
+        else:
+            logger.warning("⚠️ Could not learn our own address, transparent proxies will pass as anonymous")
+    
+    @staticmethod
+    def _merge_timings(samples):
+        """Median of each phase over the passing requests (None if never measured)"""
+        merged = {}
+        for phase in TIMING_PHASES:
+            values = sorted(t[phase] for t in samples if t[phase] is not None)
+            merged[phase] = values[len(values) // 2] if values else None
+        return merged
+    
+    async def _run_judges(self, session, proxy_info, proxy_type, proxy_url):
+        """
+        Run the judge requests according to JUDGE_MODE, on judges drawn from
+        the pool by health. Returns (passed, completed, timings of the passed
+        requests, worst anonymity level any judge saw or None)
+        """
+        urls = self.judges.pick()
+        outcomes = []
+        cancelled = []  # quorum reached before these answered
+        started = time.monotonic()
+        
+        # A plain HTTP proxy takes absolute-form requests for any judge, so
+        # its judges can take turns on one keep-alive connection
+        shared = proxy_type == "http" and all(url.startswith("http:") for url in urls)
+        if JUDGE_MODE == "sequential" or (JUDGE_MODE == "quorum" and shared):
+            # quorum: stop once it passed or can no longer pass
+            needed = min(JUDGE_QUORUM, len(urls)) if JUDGE_MODE == "quorum" else None
+            stream = HttpProxyStream(self, proxy_info) if shared else None
+            try:
+                for i, url in enumerate(urls):
+                    passed = sum(outcome[1] for outcome in outcomes)
+                    if needed is not None and (passed >= needed or passed + len(urls) - i < needed):
+                        break
+                    outcomes.append((url, *await self._judge(session, proxy_info, proxy_type, proxy_url, url, stream)))
+            finally:
+                if stream is not None:
+                    stream.close()
+        else:
+            # parallel: wait for every judge; quorum: stop once enough have passed
+            needed = len(urls)
+            if JUDGE_MODE == "quorum":
+                needed = min(JUDGE_QUORUM, needed)
+            
+            pending = {
+                asyncio.create_task(self._judge(session, proxy_info, proxy_type, proxy_url, url)): url
+                for url in urls
+            }
+            try:
+                while pending and sum(outcome[1] for outcome in outcomes) < needed:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        outcomes.append((pending.pop(task), *task.result()))
+            finally:
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+            waited = round((time.monotonic() - started) * 1000, 1)
+            cancelled = [(url, None, waited) for url in pending.values()]
+        
+        self.judges.record(
+            [(url, passed, timings and timings["total"]) for url, passed, timings, _ in outcomes] + cancelled
+        )
+        levels = [level for _, passed, _, level in outcomes if passed and level]
+        return (
+            sum(passed for _, passed, _, _ in outcomes),
+            len(outcomes),
+            [timings for _, passed, timings, _ in outcomes if passed],
+            min(levels, key=ANONYMITY_LEVELS.index) if levels else None,
+        )
+    
+    async def check_proxy_with_type(self, proxy_str, proxy_type):
+        """Check proxy with specific protocol type"""
+        # Parse proxy
+        proxy_info = ProxyParser.parse_proxy(proxy_str)
+        if not proxy_info:
+            return None
+        
+        ip = proxy_info.ip
+        
+        # Format proxy URL based on type (only used by the aiohttp HTTP/HTTPS path)
+        proxy_url = f"{proxy_type}://{ProxyParser.normalize_proxy(proxy_info)}"
+        
+        try:
+            session = await self.get_session()
+            successful_tests, total_tests, samples, anonymity = await self._run_judges(
+                session, proxy_info, proxy_type, proxy_url
+            )
+            
+            if successful_tests > 0:
+                # Median of the individual requests, not wall-clock over all judges
+                timings = self._merge_timings(samples)
+                latency = int(timings["total"])
+                geo_info = await geo_batcher.lookup(ip)
+                
+                # Calculate success rate over the judges that answered
+                success_rate = (successful_tests / total_tests) * 100
+                
+                result = {
+                    "proxy": ProxyParser.normalize_proxy(proxy_info),
+                    "original": proxy_str,
+                    "latency": latency,
+                    "timings": timings,
+                    "country": geo_info["country"],
+                    "city": geo_info["city"],
+                    "isp": geo_info["isp"],
+                    "asn": geo_info["asn"],
+                    "aso": geo_info["aso"],
+                    "success_rate": success_rate,
+                    "checks_passed": successful_tests,
+                    "total_checks": total_tests,
+                    "anonymity": anonymity,
+                    "type": proxy_type,
+                    "has_auth": proxy_info.user is not None,
+                    "live": True,
+                    "timestamp": datetime.now().isoformat()
+                }
+                return result
+        except Exception as e:
+            logger.debug(f"Proxy {proxy_str} failed with {proxy_type}: {e}")
+        
+        return None
+    
+    # ---------- protocol sniffing ----------
+    
+    def _judge_target(self):
+        """Host and port of the first judge, used as the CONNECT target of probes"""
+        url = urlsplit(self.test_urls[0])
+        return url.hostname, url.port or (443 if url.scheme == "https" else 80)
+    
+    @staticmethod
+    async def _open_connection(ip, port):
+        """Raw TCP connection to a proxy, shared by the sniffer and the SOCKS client"""
+        return await asyncio.wait_for(
+            asyncio.open_connection(ip, int(port)), current_timeouts.get().deadline("connect")
+        )
+    
+    async def _probe(self, ip, port, payload, timings=None):
+        """
+        Open one raw TCP connection, send payload and return the first bytes
+        of the reply (b"" if the peer closed or stayed silent).
+        Returns None if the TCP connect itself failed. The time from send to
+        reply goes into timings["handshake"] (ms) if a dict is given.
+        """
+        try:
+            reader, writer = await self._open_connection(ip, port)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            return None
+        
+        try:
+            sent = time.monotonic()
+            writer.write(payload)
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.read(64), current_timeouts.get().deadline("handshake"))
+            if timings is not None:
+                timings["handshake"] = round((time.monotonic() - sent) * 1000, 1)
+            return reply
+        except (OSError, asyncio.TimeoutError):
+            return b""
+        finally:
+            writer.close()
+    
+    @staticmethod
+    def _classify_reply(reply):
+        """Map the first bytes a proxy answered with to protocol candidates"""
+        if reply.startswith(b"HTTP/"):
+            # An HTTP proxy answered our CONNECT: it may tunnel https as well
+            return ["http", "https"]
+        if reply[:1] in (b"\x15", b"\x16") and reply[1:2] == b"\x03":
+            # TLS alert / handshake: the port wants TLS first
+            return ["https"]
+        if reply[:1] == b"\x05":
+            return ["socks5"]
+        if reply[:1] == b"\x00" and len(reply) >= 2 and 0x5A <= reply[1] <= 0x5D:
+            return ["socks4"]
+        return None
+    
+    async def sniff_protocol(self, proxy_info):
+        """
+        Fingerprint the protocol on ip:port with cheap raw probes: HTTP CONNECT,
+        SOCKS5 greeting and SOCKS4a CONNECT, each on its own connection and all
+        at once. They cannot share one: an HTTP proxy sits waiting for the rest
+        of a binary SOCKS greeting, and a SOCKS server hangs up on the first
+        bytes it does not speak. Once a probe is recognized, the others get as
+        long again to answer, so ports that speak several protocols report them
+        all without anyone waiting on a silent probe's full deadline.
+        Returns the protocols worth a full judge check; an empty list means
+        the port is dead or nothing answered any probe.
+        """
+        ip, port = proxy_info.ip, proxy_info.port
+        host, host_port = self._judge_target()
+        has_auth = bool(proxy_info.user and proxy_info.password)
+        
+        # SOCKS5: offer "no auth" and, if we have credentials, user/pass
+        socks5_greeting = b"\x05\x02\x00\x02" if has_auth else b"\x05\x01\x00"
+        # SOCKS4a: CONNECT to the judge by name (0.0.0.1 marks a hostname follows)
+        socks4_connect = (
+            struct.pack(">BBH", 4, 1, host_port) + b"\x00\x00\x00\x01"
+            + (proxy_info.user or "").encode() + b"\x00"
+            + host.encode() + b"\x00"
+        )
+        http_connect = f"CONNECT {host}:{host_port} HTTP/1.1\r\nHost: {host}:{host_port}\r\n\r\n".encode()
+        
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        probes = {}
+        for payload in (http_connect, socks5_greeting, socks4_connect):
+            timings = {}
+            probes[asyncio.create_task(self._probe(ip, port, payload, timings))] = timings
+        pending = set(probes)
+        candidates = []
+        unrecognized = refused = 0
+        until = None  # set by the first recognized reply
+        try:
+            while pending:
+                timeout = None if until is None else max(0, until - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break  # the rest stayed silent past the grace
+                for task in done:
+                    reply = task.result()
+                    if reply is None:
+                        refused += 1  # connect failed
+                        continue
+                    if not reply:
+                        continue  # closed or silent
+                    found = self._classify_reply(reply)
+                    if not found:
+                        unrecognized += 1
+                        continue
+                    candidates += [ptype for ptype in found if ptype not in candidates]
+                    # A recognized answer is a proxy handshake round trip: learn from
+                    # it, so runs without SOCKS checks still tune the handshake deadline
+                    current_timeouts.get().observe(probes[task])
+                    if until is None:
+                        elapsed = loop.time() - start
+                        until = loop.time() + max(elapsed, SNIFF_GRACE_MIN)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        if candidates:
+            return candidates
+        if refused == 3:
+            return []  # dead port, skip the judges entirely
+        # Something answered but we could not tell what: let the judges decide
+        return ["socks5", "socks4", "http", "https"] if unrecognized else []
+    
+    # ---------- native SOCKS transport ----------
+    
+    @staticmethod
+    async def _socks5_handshake(reader, writer, proxy_info, host, port):
+        """SOCKS5 greeting, optional username/password auth (RFC 1929) and CONNECT"""
+        user, password = proxy_info.user, proxy_info.password
+        writer.write(b"\x05\x02\x00\x02" if user and password else b"\x05\x01\x00")
+        await writer.drain()
+        
+        version, method = await reader.readexactly(2)
+        if version != 5:
+            raise ConnectionError(f"not a SOCKS5 server (version {version})")
+        if method == 0x02:
+            if not (user and password):
+                raise ConnectionError("SOCKS5 server requires authentication")
+            user_b, pass_b = user.encode(), password.encode()
+            writer.write(bytes([1, len(user_b)]) + user_b + bytes([len(pass_b)]) + pass_b)
+            await writer.drain()
+            _, status = await reader.readexactly(2)
+            if status != 0:
+                raise ConnectionError("SOCKS5 authentication rejected")
+        elif method != 0x00:
+            raise ConnectionError("SOCKS5 server accepted none of our auth methods")
+        
+        try:
+            addr = ipaddress.ip_address(host)
+            atyp = b"\x01" if addr.version == 4 else b"\x04"
+            dest = atyp + addr.packed
+        except ValueError:
+            host_b = host.encode("idna")
+            dest = b"\x03" + bytes([len(host_b)]) + host_b
+        writer.write(b"\x05\x01\x00" + dest + struct.pack(">H", port))
+        await writer.drain()
+        
+        _, rep, _, atyp = await reader.readexactly(4)
+        if rep != 0:
+            raise ConnectionError(f"SOCKS5 CONNECT failed (reply {rep})")
+        # Skip the bound address the server reports back
+        if atyp == 1:
+            await reader.readexactly(4 + 2)
+        elif atyp == 4:
+            await reader.readexactly(16 + 2)
+        else:
+            length = (await reader.readexactly(1))[0]
+            await reader.readexactly(length + 2)
+    
+    @staticmethod
+    async def _socks4_handshake(reader, writer, proxy_info, host, port):
+        """SOCKS4 CONNECT, or SOCKS4a when the target is a hostname"""
+        try:
+            dest_ip, domain = ipaddress.IPv4Address(host).packed, b""
+        except ValueError:
+            # SOCKS4a: 0.0.0.x tells the proxy to resolve the trailing name
+            dest_ip, domain = b"\x00\x00\x00\x01", host.encode("idna") + b"\x00"
+        user_id = (proxy_info.user or "").encode()
+        writer.write(struct.pack(">BBH", 4, 1, port) + dest_ip + user_id + b"\x00" + domain)
+        await writer.drain()
+        
+        reply = await reader.readexactly(8)
+        if reply[1] != 0x5A:
+            raise ConnectionError(f"SOCKS4 CONNECT rejected (reply {reply[1]})")
+    
+    async def _socks_tunnel(self, proxy_info, proxy_type, host, port, timings):
+        """Connect to the proxy and tunnel the stream to host:port"""
+        start = time.monotonic()
+        reader, writer = await self._open_connection(proxy_info.ip, proxy_info.port)
+        connected = time.monotonic()
+        timings["connect"] = round((connected - start) * 1000, 1)
+        try:
+            handshake = self._socks5_handshake if proxy_type == "socks5" else self._socks4_handshake
+            await asyncio.wait_for(
+                handshake(reader, writer, proxy_info, host, port),
+                current_timeouts.get().deadline("handshake"),
+            )
+        except BaseException:
+            writer.close()
+            raise
+        timings["handshake"] = round((time.monotonic() - connected) * 1000, 1)
+        return reader, writer
+    
+    def _ssl_context(self):
+        # Same policy as the aiohttp path (ssl=False): judges are not verified
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context()
+            self._ssl.check_hostname = False
+            self._ssl.verify_mode = ssl.CERT_NONE
+        return self._ssl
+    
+    async def socks_request(self, proxy_info, proxy_type, url, timings=None):
+        """
+        GET url through a SOCKS4/4a/5 proxy with a minimal HTTP/1.0 client.
+        Returns (status, body); raises on handshake or protocol errors.
+        Phase timings (ms) are recorded into the optional timings dict.
+        Each call opens its own tunnel: a SOCKS CONNECT is bound to one
+        destination, and a check's judges are different hosts queried at once.
+        """
+        return await asyncio.wait_for(
+            self._socks_request(proxy_info, proxy_type, url, {} if timings is None else timings),
+            TIMEOUT.total,
+        )
+    
+    async def _socks_request(self, proxy_info, proxy_type, url, timings):
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        
+        start = time.monotonic()
+        reader, writer = await self._socks_tunnel(proxy_info, proxy_type, host, port, timings)
+        try:
+            timeouts = current_timeouts.get()
+            if parts.scheme == "https":
+                tls_start = time.monotonic()
+                await asyncio.wait_for(
+                    writer.start_tls(self._ssl_context(), server_hostname=host),
+                    timeouts.deadline("handshake"),
+                )
+                timings["tls"] = round((time.monotonic() - tls_start) * 1000, 1)
+            
+            status, body, _ = await self._http_get(reader, writer, path, parts.netloc, start, timings)
+            return status, body
+        finally:
+            writer.close()
+    
+    async def _http_get(self, reader, writer, target, netloc, start, timings, extra_headers=None, keep_alive=False):
+        """
+        One GET on an open stream with a minimal HTTP/1.0 client (HTTP/1.0
+        keeps the judges from answering with chunked encoding). target is a
+        path, or the absolute URL when the stream is an HTTP proxy.
+        Returns (status, body, reusable): reusable only if keep_alive was
+        asked, the peer kept the connection open and the whole body was read.
+        """
+        request = f"GET {target} HTTP/1.0\r\nHost: {netloc}\r\n"
+        for name, value in {**self.headers, **(extra_headers or {})}.items():
+            request += f"{name}: {value}\r\n"
+        writer.write((request + f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode())
+        await writer.drain()
+        
+        status_line = await asyncio.wait_for(reader.readline(), current_timeouts.get().deadline("read"))
+        timings["ttfb"] = round((time.monotonic() - start) * 1000, 1)
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ConnectionError(f"bad HTTP status line {status_line[:40]!r}")
+        # HTTP/1.1 peers keep the connection unless told otherwise, HTTP/1.0 ones only when they say so
+        persistent = status_line.startswith(b"HTTP/1.1")
+        
+        length = None
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name in (b"connection", b"proxy-connection"):
+                persistent = value == b"keep-alive"
+        
+        if length is not None:
+            body = await reader.readexactly(min(length, MAX_JUDGE_BODY))
+        else:
+            body = await reader.read(MAX_JUDGE_BODY)
+        reusable = keep_alive and persistent and length is not None and length <= MAX_JUDGE_BODY
+        return status, body, reusable
+    
+    @staticmethod
+    def dead_result(proxy_info, proxy_str, failed_types, cancelled_types=()):
+        """
+        What a check of a parseable line returns when no protocol passed:
+        the protocols that were tried and failed (none if the port did not
+        answer a single probe)
+        """
+        return {
+            "proxy": ProxyParser.normalize_proxy(proxy_info),
+            "original": proxy_str,
+            "live": False,
+            "failed_types": list(failed_types),
+            "cancelled_types": list(cancelled_types),
+        }
+    
+    async def auto_check_proxy(self, proxy_str):
+        """
+        Automatically detect and check proxy with all protocols
+        Returns the first working result; the losing probes are cancelled
+        so they stop holding sockets as soon as one protocol wins.
+        Every protocol tried ends up in exactly one of the result's "type",
+        "passed_types", "failed_types" or "cancelled_types".
+        """
+        proxy_info = ProxyParser.parse_proxy(proxy_str)
+        if not proxy_info:
+            return None
+        
+        # Only run the judges for the protocol the line names (socks5://...)
+        # or the ones the port actually answered in
+        if proxy_info.scheme:
+            proxy_types = [proxy_info.scheme]
+        else:
+            proxy_types = await self.sniff_protocol(proxy_info)
+        if not proxy_types:
+            logger.debug(f"Proxy {proxy_str} did not answer any protocol probe")
+            return self.dead_result(proxy_info, proxy_str, [])
+        
+        # Try the candidate protocols in parallel
+        tasks = {
+            asyncio.create_task(self.check_proxy_with_type(proxy_str, ptype)): ptype
+            for ptype in proxy_types
+        }
+        pending = set(tasks)
+        passed = []
+        failed = []
+        
+        try:
+            # Wait for first successful result (several can land in the same batch)
+            while pending and not passed:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task_result = None if task.exception() else task.result()
+                    if task_result:
+                        passed.append(task_result)
+                    else:
+                        failed.append(tasks[task])
+        finally:
+            # Cancel the losers (or everything, if we were cancelled ourselves)
+            # and wait for them so their connections are released now
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        if not passed:
+            logger.debug(f"Proxy {proxy_str} failed with all protocols: {', '.join(failed)}")
+            return self.dead_result(proxy_info, proxy_str, failed)
+        
+        result = min(passed, key=lambda r: r["latency"])
+        result["passed_types"] = [r["type"] for r in passed if r is not result]
+        result["failed_types"] = failed
+        result["cancelled_types"] = [tasks[task] for task in pending]
+        return result
+    
+    async def check_all_types(self, proxy_str):
+        """
+        Check proxy with all types: (working results fastest first, failed types).
+        None if the line does not parse.
+        """
+        proxy_info = ProxyParser.parse_proxy(proxy_str)
+        if not proxy_info:
+            return None
+        
+        proxy_types = await self.sniff_protocol(proxy_info)
+        if not proxy_types:
+            logger.debug(f"Proxy {proxy_str} did not answer any protocol probe")
+            return [], []
+        
+        tasks = [self.check_proxy_with_type(proxy_str, ptype) for ptype in proxy_types]
+        proxy_results = await asyncio.gather(*tasks)
+        
+        results = [result for result in proxy_results if result]
+        failed = [ptype for ptype, result in zip(proxy_types, proxy_results) if not result]
+        if not results:
+            logger.debug(f"Proxy {proxy_str} failed with all protocols: {', '.join(failed)}")
+        for result in results:
+            result["passed_types"] = [r["type"] for r in results if r is not result]
+            result["failed_types"] = failed
+            result["cancelled_types"] = []
+        
+        # Sort by latency (fastest first)
+        results.sort(key=lambda x: x["latency"])
+        return results, failed
+    
+    async def check(self, proxy_str, ptype):
+        """
+        Run the check a job mode asks for: the live result, a dead_result()
+        record, or None if the line does not parse
+        """
+        if ptype == "auto":
+            # Auto mode: try all protocols, return first working one
+            return await self.auto_check_proxy(proxy_str)
+        
+        proxy_info = ProxyParser.parse_proxy(proxy_str)
+        if not proxy_info:
+            return None
+        
+        if ptype == "all":
+            # All types mode: test all, return fastest
+            type_results, failed = await self.check_all_types(proxy_str)
+            # Take the fastest (first in sorted list)
+            return type_results[0] if type_results else self.dead_result(proxy_info, proxy_str, failed)
+        
+        # Specific type mode
+        result = await self.check_proxy_with_type(proxy_str, ptype)
+        return result or self.dead_result(proxy_info, proxy_str, [ptype])
+    
+    async def cached_result(self, proxy_str, row):
+        """
+        Fast mode: rebuild a result from a recent proxies row after a light
+        revalidation probe (a TCP connect to the proxy port, no judges).
+        Returns None if the port stopped answering, the caller then runs a full check.
+        """
+        proxy_info = ProxyParser.parse_proxy(proxy_str)
+        if not proxy_info:
+            return None
+        
+        start = time.perf_counter()
+        try:
+            reader, writer = await self._open_connection(proxy_info.ip, proxy_info.port)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            return None
+        probe_ms = round((time.perf_counter() - start) * 1000, 1)
+        writer.close()
+        
+        geo_info = await geo_batcher.lookup(proxy_info.ip)
+        return {
+            "proxy": ProxyParser.normalize_proxy(proxy_info),
+            "original": proxy_str,
+            "latency": row["latency"],
+            "country": geo_info["country"],
+            "city": geo_info["city"],
+            "isp": geo_info["isp"],
+            "asn": geo_info["asn"],
+            "aso": geo_info["aso"],
+            "success_rate": row["success_rate"],
+            "checks_passed": 0,
+            "total_checks": 0,
+            "type": row["type"],
+            "has_auth": proxy_info.user is not None,
+            "score": row["score"],
+            "live": True,
+            "cached": True,
+            "verified_at": row["last_seen"],
+            "probe_ms": probe_ms,
+            "timestamp": datetime.now().isoformat()
+        }
+
+proxy_checker = ProxyChecker()
+
+# ================== BUILT-IN JUDGE ==================
+
+async def judge_handler(request):
+    """Echo what reached us: the connecting address and every request header"""
+    return web.json_response({
+        "origin": request.remote,
+        "headers": {name: ", ".join(request.headers.getall(name)) for name in request.headers},
+    })
+
+class JudgeServer:
+    """
+    Judge endpoint served next to the checker (JUDGE_SERVER_PORT), so checks do not
+    depend on public judges that throttle us. Proxies reach it on JUDGE_PUBLIC_URL.
+    """
+    
+    def __init__(self, host=JUDGE_SERVER_HOST, port=JUDGE_SERVER_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+    
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/", judge_handler)
+        app.router.add_get("/judge", judge_handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port, reuse_address=True).start()
+        except OSError as e:
+            logger.error(f"❌ Judge server could not listen on {self.host}:{self.port}: {e}")
+            await self.stop()
+            return
+        logger.info(f"⚖️ Judge server listening on {self.host}:{self.port}")
+        if not JUDGE_PUBLIC_URL:
+            logger.warning("⚠️ JUDGE_PUBLIC_URL is not set, checks will not use the built-in judge")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+judge_server = JudgeServer()
+
+# ================== WORKER POOL ==================
+
+class WorkerPool:
+    """
+    Fixed set of worker tasks draining a bounded queue.
+    Memory and scheduler load depend on the pool size, not on the file size,
+    and the size can be changed while the pool is running.
+    """
+    
+    def __init__(self, handler, size, queue_size):
+        self.handler = handler
+        self.size = size
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = set()
+    
+    def start(self):
+        self.resize(self.size)
+        active_pools.add(self)
+        return self
+    
+    def resize(self, size):
+        """Grow immediately; shrinking retires workers as they finish their current item"""
+        self.size = max(1, size)
+        while len(self._workers) < self.size:
+            task = asyncio.create_task(self._worker())
+            self._workers.add(task)
+    
+    async def put(self, item):
+        await self.queue.put(item)  # blocks while the queue is full
+    
+    async def join(self):
+        """Wait until every queued item has been handled"""
+        await self.queue.join()
+    
+    async def close(self):
+        active_pools.discard(self)
+        for task in list(self._workers):
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+    
+    async def _worker(self):
+        try:
+            while True:
+                if len(self._workers) > self.size:
+                    return  # pool was shrunk
+                item = await self.queue.get()
+                try:
+                    await self.handler(item)
+                except Exception as e:
+                    logger.error(f"Worker failed on {item}: {e}")
+                finally:
+                    self.queue.task_done()
+        finally:
+            self._workers.discard(asyncio.current_task())
+
+# Pools of checks currently running, resized together by /workers
+active_pools = set()
+
+# ================== SHARDED ENGINE ==================
+
+def _open_existing_reader(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        return open_geo_reader(path)
+    except Exception as e:
+        logger.error(f"❌ Failed to open {path}: {e}")
+        return None
+
+def _apply_engine_settings(settings):
+    """Checker settings a shard copies from the calling process"""
+    global TIMEOUT
+    TIMEOUT = aiohttp.ClientTimeout(total=settings["total_timeout"])
+    proxy_checker.test_urls = settings["judge_urls"]
+    proxy_checker.real_ips = set(settings["real_ips"])
+
+def engine_worker_main(conn, shard, settings):
+    """Entry point of one engine process. Spawned, so only settings are inherited"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole group, the caller stops us
+    asyncio.run(_engine_worker(conn, shard, settings))
+
+async def _engine_worker(conn, shard, settings):
+    global geo_reader, geo_asn_reader
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+    
+    def receive():
+        # Blocking reads on a thread, handed over to the loop; None means stop
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            loop.call_soon_threadsafe(inbox.put_nowait, message)
+            if message is None:
+                return
+    
+    _apply_engine_settings(settings)
+    geo_reader, geo_asn_reader = _open_existing_reader(GEO_DB), _open_existing_reader(GEO_ASN_DB)
+    threading.Thread(target=receive, name="engine-rx", daemon=True).start()
+    
+    policies = {}  # job id -> TimeoutPolicy, each job adapts on its own here too
+    tasks = {}
+    
+    async def run(req_id, job_id, proxy_str, ptype):
+        policy = policies.get(job_id)
+        if policy is None:
+            policy = policies[job_id] = TimeoutPolicy(settings["ceilings"])
+        current_timeouts.set(policy)
+        try:
+            result = await proxy_checker.check(proxy_str, ptype)
+        except Exception as e:
+            logger.error(f"Error checking proxy {proxy_str} on shard {shard}: {e}")
+            result = None
+        finally:
+            tasks.pop(req_id, None)
+        try:
+            conn.send((req_id, result))
+        except (OSError, ValueError):
+            pass  # the caller is gone, the receiver stops us
+    
+    logger.info(f"🧩 Engine shard {shard} ready (pid {os.getpid()})")
+    try:
+        while True:
+            message = await inbox.get()
+            if message is None:
+                break
+            kind = message[0]
+            if kind == "check":
+                _, req_id, job_id, proxy_str, ptype = message
+                tasks[req_id] = asyncio.create_task(run(req_id, job_id, proxy_str, ptype))
+            elif kind == "cancel":
+                task = tasks.get(message[1])
+                if task:
+                    task.cancel()
+            elif kind == "end":
+                policies.pop(message[1], None)
+            elif kind == "settings":
+                settings = message[1]
+                _apply_engine_settings(settings)
+            elif kind == "geo":
+                old = geo_reader, geo_asn_reader
+                geo_reader, geo_asn_reader = _open_existing_reader(GEO_DB), _open_existing_reader(GEO_ASN_DB)
+                geo_cache.clear()
+                for reader in old:
+                    if reader is not None:
+                        loop.call_later(GEO_SWAP_GRACE, reader.close)
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        await proxy_checker.close()
+        conn.close()
+
+class ShardedEngine:
+    """
+    Caller side of the engine processes. A check goes to the shard its key
+    hashes to and its result comes back over that shard's pipe, where a
+    reader thread resolves the waiting future on the loop. A shard that
+    dies fails its checks in flight and is started again with exponential
+    backoff, up to ENGINE_RESTART_LIMIT failures in a row; meanwhile its
+    checks raise ConnectionError and callers run them in-process.
+    """
+    
+    def __init__(self, processes=ENGINE_PROCESSES):
+        self.processes = processes
+        # spawn, not fork: a forked child would inherit the caller's loop, sockets and threads
+        self._mp = multiprocessing.get_context("spawn")
+        self._shards = []  # (process, connection) per shard
+        self._started = {}  # shard -> monotonic start time
+        self._failures = {}  # shard -> deaths in a row
+        self._restarts = {}  # shard -> pending restart task
+        self._pending = {}  # request id -> (shard, future)
+        self._ids = itertools.count()
+        self._loop = None
+    
+    @property
+    def running(self):
+        return bool(self._shards)
+    
+    @staticmethod
+    def settings():
+        return {
+            "judge_urls": list(proxy_checker.test_urls),
+            "real_ips": sorted(proxy_checker.real_ips),
+            "ceilings": {"connect": CONNECT_TIMEOUT, "handshake": HANDSHAKE_TIMEOUT, "read": READ_TIMEOUT},
+            "total_timeout": TIMEOUT.total,
+        }
+    
+    def _spawn(self, shard):
+        conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(
+            target=engine_worker_main,
+            args=(child_conn, shard, self.settings()),
+            name=f"engine-{shard}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        threading.Thread(
+            target=self._receive, args=(shard, conn), name=f"engine-{shard}-rx", daemon=True
+        ).start()
+        self._started[shard] = time.monotonic()
+        return process, conn
+    
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._failures.clear()
+        # Starting an interpreter per shard takes a while: keep it off the loop
+        self._shards = list(await asyncio.gather(*(run_io(self._spawn, shard) for shard in range(self.processes))))
+        logger.info(f"🧩 Engine started with {self.processes} worker processes")
+    
+    def _receive(self, shard, conn):
+        """Reader thread of one shard: hand every result to the loop until the pipe closes"""
+        while True:
+            try:
+                req_id, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                self._loop.call_soon_threadsafe(self._resolve, req_id, result)
+            except RuntimeError:
+                return  # loop closed under us
+        try:
+            self._loop.call_soon_threadsafe(self._lost, shard, conn)
+        except RuntimeError:
+            pass
+    
+    def _resolve(self, req_id, result):
+        _, future = self._pending.pop(req_id, (None, None))
+        if future is not None and not future.done():
+            future.set_result(result)
+    
+    def _lost(self, shard, conn):
+        for req_id, (owner, future) in list(self._pending.items()):
+            if owner == shard:
+                del self._pending[req_id]
+                if not future.done():
+                    future.set_exception(ConnectionError(f"engine shard {shard} exited"))
+        # Still ours (not stopping, not already replaced): start it again
+        if shard < len(self._shards) and self._shards[shard][1] is conn:
+            conn.close()
+            if time.monotonic() - self._started.get(shard, 0) >= ENGINE_RESTART_RESET:
+                self._failures[shard] = 0
+            failures = self._failures[shard] = self._failures.get(shard, 0) + 1
+            if failures > ENGINE_RESTART_LIMIT:
+                logger.error(f"❌ Engine shard {shard} died {failures - 1} times in a row, giving up on it")
+                return
+            delay = min(ENGINE_RESTART_DELAY * 2 ** (failures - 1), ENGINE_RESTART_MAX_DELAY)
+            logger.error(f"❌ Engine shard {shard} exited, restarting it in {delay}s")
+            self._restarts[shard] = self._loop.create_task(self._restart(shard, conn, delay))
+    
+    async def _restart(self, shard, conn, delay):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._restarts.pop(shard, None)  # past here stop() no longer cancels us
+        try:
+            process, new_conn = await run_io(self._spawn, shard)
+        except Exception as e:
+            logger.error(f"❌ Engine shard {shard} failed to start: {e}")
+            self._started[shard] = time.monotonic()
+            self._lost(shard, conn)  # counts as one more failure
+            return
+        if shard < len(self._shards) and self._shards[shard][1] is conn:
+            self._shards[shard] = (process, new_conn)
+        else:
+            # Stopped while it was starting
+            new_conn.close()
+            process.terminate()
+    
+    def _send(self, shard, message):
+        try:
+            self._shards[shard][1].send(message)
+        except (OSError, ValueError):
+            pass  # dead pipe, the reader thread reports it
+    
+    async def check(self, job_id, key, proxy_str, ptype):
+        """Check one proxy on its shard: one result or None, like ProxyChecker.check"""
+        if not self._shards:
+            raise ConnectionError("engine stopped")
+        shard = zlib.crc32(key.encode()) % len(self._shards)
+        req_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[req_id] = (shard, future)
+        try:
+            try:
+                self._shards[shard][1].send(("check", req_id, job_id, proxy_str, ptype))
+            except (OSError, ValueError) as e:
+                raise ConnectionError(f"engine shard {shard} unavailable: {e}")
+            return await future
+        except asyncio.CancelledError:
+            self._send(shard, ("cancel", req_id))
+            raise
+        finally:
+            self._pending.pop(req_id, None)
+    
+    def broadcast(self, message):
+        for shard in range(len(self._shards)):
+            self._send(shard, message)
+    
+    def configure(self):
+        """Push changed checker settings (judges, our address) to every shard"""
+        self.broadcast(("settings", self.settings()))
+    
+    def end_job(self, job_id):
+        """Let the shards drop the per-job state of a finished job"""
+        self.broadcast(("end", job_id))
+    
+    def in_flight(self):
+        counts = [0] * len(self._shards)
+        for shard, _ in self._pending.values():
+            counts[shard] += 1
+        return counts
+    
+    async def stop(self):
+        shards, self._shards = self._shards, []
+        for task in list(self._restarts.values()):
+            task.cancel()
+        for process, conn in shards:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process, conn in shards:
+            await run_io(process.join, 10)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        if shards:
+            logger.info("✅ Engine worker processes stopped")
+
+engine = ShardedEngine()
+
+# ================== HEADLESS API ==================
+
+_run_ids = itertools.count()
+
+async def _iter_items(lines):
+    if hasattr(lines, "__aiter__"):
+        async for item in lines:
+            yield item
+    else:
+        for item in lines:
+            yield item
+
+async def check_proxies(lines, ptype="auto", concurrency=50, include_dead=False):
+    """
+    Check proxies and yield a result dict per unique endpoint, in completion
+    order. lines is an iterable or async iterable of lines, text buffers or
+    lists of lines, consumed as the checks go. Live results are geo-enriched
+    and scored like the bot's (first sighting, no uptime history); with
+    include_dead the rest come as {"proxy", "original", "live": False}, plus
+    the "failed_types" and "cancelled_types" tried if the line parsed.
+    Closing the generator early cancels the checks still running.
+    """
+    results = asyncio.Queue(maxsize=concurrency * 2)
+    finished = object()
+    run_id = f"api-{os.getpid()}-{next(_run_ids)}"
+    
+    async def dead(proxy, original):
+        if include_dead:
+            await results.put({"proxy": proxy, "original": original, "live": False})
+    
+    async def runner(item):
+        key, proxy_str, proxy = item
+        try:
+            if engine.running:
+                result = await engine.check(run_id, key, proxy_str, ptype)
+            else:
+                result = await proxy_checker.check(proxy_str, ptype)
+        except ConnectionError:
+            # Its engine shard died mid-check: check it here rather than call it dead
+            result = await proxy_checker.check(proxy_str, ptype)
+        except Exception as e:
+            logger.error(f"Error checking proxy {proxy_str}: {e}")
+            result = None
+        
+        if not result:
+            await dead(proxy, proxy_str)
+            return
+        if not result["live"]:
+            if include_dead:
+                await results.put(result)
+            return
+        result["score"] = smart_score(
+            result["latency"], 1, 100, result["type"], result.get("timings")
+        )
+        await results.put(result)
+    
+    async def run():
+        # Own task, so the adaptive deadlines of this run stay out of the caller's context
+        current_timeouts.set(TimeoutPolicy())
+        if not proxy_checker.real_ips:
+            await proxy_checker.detect_real_ip()
+        pool = WorkerPool(runner, concurrency, concurrency * 2).start()
+        seen = set()
+        try:
+            async for item in _iter_items(lines):
+                for line, proxy_info in ProxyParser.parse_many(item):
+                    if not proxy_info:
+                        if ':' in line:
+                            await dead(None, line)  # looks like host:port but can never be checked
+                        continue
+                    key = ProxyParser.canonical_key(proxy_info)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    await pool.put((key, line, ProxyParser.normalize_proxy(proxy_info)))
+            await pool.join()
+        finally:
+            await pool.close()
+            if engine.running:
+                engine.end_job(run_id)
+            await results.put(finished)
+    
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            result = await results.get()
+            if result is finished:
+                break
+            yield result
+        await task  # surfaces a failure of the input iterable
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+# ================== COMMAND LINE ==================
+
+CSV_FIELDS = (
+    "proxy", "original", "live", "type", "latency", "score", "anonymity", "country",
+    "city", "isp", "asn", "aso", "success_rate", "checks_passed", "total_checks", "has_auth",
+    "passed_types", "failed_types", "cancelled_types",
+)
+CSV_LIST_FIELDS = ("passed_types", "failed_types", "cancelled_types")
+
+async def iter_file_lines(paths):
+    """Yield batches of lines from the files in order, "-" (or no file) being stdin"""
+    for path in paths or ["-"]:
+        if path == "-":
+            f = sys.stdin
+        else:
+            f = await run_io(open, path, encoding="utf-8", errors="replace")
+        try:
+            while True:
+                batch = await run_io(f.readlines, DOWNLOAD_CHUNK_SIZE)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+async def run_cli(args):
+    await run_io(load_geo_readers, download=not (args.offline or args.update_geo))
+    if args.update_geo:
+        await refresh_geolite(force=True)
+    if args.processes > 1:
+        await proxy_checker.detect_real_ip()  # before the shards copy it
+        engine.processes = args.processes
+        await engine.start()
+    
+    if args.format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        
+        def write(result):
+            writer.writerow({**result, **{
+                field: " ".join(result[field]) for field in CSV_LIST_FIELDS if field in result
+            }})
+    else:
+        def write(result):
+            sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+    
+    live = total = 0
+    started = time.perf_counter()
+    try:
+        async for result in check_proxies(
+            iter_file_lines(args.files), args.type, args.concurrency, args.include_dead
+        ):
+            write(result)
+            sys.stdout.flush()  # consumers read results as they come
+            total += 1
+            live += result["live"]
+    finally:
+        await engine.stop()
+        await proxy_checker.close()
+        close_geo_readers()
+    logger.info(f"✅ {live} live proxies out of {total} reported in {time.perf_counter() - started:.1f}s")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m checker",
+        description="Check proxies from files or stdin and stream results to stdout.",
+    )
+    parser.add_argument("files", nargs="*", metavar="FILE", help='proxy lists, "-" or none for stdin')
+    parser.add_argument(
+        "-t", "--type", default="auto", choices=("auto", "all", "http", "https") + SOCKS_TYPES,
+        help="protocol to check (auto: first working one, all: fastest one)",
+    )
+    parser.add_argument("-f", "--format", default="jsonl", choices=("jsonl", "csv"))
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="checks in flight")
+    parser.add_argument(
+        "--processes", type=int, default=ENGINE_PROCESSES, help="check in this many worker processes"
+    )
+    parser.add_argument("--include-dead", action="store_true", help="also report dead and invalid proxies")
+    parser.add_argument("--update-geo", action="store_true", help="download fresh GeoLite2 databases first")
+    parser.add_argument("--offline", action="store_true", help="never download GeoLite2, use what is on disk")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    
+    # Bad arguments fail here, before GeoLite2 or our own address go to the network
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.processes < 0:
+        parser.error("--processes must not be negative")
+    for path in args.files:
+        if path != "-" and not (os.path.isfile(path) and os.access(path, os.R_OK)):
+            parser.error(f"cannot read {path}")
+    
+    # Logs go to stderr, stdout only carries results
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+        level=logging.INFO if args.verbose else logging.WARNING,
+        stream=sys.stderr,
+    )
+    try:
+        asyncio.run(run_cli(args))
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # Reader went away (| head): stop quietly
+        sys.stderr.close()
+    except OSError as e:
+        # Missing or unreadable input file
+        print(f"checker: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        io_executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+ProxyChecker.check outcomes with the sniff and the judges stubbed out:
+every protocol tried is accounted for, and dead lines get a record.
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from checker import ProxyChecker  # noqa: E402
+
+
+def stub_checker(sniffed, outcomes):
+    """outcomes: protocol -> (seconds to answer, latency if it passes else None)"""
+    checker = ProxyChecker()
+    
+    async def sniff_protocol(proxy_info):
+        return list(sniffed)
+    
+    async def check_proxy_with_type(proxy_str, ptype):
+        delay, latency = outcomes[ptype]
+        await asyncio.sleep(delay)
+        if latency is None:
+            return None
+        return {"proxy": proxy_str, "type": ptype, "latency": latency, "live": True}
+    
+    checker.sniff_protocol = sniff_protocol
+    checker.check_proxy_with_type = check_proxy_with_type
+    return checker
+
+
+def test_auto_keeps_every_protocol_of_a_batch():
+    # Both pass at the same moment: the faster one wins, the other is reported, not lost
+    checker = stub_checker(
+        ["http", "https", "socks5"],
+        {"http": (0, 300), "https": (0, 120), "socks5": (5, 50)},
+    )
+    result = asyncio.run(checker.check("127.0.0.1:8080", "auto"))
+    assert result["type"] == "https"
+    assert result["passed_types"] == ["http"]
+    assert result["failed_types"] == []
+    assert result["cancelled_types"] == ["socks5"]
+
+
+def test_auto_dead_record_names_the_failed_protocols():
+    checker = stub_checker(["http", "https"], {"http": (0, None), "https": (0.01, None)})
+    result = asyncio.run(checker.check("127.0.0.1:8080", "auto"))
+    assert result["live"] is False
+    assert result["proxy"] == "127.0.0.1:8080"
+    assert sorted(result["failed_types"]) == ["http", "https"]
+
+
+def test_silent_port_and_specific_type_dead_records():
+    checker = stub_checker([], {"socks4": (0, None)})
+    assert asyncio.run(checker.check("127.0.0.1:1080", "auto"))["failed_types"] == []
+    assert asyncio.run(checker.check("127.0.0.1:1080", "socks4"))["failed_types"] == ["socks4"]
+    assert asyncio.run(checker.check("not a proxy", "socks4")) is None
+
+
+def test_all_mode_returns_the_fastest_and_lists_the_rest():
+    checker = stub_checker(
+        ["http", "socks5", "socks4"],
+        {"http": (0, 300), "socks5": (0, 90), "socks4": (0, None)},
+    )
+    result = asyncio.run(checker.check("127.0.0.1:8080", "all"))
+    assert (result["type"], result["passed_types"], result["failed_types"]) == ("socks5", ["http"], ["socks4"])
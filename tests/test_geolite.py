@@ -0,0 +1,171 @@
+"""
+Background GeoLite2 refresh (refresh_geolite) against a local HTTP stand-in
+for the MaxMind download endpoint serving fixture tarballs: the reader is
+hot-swapped, the old one is closed only after GEO_SWAP_GRACE, and an archive
+holding the wrong edition never replaces a working database.
+"""
+import io
+import os
+import sys
+import asyncio
+import tarfile
+
+import geoip2.database
+import geoip2.errors
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import checker  # noqa: E402
+
+
+# ---------- minimal MaxMind DB files ----------
+
+def _control(type_, size):
+    if type_ <= 7:
+        return bytes([(type_ << 5) | size])
+    return bytes([size, type_ - 7])  # extended type
+
+def _encode(value):
+    """MaxMind DB data section encoding of the few types the metadata needs"""
+    if isinstance(value, str):
+        data = value.encode()
+        return _control(2, len(data)) + data
+    if isinstance(value, dict):
+        return _control(7, len(value)) + b"".join(_encode(k) + _encode(v) for k, v in value.items())
+    if isinstance(value, list):
+        return _control(11, len(value)) + b"".join(_encode(v) for v in value)
+    type_, number = value  # (uint16=5 / uint32=6 / uint64=9, value)
+    data = number.to_bytes(8, "big").lstrip(b"\x00")
+    return _control(type_, len(data)) + data
+
+def mmdb(database_type, build_epoch):
+    """An empty IPv4 database: one search tree node, no records, real metadata"""
+    metadata = {
+        "binary_format_major_version": (5, 2),
+        "binary_format_minor_version": (5, 0),
+        "build_epoch": (9, build_epoch),
+        "database_type": database_type,
+        "description": {"en": "test fixture"},
+        "ip_version": (5, 4),
+        "languages": ["en"],
+        "node_count": (6, 1),
+        "record_size": (5, 24),
+    }
+    tree = (1).to_bytes(3, "big") * 2  # both records point past the tree: not found
+    return tree + b"\x00" * 16 + b"\xab\xcd\xefMaxMind.com" + _encode(metadata)
+
+def tarball(edition, database_type, build_epoch):
+    """Archive laid out like MaxMind's: <edition>_<date>/<edition>.mmdb"""
+    data = mmdb(database_type, build_epoch)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        info = tarfile.TarInfo(f"{edition}_20261016/{edition}.mmdb")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+# ---------- stand-in download endpoint ----------
+
+@pytest.fixture
+def geo_env(tmp_path, monkeypatch):
+    """Point the checker's GeoLite2 paths and download URL at tmp_path and a local server"""
+    city, asn = str(tmp_path / "GeoLite2-City.mmdb"), str(tmp_path / "GeoLite2-ASN.mmdb")
+    monkeypatch.setattr(checker, "GEO_DB", city)
+    monkeypatch.setattr(checker, "GEO_ASN_DB", asn)
+    monkeypatch.setattr(checker, "GEO_EDITIONS", (("GeoLite2-City", city, True),))
+    monkeypatch.setattr(checker, "GEO_SWAP_GRACE", 0.2)
+    monkeypatch.setattr(checker, "geo_reader", None)
+    monkeypatch.setattr(checker, "geo_asn_reader", None)
+    monkeypatch.setattr(checker, "GEO_DOWNLOAD_URL", checker.GEO_DOWNLOAD_URL)  # _serve repoints it
+    served = {}  # edition -> tarball bytes
+    return city, served
+
+async def _serve(served):
+    async def download(request):
+        body = served.get(request.query.get("edition_id"))
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body, content_type="application/gzip")
+    
+    app = web.Application()
+    app.router.add_get("/app/geoip_download", download)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    checker.GEO_DOWNLOAD_URL = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/app/geoip_download"
+    return runner
+
+def refresh(served, during=None):
+    """refresh_geolite(force=True) against the stand-in; during(updated) runs before it shuts down"""
+    async def run():
+        runner = await _serve(served)
+        try:
+            updated = await checker.refresh_geolite(force=True)
+            if during is not None:
+                await during(updated)
+            return updated
+        finally:
+            await checker.proxy_checker.close()
+            await runner.cleanup()
+    return asyncio.run(run())
+
+def write_db(path, database_type, build_epoch):
+    with open(path, "wb") as f:
+        f.write(mmdb(database_type, build_epoch))
+
+
+# ---------- tests ----------
+
+def test_hot_swap_closes_old_reader_after_grace(geo_env):
+    city, served = geo_env
+    write_db(city, "GeoLite2-City", 1)
+    old = geoip2.database.Reader(city)
+    checker.geo_reader = old
+    served["GeoLite2-City"] = tarball("GeoLite2-City", "GeoLite2-City", 2)
+    
+    async def during(updated):
+        assert updated == ["GeoLite2-City"]
+        assert checker.geo_reader is not old
+        assert checker.geo_reader.metadata().build_epoch == 2
+        # Lookups already running on the old reader still work inside the grace period
+        with pytest.raises(geoip2.errors.AddressNotFoundError):
+            old.city("1.2.3.4")
+        await asyncio.sleep(checker.GEO_SWAP_GRACE + 0.2)
+        with pytest.raises(ValueError, match="closed"):
+            old.city("1.2.3.4")
+    
+    refresh(served, during)
+    checker.geo_reader.close()
+    with geoip2.database.Reader(city) as reader:
+        assert reader.metadata().build_epoch == 2
+    assert sorted(os.listdir(os.path.dirname(city))) == ["GeoLite2-City.mmdb"]  # no .part / .tmp left
+
+def test_wrong_edition_is_rejected(geo_env):
+    city, served = geo_env
+    write_db(city, "GeoLite2-City", 1)
+    current = geoip2.database.Reader(city)
+    checker.geo_reader = current
+    # A City-named archive that actually holds the ASN database
+    served["GeoLite2-City"] = tarball("GeoLite2-City", "GeoLite2-ASN", 2)
+    
+    assert refresh(served) == []
+    assert checker.geo_reader is current
+    with geoip2.database.Reader(city) as reader:
+        assert reader.metadata().database_type == "GeoLite2-City"
+        assert reader.metadata().build_epoch == 1
+    current.close()
+    assert sorted(os.listdir(os.path.dirname(city))) == ["GeoLite2-City.mmdb"]
+
+def test_failed_download_keeps_current_reader(geo_env):
+    city, served = geo_env
+    write_db(city, "GeoLite2-City", 1)
+    current = geoip2.database.Reader(city)
+    checker.geo_reader = current
+    
+    assert refresh(served) == []  # the stand-in answers 404
+    assert checker.geo_reader is current
+    current.close()
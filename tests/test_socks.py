@@ -0,0 +1,296 @@
+"""
+Native SOCKS client (ProxyChecker.socks_request) against a local asyncio
+SOCKS4/4a/5 stand-in: no auth, username/password, rejected replies and
+SOCKS4a hostnames; protocol sniffing against raw local listeners; and the
+keep-alive HTTP proxy client (HttpProxyStream) a check's judges share.
+Nothing leaves 127.0.0.1.
+"""
+import os
+import sys
+import json
+import socket
+import struct
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from checker import ProxyChecker, ProxyParser, TimeoutPolicy, current_timeouts  # noqa: E402
+
+
+class SocksStandIn:
+    """
+    Minimal SOCKS4/4a/5 server. Granted tunnels answer one HTTP request the
+    way a judge would; every CONNECT is recorded as (host, port, user).
+    """
+    
+    def __init__(self, version, credentials=None, reply=None):
+        self.version = version
+        self.credentials = credentials  # (user, password) a SOCKS5 client must send
+        self.reply = reply  # CONNECT reply code to refuse with, None = grant
+        self.connects = []
+        self.port = None
+        self._server = None
+    
+    async def __aenter__(self):
+        handler = self._socks5 if self.version == 5 else self._socks4
+        self._server = await asyncio.start_server(self._serve(handler), "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+    
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+    
+    def _serve(self, handler):
+        async def serve(reader, writer):
+            try:
+                if await handler(reader, writer):
+                    await self._judge(reader, writer)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+        return serve
+    
+    async def _judge(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        body = json.dumps({"origin": "127.0.0.1", "request": head.split(b"\r\n")[0].decode()}).encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    
+    async def _socks5(self, reader, writer):
+        version, n = await reader.readexactly(2)
+        assert version == 5
+        methods = await reader.readexactly(n)
+        user = None
+        if self.credentials:
+            if 2 not in methods:
+                writer.write(b"\x05\xff")
+                return False
+            writer.write(b"\x05\x02")
+            await reader.readexactly(1)
+            user = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            password = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            if (user, password) != self.credentials:
+                writer.write(b"\x01\x01")
+                return False
+            writer.write(b"\x01\x00")
+        else:
+            writer.write(b"\x05\x00")
+        
+        _, _, _, atyp = await reader.readexactly(4)
+        if atyp == 1:
+            host = socket.inet_ntoa(await reader.readexactly(4))
+        elif atyp == 3:
+            host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        port = struct.unpack(">H", await reader.readexactly(2))[0]
+        self.connects.append((host, port, user))
+        
+        writer.write(bytes([5, self.reply or 0, 0, 1]) + b"\x00" * 6)
+        await writer.drain()
+        return self.reply is None
+    
+    async def _socks4(self, reader, writer):
+        version, command = await reader.readexactly(2)
+        assert (version, command) == (4, 1)
+        port = struct.unpack(">H", await reader.readexactly(2))[0]
+        ip = await reader.readexactly(4)
+        user = (await reader.readuntil(b"\x00"))[:-1].decode()
+        if ip[:3] == b"\x00\x00\x00" and ip[3]:
+            host = (await reader.readuntil(b"\x00"))[:-1].decode()  # SOCKS4a
+        else:
+            host = socket.inet_ntoa(ip)
+        self.connects.append((host, port, user))
+        
+        writer.write(bytes([0, self.reply or 0x5A]) + b"\x00" * 6)
+        await writer.drain()
+        return self.reply is None
+
+
+def request(server, proxy_type, url, line="127.0.0.1:1"):
+    """socks_request through the stand-in (the line's port is replaced); returns (status, parsed body)"""
+    proxy_info = ProxyParser.parse_proxy(line)
+    status, body = asyncio.run(_request(server, proxy_info, proxy_type, url))
+    return status, json.loads(body)
+
+
+async def _request(server, proxy_info, proxy_type, url):
+    async with server:
+        proxy_info = proxy_info._replace(port=server.port)
+        return await ProxyChecker().socks_request(proxy_info, proxy_type, url)
+
+
+def test_socks5_no_auth_hostname():
+    server = SocksStandIn(5)
+    status, body = request(server, "socks5", "http://judge.test/ip?format=json")
+    assert status == 200
+    assert body["request"] == "GET /ip?format=json HTTP/1.0"
+    assert server.connects == [("judge.test", 80, None)]
+
+
+def test_socks5_ip_target():
+    server = SocksStandIn(5)
+    request(server, "socks5", "http://203.0.113.7:8089/judge")
+    assert server.connects == [("203.0.113.7", 8089, None)]
+
+
+def test_socks5_user_pass():
+    server = SocksStandIn(5, credentials=("alice", "s3cret"))
+    status, _ = request(server, "socks5", "http://judge.test/ip", "alice:s3cret@127.0.0.1:1")
+    assert status == 200
+    assert server.connects == [("judge.test", 80, "alice")]
+
+
+def test_socks5_wrong_password():
+    server = SocksStandIn(5, credentials=("alice", "s3cret"))
+    with pytest.raises(ConnectionError, match="authentication rejected"):
+        request(server, "socks5", "http://judge.test/ip", "alice:nope@127.0.0.1:1")
+    assert server.connects == []
+
+
+def test_socks5_auth_required_without_credentials():
+    server = SocksStandIn(5, credentials=("alice", "s3cret"))
+    with pytest.raises(ConnectionError, match="none of our auth methods"):
+        request(server, "socks5", "http://judge.test/ip")
+
+
+def test_socks5_connect_refused():
+    server = SocksStandIn(5, reply=5)
+    with pytest.raises(ConnectionError, match="reply 5"):
+        request(server, "socks5", "http://judge.test/ip")
+
+
+def test_socks4_ip_target():
+    server = SocksStandIn(4)
+    status, _ = request(server, "socks4", "http://203.0.113.7/ip")
+    assert status == 200
+    assert server.connects == [("203.0.113.7", 80, "")]
+
+
+def test_socks4a_hostname_and_user_id():
+    server = SocksStandIn(4)
+    status, _ = request(server, "socks4", "http://judge.test:8080/ip", "bob:pw@127.0.0.1:1")
+    assert status == 200
+    assert server.connects == [("judge.test", 8080, "bob")]
+
+
+def test_socks4_rejected():
+    server = SocksStandIn(4, reply=0x5B)
+    with pytest.raises(ConnectionError, match="rejected"):
+        request(server, "socks4", "http://judge.test/ip")
+
+
+async def _sniff(handler, line="127.0.0.1:1"):
+    server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    async with server:
+        proxy_info = ProxyParser.parse_proxy(line)._replace(port=server.sockets[0].getsockname()[1])
+        return await ProxyChecker().sniff_protocol(proxy_info)
+
+
+def test_sniff_mixed_port_finds_socks_next_to_http():
+    async def mixed(reader, writer):
+        first = await reader.read(64)
+        if first.startswith(b"CONNECT"):
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        elif first[:1] == b"\x05":
+            writer.write(b"\x05\x00")
+        await writer.drain()
+        writer.close()
+    
+    assert sorted(asyncio.run(_sniff(mixed))) == ["http", "https", "socks5"]
+
+
+def test_sniff_silent_port_is_not_waited_on_after_a_reply():
+    async def socks4_only(reader, writer):
+        first = await reader.read(64)
+        if first[:1] == b"\x04":
+            writer.write(b"\x00\x5a" + b"\x00" * 6)
+            await writer.drain()
+            writer.close()
+        else:
+            await asyncio.sleep(30)  # an HTTP proxy waiting on the rest of a greeting
+    
+    async def timed():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        found = await _sniff(socks4_only)
+        return found, loop.time() - start
+    
+    found, elapsed = asyncio.run(timed())
+    assert found == ["socks4"]
+    assert elapsed < 1
+
+
+def test_sniff_reply_teaches_the_handshake_deadline():
+    async def http_only(reader, writer):
+        if (await reader.read(64)).startswith(b"CONNECT"):
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            await writer.drain()
+        writer.close()
+    
+    async def run():
+        policy = TimeoutPolicy()
+        current_timeouts.set(policy)
+        await _sniff(http_only)
+        return policy
+    
+    policy = asyncio.run(run())
+    assert len(policy.samples["handshake"]) == 1
+    assert not policy.samples["connect"]
+
+
+class HttpProxyStandIn:
+    """Plain HTTP proxy answering absolute-form GETs as a judge; records each connection's requests"""
+    
+    def __init__(self, keep_alive=True):
+        self.keep_alive = keep_alive
+        self.connections = []
+        self.port = None
+    
+    async def serve(self, reader, writer):
+        requests = []
+        self.connections.append(requests)
+        try:
+            while head := await reader.readuntil(b"\r\n\r\n"):
+                requests.append(head.decode())
+                body = b'{"origin": "203.0.113.9"}'
+                keep = self.keep_alive and b"connection: keep-alive" in head.lower()
+                writer.write(
+                    b"HTTP/1.0 200 OK\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n"
+                    % (len(body), b"keep-alive" if keep else b"close") + body
+                )
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _judges(proxy, line="127.0.0.1:1"):
+    checker = ProxyChecker([f"http://judge{i}.test/ip" for i in range(3)])
+    server = await asyncio.start_server(proxy.serve, "127.0.0.1", 0)
+    async with server:
+        proxy_info = ProxyParser.parse_proxy(line)._replace(port=server.sockets[0].getsockname()[1])
+        passed, completed, _, _ = await checker._run_judges(None, proxy_info, "http", "unused")
+    return passed, completed
+
+
+def test_http_proxy_judges_share_one_connection():
+    proxy = HttpProxyStandIn()
+    assert asyncio.run(_judges(proxy, "alice:s3cret@127.0.0.1:1")) == (2, 2)
+    assert len(proxy.connections) == 1
+    first, second = proxy.connections[0]
+    assert first.startswith("GET http://judge") and second.startswith("GET http://judge")
+    assert "Proxy-Authorization: Basic YWxpY2U6czNjcmV0\r\n" in first
+
+
+def test_http_proxy_that_closes_gets_a_new_connection():
+    proxy = HttpProxyStandIn(keep_alive=False)
+    assert asyncio.run(_judges(proxy)) == (2, 2)
+    assert [len(requests) for requests in proxy.connections] == [1, 1]